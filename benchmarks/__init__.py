@@ -0,0 +1,6 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
\ No newline at end of file
@@ -0,0 +1,54 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+'''
+Run the mipy benchmarks against an in-process stub kernel and emit the results as JSON
+
+Usage: python -m benchmarks [--quick] [--output results.json] [--list] [benchmark names...]
+'''
+
+import sys, json, argparse
+
+from . import protocol, connection
+from .harness import run_benchmarks, benchmark_names
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Run the mipy benchmarks')
+	parser.add_argument('names', nargs='*', help='benchmarks to run; all if none are given')
+	parser.add_argument('--quick', action='store_true', help='run a tenth of the iterations')
+	parser.add_argument('--scale', type=float, default=1.0, help='factor applied to iteration counts')
+	parser.add_argument('-o', '--output', help='file to which the JSON results are written; stdout if omitted')
+	parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+	args = parser.parse_args(argv)
+
+	if args.list:
+		for name in benchmark_names():
+			print name
+		return 0
+
+	unknown = [name   for name in args.names   if name not in benchmark_names()]
+	if len(unknown) > 0:
+		parser.error('unknown benchmarks: {0}'.format(', '.join(unknown)))
+
+	scale = args.scale * (0.1   if args.quick   else 1.0)
+	report = run_benchmarks(args.names   or  None, scale=scale, log=sys.stderr)
+
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+	else:
+		json.dump(report, sys.stdout, indent=2, sort_keys=True)
+		sys.stdout.write('\n')
+
+	failed = [name   for name, result in report['results'].items()   if 'error' in result]
+	return 1   if len(failed) > 0   else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,189 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import gc, time
+
+from mipy.util import clock
+from mipy.metrics import process_rss_bytes
+from mipy.request_listener import KernelRequestListener
+from mipy.stub_kernel import StubKernel, stream_output
+
+from .harness import benchmark, scaled, rate, latency_summary, poll_until
+
+
+
+class _CountingListener (KernelRequestListener):
+	def __init__(self):
+		super(_CountingListener, self).__init__()
+		self.n_streams = 0
+		self.n_stream_bytes = 0
+		self.finished = False
+
+	def on_stream(self, stream_name, text):
+		self.n_streams += 1
+		self.n_stream_bytes += len(text)
+
+	def on_request_finished(self):
+		self.finished = True
+
+
+def _connect(kernel, **kwargs):
+	'''
+	Connect to a stub kernel and wait until the IOPUB subscription is in place
+	'''
+	connection = kernel.connect(**kwargs)
+	info = []
+	connection.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+	poll_until(connection, lambda: len(info) > 0)
+	# IOPUB is a slow joiner; the reply can arrive before the subscription reaches the kernel
+	time.sleep(0.2)
+	return connection
+
+
+def _execute(connection, code):
+	listener = _CountingListener()
+	connection.execute_request(code, listener=listener)
+	poll_until(connection, lambda: listener.finished)
+	return listener
+
+
+@benchmark('poll_idle')
+def poll_idle(scale):
+	'''
+	Calls to poll(0) on an idle connection
+	'''
+	kernel = StubKernel()
+	try:
+		connection = _connect(kernel)
+		n = scaled(100000, scale)
+		t0 = clock()
+		for i in xrange(n):
+			connection.poll(0)
+		t = clock() - t0
+		connection.close()
+	finally:
+		kernel.close()
+	return {'polls': n, 'polls_per_second': rate(n, t)}
+
+
+@benchmark('execute_round_trip')
+def execute_round_trip(scale):
+	'''
+	Time from sending an execute request until both its reply and idle status have been dispatched
+	'''
+	kernel = StubKernel()
+	try:
+		connection = _connect(kernel)
+		for i in xrange(20):
+			_execute(connection, 'pass')
+		samples = []
+		n = scaled(2000, scale)
+		t0 = clock()
+		for i in xrange(n):
+			t = clock()
+			_execute(connection, 'pass')
+			samples.append(clock() - t)
+		total = clock() - t0
+		connection.close()
+	finally:
+		kernel.close()
+	result = latency_summary(samples)
+	result['requests_per_second'] = rate(n, total)
+	return result
+
+
+@benchmark('stream_flood')
+def stream_flood(scale):
+	'''
+	Rate at which a flood of 'stream' messages from one request is drained and delivered, with and without
+	stream coalescing
+	'''
+	n = scaled(50000, scale)
+	line = 'x' * 79 + '\n'
+	outputs = [stream_output(line)] * n
+	kernel = StubKernel(execute_handler=lambda code: outputs)
+	result = {'messages': n, 'message_text_bytes': len(line)}
+	try:
+		for name, kwargs in [('plain', {}), ('coalesced', {'coalesce_streams': True})]:
+			connection = _connect(kernel, **kwargs)
+			t0 = clock()
+			listener = _execute(connection, 'flood')
+			t = clock() - t0
+			connection.close()
+			if listener.n_stream_bytes != n * len(line):
+				raise RuntimeError, 'received {0} of {1} bytes of output'.format(listener.n_stream_bytes,
+												  n * len(line))
+			result[name] = {'messages_per_second': rate(n, t),
+					'megabytes_per_second': rate(listener.n_stream_bytes / 1.0e6, t),
+					'on_stream_events': listener.n_streams}
+	finally:
+		kernel.close()
+	return result
+
+
+@benchmark('comm_throughput')
+def comm_throughput(scale):
+	'''
+	Comm messages echoed by the kernel per second, keeping a window of messages in flight
+	'''
+	window = 32
+	kernel = StubKernel()
+	result = {'window': window}
+	try:
+		connection = _connect(kernel)
+		for name, buffers, n in [('json', None, scaled(20000, scale)),
+					 ('buffers_64k', [b'\0' * 65536], scaled(5000, scale))]:
+			received = [0]
+			comm = connection.open_comm('benchmark')
+			comm.on_binary_message = lambda comm, data, buffers, listener: received.__setitem__(0, received[0] + 1)
+			n_sent = 0
+			t0 = clock()
+			while received[0] < n:
+				while n_sent < n  and  n_sent - received[0] < window:
+					comm.send({'i': n_sent}, buffers=buffers)
+					n_sent += 1
+				connection.poll(100)
+			t = clock() - t0
+			comm.close({})
+			result[name] = {'messages': n, 'messages_per_second': rate(n, t)}
+			if buffers is not None:
+				result[name]['megabytes_per_second'] = rate(n * len(buffers[0]) / 1.0e6, t)
+		connection.close()
+	finally:
+		kernel.close()
+	return result
+
+
+@benchmark('connection_memory')
+def connection_memory(scale):
+	'''
+	Resident memory used by each open connection
+	'''
+	n = scaled(50, scale)
+	kernel = StubKernel()
+	connections = []
+	try:
+		# Load modules and create the shared ZeroMQ context before measuring
+		connections.append(_connect(kernel))
+		gc.collect()
+		before = process_rss_bytes()
+		for i in xrange(n):
+			connection = kernel.connect()
+			info = []
+			connection.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+			poll_until(connection, lambda: len(info) > 0)
+			connections.append(connection)
+		gc.collect()
+		after = process_rss_bytes()
+	finally:
+		for connection in connections:
+			connection.close()
+		kernel.close()
+	if before is None  or  after is None:
+		return {'connections': n, 'bytes_per_connection': None}
+	return {'connections': n, 'rss_before_bytes': before, 'rss_after_bytes': after,
+		'bytes_per_connection': (after - before) / float(n)}
@@ -0,0 +1,110 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import gc, time, platform, traceback
+
+from mipy.util import clock
+
+
+
+_BENCHMARKS = []
+
+
+
+def benchmark(name):
+	'''
+	Decorator that registers a benchmark
+
+	The benchmark function takes a scale factor (1.0 for a full run, smaller for a quick one) by which to
+	multiply its iteration counts, and returns a dictionary of results.
+
+	:param name: the name under which the results are reported
+	'''
+	def register(fn):
+		_BENCHMARKS.append((name, fn))
+		return fn
+	return register
+
+
+def benchmark_names():
+	return [name   for name, fn in _BENCHMARKS]
+
+
+def scaled(n, scale):
+	'''
+	:return: the iteration count n multiplied by scale, and at least 1
+	'''
+	return max(int(n * scale), 1)
+
+
+def rate(n, seconds):
+	'''
+	:return: the number of operations per second, given n operations in the given time
+	'''
+	return n / seconds   if seconds > 0   else None
+
+
+def latency_summary(samples):
+	'''
+	:param samples: a list of durations in seconds
+	:return: a dictionary of count and the mean, min, p50, p90, p99 and max durations in milliseconds
+	'''
+	ordered = sorted(samples)
+	n = len(ordered)
+	def pct(q):
+		return ordered[min(int(n * q / 100.0), n - 1)] * 1.0e3
+	return {'count': n, 'mean_ms': sum(ordered) / n * 1.0e3, 'min_ms': ordered[0] * 1.0e3,
+		'p50_ms': pct(50), 'p90_ms': pct(90), 'p99_ms': pct(99), 'max_ms': ordered[-1] * 1.0e3}
+
+
+def poll_until(connection, condition, timeout=60.0):
+	'''
+	Poll a connection until a condition holds
+
+	:param connection: a KernelConnection
+	:param condition: function of the form f() -> bool
+	:param timeout: the time in seconds after which to give up
+	'''
+	deadline = clock() + timeout
+	while not condition():
+		if clock() > deadline:
+			raise RuntimeError, 'benchmark timed out'
+		connection.poll(100)
+
+
+def run_benchmarks(names=None, scale=1.0, log=None):
+	'''
+	Run benchmarks
+
+	:param names: None to run all benchmarks, or a list of the names of those to run
+	:param scale: scale factor applied to iteration counts
+	:param log: None, or a file to which progress is written
+	:return: a JSON serializable dictionary describing the environment and the results of each benchmark;
+		a benchmark that fails is reported with an 'error' entry
+	'''
+	results = {}
+	for name, fn in _BENCHMARKS:
+		if names is not None  and  name not in names:
+			continue
+		if log is not None:
+			log.write('{0}... '.format(name))
+			log.flush()
+		gc.collect()
+		t0 = clock()
+		try:
+			result = fn(scale)
+		except Exception, e:
+			result = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+			if log is not None:
+				traceback.print_exc(file=log)
+		result['wall_seconds'] = clock() - t0
+		results[name] = result
+		if log is not None:
+			log.write('{0:.2f}s\n'.format(result['wall_seconds']))
+	return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_implementation() + ' ' + platform.python_version(),
+		'platform': platform.platform(), 'scale': scale, 'results': results}
@@ -0,0 +1,61 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+from mipy.util import clock
+from mipy.session import Session
+
+from .harness import benchmark, scaled, rate
+
+
+
+_EXECUTE_CONTENT = {'code': 'x = 1\nprint x\n', 'silent': False, 'store_history': True, 'user_expressions': {},
+		    'allow_stdin': True}
+
+_DISPLAY_CONTENT = {'data': {'text/plain': 'x' * 4096, 'text/html': '<pre>' + 'x' * 4096 + '</pre>'},
+		    'metadata': {}}
+
+
+def _serialize_deserialize(content, n):
+	session = Session('benchmark-key')
+	parent = session.build_msg_header('execute_request')
+
+	t0 = clock()
+	for i in xrange(n):
+		to_send, msg, msg_id = session.build_multipart('display_data', content, parent)
+	serialize_time = clock() - t0
+
+	# Deserializing decodes the header up front; touching the content decodes the rest
+	frames = to_send[1:]
+	t0 = clock()
+	for i in xrange(n):
+		session.deserialize(frames)
+	header_time = clock() - t0
+	t0 = clock()
+	for i in xrange(n):
+		session.deserialize(frames)['content']
+	full_time = clock() - t0
+
+	return {'messages': n, 'message_bytes': sum([len(f)   for f in to_send]),
+		'serialize_per_second': rate(n, serialize_time),
+		'deserialize_header_per_second': rate(n, header_time),
+		'deserialize_full_per_second': rate(n, full_time)}
+
+
+@benchmark('session_small')
+def session_small(scale):
+	'''
+	Serializing, signing, verifying and deserializing small messages, such as requests and status updates
+	'''
+	return _serialize_deserialize(_EXECUTE_CONTENT, scaled(50000, scale))
+
+
+@benchmark('session_display_data')
+def session_display_data(scale):
+	'''
+	Serializing, signing, verifying and deserializing 8KB display_data messages
+	'''
+	return _serialize_deserialize(_DISPLAY_CONTENT, scaled(20000, scale))
@@ -0,0 +1,298 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+
+ARRAY_COMM_TARGET = 'mipy.array'
+
+
+
+def encode_arrays(arrays):
+	'''
+	Encode arrays for sending as binary message buffers
+
+	:param arrays: dictionary mapping name to numpy array
+	:return: a tuple of (descriptors, buffers); descriptors is a JSON serializable list describing the name,
+		dtype and shape of each array, buffers is a list holding the data of each array. Arrays that are
+		already C-contiguous are not copied.
+	'''
+	descriptors = []
+	buffers = []
+	for name, value in sorted(arrays.items()):
+		value = numpy.ascontiguousarray(value)
+		if value.dtype.hasobject  or  value.dtype.fields is not None:
+			raise ValueError, 'Cannot send array {0} of dtype {1}; only simple dtypes are supported'.format(
+				name, value.dtype)
+		descriptors.append({'name': name, 'dtype': value.dtype.str, 'shape': list(value.shape)})
+		buffers.append(value)
+	return descriptors, buffers
+
+
+def _array_from_buffer(buf, dtype, shape):
+	if isinstance(buf, memoryview):
+		# numpy.frombuffer does not accept memoryviews under Python 2; numpy.asarray wraps the memory
+		# as a uint8 array, again without copying
+		arr = numpy.asarray(buf).view(dtype)
+	else:
+		arr = numpy.frombuffer(buf, dtype=dtype)
+	return arr.reshape(shape)
+
+
+def decode_arrays(descriptors, buffers):
+	'''
+	Reconstruct arrays from their descriptors and the buffers that accompanied them
+
+	The arrays share memory with the buffers rather than copying them, so they are read-only; copy an
+	array if you need to modify it.
+
+	:param descriptors: array descriptors, as produced by encode_arrays()
+	:param buffers: the buffers received with the message
+	:return: dictionary mapping name to numpy array
+	'''
+	if len(descriptors) != len(buffers):
+		raise ValueError, 'Received {0} array descriptors with {1} buffers'.format(len(descriptors), len(buffers))
+	arrays = {}
+	for desc, buf in zip(descriptors, buffers):
+		arrays[desc['name']] = _array_from_buffer(buf, numpy.dtype(str(desc['dtype'])), tuple(desc['shape']))
+	return arrays
+
+
+
+
+# Source code of the kernel side of the array channel. Registers a comm target that stores arrays that it
+# receives in the user namespace, and sends arrays from the user namespace on request. Also defines
+# mipy_send_arrays(**arrays) in the user namespace, with which kernel code can push arrays to the front end.
+KERNEL_HELPER_CODE = """
+def __mipy_install_array_comm():
+	import numpy
+	from IPython.core.getipython import get_ipython
+
+	shell = get_ipython()
+	comms = []
+
+	def encode(arrays):
+		descriptors = []
+		buffers = []
+		for name, value in sorted(arrays.items()):
+			value = numpy.ascontiguousarray(value)
+			descriptors.append({'name': name, 'dtype': value.dtype.str, 'shape': list(value.shape)})
+			buffers.append(value)
+		return descriptors, buffers
+
+	def decode(descriptors, buffers):
+		arrays = {}
+		for desc, buf in zip(descriptors, buffers):
+			dtype = numpy.dtype(str(desc['dtype']))
+			if isinstance(buf, memoryview):
+				arr = numpy.asarray(buf).view(dtype)
+			else:
+				arr = numpy.frombuffer(buf, dtype=dtype)
+			arrays[desc['name']] = arr.reshape(tuple(desc['shape']))
+		return arrays
+
+	def send_arrays(comm, arrays, data=None):
+		descriptors, buffers = encode(arrays)
+		comm.send({'op': 'arrays', 'arrays': descriptors, 'data': data}, buffers=buffers)
+
+	def on_open(comm, open_msg):
+		comms.append(comm)
+
+		def on_msg(msg):
+			data = msg['content']['data']
+			op = data.get('op')
+			try:
+				if op == 'set':
+					shell.user_ns.update(decode(data['arrays'], msg['buffers']))
+				elif op == 'get':
+					names = data['names']
+					missing = [name   for name in names   if name not in shell.user_ns]
+					if len(missing) > 0:
+						raise NameError('Arrays not defined: {0}'.format(', '.join(missing)))
+					send_arrays(comm, dict([(name, shell.user_ns[name])   for name in names]), data.get('data'))
+				else:
+					raise ValueError('Unknown array comm operation {0}'.format(op))
+			except Exception as e:
+				comm.send({'op': 'error', 'message': '{0}: {1}'.format(type(e).__name__, e)})
+
+		def on_close(msg):
+			comms.remove(comm)
+
+		comm.on_msg(on_msg)
+		comm.on_close(on_close)
+
+	def mipy_send_arrays(**arrays):
+		for comm in comms:
+			send_arrays(comm, arrays)
+
+	shell.kernel.comm_manager.register_target('""" + ARRAY_COMM_TARGET + """', on_open)
+	shell.user_ns['mipy_send_arrays'] = mipy_send_arrays
+
+__mipy_install_array_comm()
+del __mipy_install_array_comm
+"""
+
+
+
+def install_kernel_helper(connection, listener=None):
+	'''
+	Install the kernel side of the array channel by executing KERNEL_HELPER_CODE in the kernel
+
+	:param connection: a KernelConnection
+	:param listener: None, or a KernelRequestListener that will receive the events of the execute request
+	:return: message ID of the execute request
+	'''
+	return connection.execute_request(KERNEL_HELPER_CODE, store_history=False, listener=listener)
+
+
+def open_array_comm(connection, listener=None):
+	'''
+	Open an array channel to a kernel in which the helper has been installed (see install_kernel_helper)
+
+	:param connection: a KernelConnection
+	:param listener: None, or a KernelRequestListener
+	:return: an ArrayComm
+	'''
+	return ArrayComm(connection.open_comm(ARRAY_COMM_TARGET, listener=listener))
+
+
+
+
+class ArrayComm (object):
+	'''
+	    An array channel layered on a Comm
+
+	    Arrays are sent as a JSON description of their names, dtypes and shapes, accompanied by their raw data
+	    as binary message buffers, avoiding the cost of encoding their contents as JSON.
+
+	    Callback attributes:
+	    on_arrays: arrays received from the kernel; f(array_comm, arrays, data, kernel_request_listener) where
+	    	arrays is a dictionary mapping name to (read-only) numpy array
+	    on_error: the kernel could not handle a request; f(array_comm, message, kernel_request_listener)
+	    '''
+
+	def __init__(self, comm):
+		'''
+		Array comm constructor
+
+		:param comm: the Comm to layer the array channel on; it is attached to via its on_binary_message callback
+		'''
+		if numpy is None:
+			raise ImportError, 'numpy is not available'
+		self.comm = comm
+		self.on_arrays = None
+		self.on_error = None
+		comm.on_binary_message = self.__on_binary_message
+
+
+	def send_arrays(self, arrays, listener=None):
+		'''
+		Send arrays to the kernel; the kernel side helper stores them in the user namespace
+
+		Arrays that are C-contiguous are sent without being copied, so they must not be modified until the
+		message has been sent.
+
+		:param arrays: dictionary mapping name to numpy array
+		:param listener: None, or a KernelRequestListener
+		'''
+		descriptors, buffers = encode_arrays(arrays)
+		self.comm.send({'op': 'set', 'arrays': descriptors}, listener=listener, buffers=buffers)
+
+
+	def request_arrays(self, names, data=None, listener=None):
+		'''
+		Request arrays from the user namespace of the kernel; they will be delivered via on_arrays
+
+		:param names: the names of the arrays
+		:param data: extra JSON data that will be passed back to on_arrays
+		:param listener: None, or a KernelRequestListener
+		'''
+		self.comm.send({'op': 'get', 'names': list(names), 'data': data}, listener=listener)
+
+
+	def close(self, listener=None):
+		self.comm.close({}, listener=listener)
+
+
+	def __on_binary_message(self, comm, data, buffers, kernel_request_listener):
+		op = data.get('op')
+		if op == 'arrays':
+			if self.on_arrays is not None:
+				self.on_arrays(self, decode_arrays(data['arrays'], buffers), data.get('data'),
+					       kernel_request_listener)
+		elif op == 'error':
+			if self.on_error is not None:
+				self.on_error(self, data['message'], kernel_request_listener)
+		else:
+			raise ValueError, 'Unknown array comm message {0}'.format(op)
+
+
+
+
+import unittest, os
+
+
+@unittest.skipIf(numpy is None, 'numpy is not available')
+class TestCase_array_comm (unittest.TestCase):
+	def test_010_encode_decode(self):
+		arrays = {'a': numpy.arange(12.0).reshape(3, 4),
+			  'b': numpy.arange(10, dtype='>i2')[::2],
+			  'c': numpy.zeros((0, 3), dtype=numpy.uint8)}
+		descriptors, buffers = encode_arrays(arrays)
+		self.assertIs(arrays['a'], buffers[0])
+		self.assertEqual({'name': 'b', 'dtype': '>i2', 'shape': [5]}, descriptors[1])
+
+		# Received frames are either byte strings or, above the copy threshold, memoryviews
+		received = [memoryview(buffers[0].tostring()), buffers[1].tostring(), buffers[2].tostring()]
+		decoded = decode_arrays(descriptors, received)
+		self.assertEqual(sorted(arrays.keys()), sorted(decoded.keys()))
+		for name in arrays:
+			self.assertEqual(arrays[name].dtype, decoded[name].dtype)
+			self.assertTrue(numpy.array_equal(arrays[name], decoded[name]))
+		self.assertFalse(decoded['a'].flags.owndata)
+
+		self.assertRaises(ValueError, lambda: encode_arrays({'x': numpy.array([object()])}))
+
+
+	def test_020_kernel_round_trip(self):
+		from .kernel import IPythonKernelProcess
+		from .request_listener import EventLogKernelRequestListener
+
+		krn_proc = IPythonKernelProcess(ipython_path=os.environ.get('IPYTHON_PATH', 'ipython'))
+		try:
+			krn_proc.wait_ready()
+			krn = krn_proc.connection
+
+			ev = EventLogKernelRequestListener(lambda prompt: '')
+			install_kernel_helper(krn, listener=ev)
+			while not any([e['event_name'] in ('on_execute_ok', 'on_execute_error')   for e in ev.events]):
+				krn.poll(-1)
+			self.assertIn('on_execute_ok', [e['event_name']   for e in ev.events])
+
+			received = []
+			errors = []
+			array_comm = open_array_comm(krn)
+			array_comm.on_arrays = lambda ac, arrays, data, listener: received.append((arrays, data))
+			array_comm.on_error = lambda ac, message, listener: errors.append(message)
+
+			x = numpy.random.normal(size=(256, 128))
+			array_comm.send_arrays({'x': x})
+			array_comm.request_arrays(['x'], data={'tag': 1})
+			array_comm.request_arrays(['undefined_array'])
+			while len(received) == 0  or  len(errors) == 0:
+				krn.poll(-1)
+
+			arrays, data = received[0]
+			self.assertEqual({'tag': 1}, data)
+			self.assertTrue(numpy.array_equal(x, arrays['x']))
+			self.assertTrue(errors[0].startswith('NameError'))
+		finally:
+			krn_proc.close()
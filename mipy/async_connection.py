@@ -0,0 +1,595 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import select, time, traceback, sys
+
+from .util import ZMQ_SOCKET_FDS_AVAILABLE, zmq_socket_readable
+if ZMQ_SOCKET_FDS_AVAILABLE:
+	from .util import zmq_socket_fd
+from .request_listener import KernelRequestListener, krn_event
+from .kernel import RequestTimeoutError, RequestExpiredError, KernelDeadError
+
+
+
+class InvalidStateError (Exception):
+	pass
+
+class KernelReplyError (Exception):
+	'''
+	Raised by ReplyFuture.result() when the kernel replied with status 'error'
+	'''
+	def __init__(self, ename, evalue, traceback):
+		super(KernelReplyError, self).__init__('{0}: {1}'.format(ename, evalue))
+		self.ename = ename
+		self.evalue = evalue
+		self.traceback = traceback
+
+class KernelRequestAbortedError (Exception):
+	pass
+
+
+
+class ReplyFuture (object):
+	'''
+	The eventual reply to a kernel request
+
+	Modelled on the futures in the standard library; result() does not block, use
+	AsyncKernelConnection.run_until_complete() or run_until_complete() to wait for completion.
+	'''
+	def __init__(self):
+		self.__done = False
+		self.__result = None
+		self.__exception = None
+		self.__callbacks = []
+
+
+	def done(self):
+		return self.__done
+
+	def result(self):
+		if not self.__done:
+			raise InvalidStateError, 'Result is not ready'
+		if self.__exception is not None:
+			raise self.__exception
+		return self.__result
+
+	def exception(self):
+		if not self.__done:
+			raise InvalidStateError, 'Result is not ready'
+		return self.__exception
+
+	def add_done_callback(self, fn):
+		'''
+		Add a callback to be invoked when the future completes
+
+		:param fn: callback: f(future); invoked immediately if the future is already done
+		'''
+		if self.__done:
+			fn(self)
+		else:
+			self.__callbacks.append(fn)
+
+
+	def set_result(self, result):
+		self.__set(result, None)
+
+	def set_exception(self, exception):
+		self.__set(None, exception)
+
+
+	def __set(self, result, exception):
+		if self.__done:
+			raise InvalidStateError, 'Future is already done'
+		self.__result = result
+		self.__exception = exception
+		self.__done = True
+		callbacks = self.__callbacks
+		self.__callbacks = []
+		for fn in callbacks:
+			try:
+				fn(self)
+			except:
+				type, value, tb = sys.exc_info()
+				print 'WARNING: {0}:{1} exception in future done callback'.format(type, value)
+				traceback.print_tb(tb)
+
+
+
+class KernelRequest (object):
+	'''
+	A request sent by an AsyncKernelConnection
+
+	Attributes:
+	msg_id: the message ID of the request
+	reply: a ReplyFuture that completes when the reply arrives on the SHELL socket
+	finished: a ReplyFuture that completes (with the reply) once both the reply and the kernel's idle status
+		for this request have been received; all IOPUB events for the request will have arrived by then
+	events: the IOPUB events received so far, in the form of krn_event dicts
+	'''
+	def __init__(self):
+		self.msg_id = None
+		self.reply = ReplyFuture()
+		self.finished = ReplyFuture()
+		self.events = []
+		self.__event_callbacks = []
+		self.__n_popped = 0
+
+
+	def add_event_callback(self, fn):
+		'''
+		Add a callback to be invoked for each IOPUB event
+
+		:param fn: callback: f(event) where event is a krn_event dict
+		'''
+		self.__event_callbacks.append(fn)
+
+
+	def __iter__(self):
+		'''
+		Iterate over the events that have arrived so far, including any that arrive during the iteration;
+		does not wait for more. Each iterator is independent.
+		'''
+		pos = 0
+		while pos < len(self.events):
+			yield self.events[pos]
+			pos += 1
+
+
+	def pop_events(self):
+		'''
+		:return: a list of the events that have arrived since the last call to pop_events()
+		'''
+		events = self.events[self.__n_popped:]
+		self.__n_popped = len(self.events)
+		return events
+
+
+	def _push_event(self, ev):
+		self.events.append(ev)
+		for fn in self.__event_callbacks:
+			fn(ev)
+
+	def _set_reply(self, result=None, exception=None):
+		if not self.reply.done():
+			if exception is not None:
+				self.reply.set_exception(exception)
+			else:
+				self.reply.set_result(result)
+
+	def _set_finished(self):
+		if self.reply.done()  and  not self.finished.done():
+			exception = self.reply.exception()
+			if exception is not None:
+				self.finished.set_exception(exception)
+			else:
+				self.finished.set_result(self.reply.result())
+
+
+
+class _AsyncRequestListener (KernelRequestListener):
+	def __init__(self, request, comm_manager=None):
+		super(_AsyncRequestListener, self).__init__(comm_manager)
+		self.__request = request
+
+
+	def on_stream(self, stream_name, text):
+		self.__request._push_event(krn_event('on_stream', stream_name=stream_name, text=text))
+
+	def on_display_data(self, data, metadata):
+		self.__request._push_event(krn_event('on_display_data', data=data, metadata=metadata))
+
+	def on_status(self, busy):
+		self.__request._push_event(krn_event('on_status', busy=busy))
+
+	def on_request_finished(self):
+		self.__request._set_finished()
+
+	def on_comm_open(self, comm, data):
+		super(_AsyncRequestListener, self).on_comm_open(comm, data)
+		self.__request._push_event(krn_event('on_comm_open', comm=comm, data=data))
+
+	def on_execute_input(self, execution_count, code):
+		self.__request._push_event(krn_event('on_execute_input', execution_count=execution_count, code=code))
+
+	def on_execute_result(self, execution_count, data, metadata):
+		self.__request._push_event(krn_event('on_execute_result', execution_count=execution_count, data=data, metadata=metadata))
+
+	def on_error(self, ename, evalue, traceback):
+		self.__request._push_event(krn_event('on_error', ename=ename, evalue=evalue, traceback=traceback))
+
+
+	def on_execute_ok(self, execution_count, payload, user_expressions):
+		self.__request._set_reply(dict(execution_count=execution_count, payload=payload, user_expressions=user_expressions))
+
+	def on_execute_error(self, ename, evalue, traceback):
+		self.__request._set_reply(exception=KernelReplyError(ename, evalue, traceback))
+
+	def on_execute_abort(self):
+		self.__request._set_reply(exception=KernelRequestAbortedError())
+
+
+	def on_inspect_ok(self, data, metadata):
+		self.__request._set_reply(dict(data=data, metadata=metadata))
+
+	def on_inspect_error(self, ename, evalue, traceback):
+		self.__request._set_reply(exception=KernelReplyError(ename, evalue, traceback))
+
+
+	def on_complete_ok(self, matches, cursor_start, cursor_end, metadata):
+		self.__request._set_reply(dict(matches=matches, cursor_start=cursor_start, cursor_end=cursor_end, metadata=metadata))
+
+	def on_complete_error(self, ename, evalue, traceback):
+		self.__request._set_reply(exception=KernelReplyError(ename, evalue, traceback))
+
+
+	def on_kernel_dead(self):
+		self.__request._set_reply(exception=KernelDeadError([self.__request.msg_id]))
+		self.__request._set_finished()
+
+	def on_request_expired(self):
+		self.__request._set_reply(exception=RequestExpiredError(self.__request.msg_id))
+		self.__request._set_finished()
+
+
+
+
+class AsyncKernelConnection (object):
+	'''
+	    A front-end for KernelConnection whose requests return KernelRequest objects carrying a future for
+	    the reply and the stream of IOPUB events, rather than invoking listener callbacks.
+
+	    Rather than calling poll(), the connection is driven by socket readiness; file_descriptors() returns
+	    file descriptors that become readable when messages arrive, suitable for select/poll/epoll based
+	    event loops. Call handle_events() when any of them become readable. The module level
+	    run_until_complete() function drives many connections from one select loop.
+
+	    Request methods accept a timeout in seconds; if the request does not complete in time, its futures
+	    raise RequestTimeoutError. If the connection monitors the kernel's heartbeat and the kernel is declared
+	    dead, the futures of every request in flight raise KernelDeadError; the AsyncKernelConnection takes
+	    over the connection's on_kernel_dead callback to do so. The futures of requests that expire under the
+	    connection's request_ttl raise RequestExpiredError.
+
+	    Note that the file descriptors are edge triggered; handle_events() drains every message that is
+	    available so that no edge is missed. Not supported under Jython, as JeroMQ sockets do not expose file
+	    descriptors.
+	    '''
+
+	def __init__(self, connection, comm_manager=None):
+		'''
+		Asynchronous kernel connection constructor
+
+		:param connection: the KernelConnection to drive
+		:param comm_manager: CommManager passed to listeners to handle comms opened by the kernel
+		'''
+		if not ZMQ_SOCKET_FDS_AVAILABLE:
+			raise NotImplementedError, 'AsyncKernelConnection is not supported on Jython; JeroMQ sockets do not ' \
+						   'expose file descriptors'
+		if connection.uses_io_thread:
+			raise ValueError, 'AsyncKernelConnection cannot drive a connection that uses a background I/O thread'
+		self.connection = connection
+		self.__comm_manager = comm_manager
+		# Set when a message has been sent; sending can consume the edge on a ZMQ file descriptor, so the
+		# sockets must be checked before waiting on them again
+		self.__dirty = True
+		# Requests whose replies are delivered to callbacks rather than listeners
+		self.__callback_requests = {}
+		connection.on_kernel_dead = self.__on_kernel_dead
+
+
+	def file_descriptors(self):
+		'''
+		:return: the list of file descriptors that should be watched for readability
+		'''
+		return [zmq_socket_fd(s)   for s in self.connection._poll_sockets()]
+
+
+	def has_pending(self):
+		'''
+		:return: True if messages may be waiting to be handled, in which case handle_events() should be called
+			before waiting on the file descriptors
+		'''
+		if self.__dirty:
+			return True
+		c = self.connection
+		deadline = c._next_deadline()
+		if deadline is not None  and  deadline <= time.time():
+			return True
+		for s in c._poll_sockets():
+			if zmq_socket_readable(s):
+				return True
+		return False
+
+
+	def handle_events(self):
+		'''
+		Handle all messages that are waiting on the sockets
+
+		:return: the number of poll iterations that processed events
+		'''
+		self.__dirty = False
+		n = 0
+		while self.connection.poll(0):
+			n += 1
+		return n
+
+
+	def run_until_complete(self, future, timeout=None):
+		'''
+		Handle events until the future completes
+
+		:param future: a ReplyFuture
+		:param timeout: time in seconds to wait; None to wait indefinitely
+		:return: the result of the future
+		'''
+		return run_until_complete([self], future, timeout)
+
+
+	def __request(self, send, msg_type, timeout):
+		request = KernelRequest()
+		listener = _AsyncRequestListener(request, self.__comm_manager)
+		request.msg_id = send(listener, self.__timeout_handler(request, msg_type, timeout))
+		self.__dirty = True
+		return request
+
+	def __callback_request(self, send, msg_type, timeout):
+		request = KernelRequest()
+		def on_reply(*args):
+			self.__forget_callback_request(request)
+			request._set_reply(args)
+			request._set_finished()
+		request.msg_id = send(on_reply, self.__timeout_handler(request, msg_type, timeout))
+		# Identical requests may be coalesced by the connection, in which case they share a message ID
+		self.__callback_requests.setdefault(request.msg_id, []).append(request)
+		self.__dirty = True
+		return request
+
+	def __timeout_handler(self, request, msg_type, timeout):
+		if timeout is None:
+			return None
+		def on_timeout(msg_id):
+			self.__forget_callback_request(request)
+			request._set_reply(exception=RequestTimeoutError(msg_id, msg_type, timeout))
+			request._set_finished()
+		return on_timeout
+
+	def __on_kernel_dead(self, failed_msg_ids):
+		# Requests with listeners have already been failed through their listeners
+		for msg_id in failed_msg_ids:
+			for request in self.__callback_requests.pop(msg_id, []):
+				request._set_reply(exception=KernelDeadError([msg_id]))
+				request._set_finished()
+
+	def __forget_callback_request(self, request):
+		requests = self.__callback_requests.get(request.msg_id)
+		if requests is not None:
+			requests.remove(request)
+			if len(requests) == 0:
+				del self.__callback_requests[request.msg_id]
+
+
+	def execute(self, code, silent=False, store_history=True, user_expressions=None, allow_stdin=False,
+		    timeout=None):
+		'''
+		Send an execute request; see KernelConnection.execute_request
+
+		The reply is a dict with the keys execution_count, payload and user_expressions. If execution
+		fails, the reply future raises KernelReplyError.
+		:return: a KernelRequest
+		'''
+		return self.__request(lambda listener, on_timeout: self.connection.execute_request(code, silent=silent,
+			store_history=store_history, user_expressions=user_expressions, allow_stdin=allow_stdin,
+			listener=listener, timeout=timeout, on_timeout=on_timeout), 'execute_request', timeout)
+
+	def inspect(self, code, cursor_pos, detail_level=0, timeout=None):
+		'''
+		Send an inspect request; see KernelConnection.inspect_request
+
+		The reply is a dict with the keys data and metadata.
+		:return: a KernelRequest
+		'''
+		return self.__request(lambda listener, on_timeout: self.connection.inspect_request(code, cursor_pos,
+			detail_level=detail_level, listener=listener,
+			timeout=timeout, on_timeout=on_timeout), 'inspect_request', timeout)
+
+	def complete(self, code, cursor_pos, timeout=None):
+		'''
+		Send a complete request; see KernelConnection.complete_request
+
+		The reply is a dict with the keys matches, cursor_start, cursor_end and metadata.
+		:return: a KernelRequest
+		'''
+		return self.__request(lambda listener, on_timeout: self.connection.complete_request(code, cursor_pos,
+			listener=listener, timeout=timeout, on_timeout=on_timeout), 'complete_request', timeout)
+
+	def history_range(self, output=True, raw=False, session=0, start=0, stop=0, timeout=None):
+		'''
+		Send a range history request; the reply is a 1-tuple containing the history list
+		:return: a KernelRequest
+		'''
+		return self.__callback_request(lambda on_reply, on_timeout: self.connection.history_request_range(output=output,
+			raw=raw, session=session, start=start, stop=stop, on_history=on_reply,
+			timeout=timeout, on_timeout=on_timeout), 'history_request', timeout)
+
+	def history_tail(self, output=True, raw=False, n=1, timeout=None):
+		'''
+		Send a tail history request; the reply is a 1-tuple containing the history list
+		:return: a KernelRequest
+		'''
+		return self.__callback_request(lambda on_reply, on_timeout: self.connection.history_request_tail(output=output,
+			raw=raw, n=n, on_history=on_reply,
+			timeout=timeout, on_timeout=on_timeout), 'history_request', timeout)
+
+	def history_search(self, output=True, raw=False, pattern='', unique=False, n=1, timeout=None):
+		'''
+		Send a search history request; the reply is a 1-tuple containing the history list
+		:return: a KernelRequest
+		'''
+		return self.__callback_request(lambda on_reply, on_timeout: self.connection.history_request_search(output=output,
+			raw=raw, pattern=pattern, unique=unique, n=n, on_history=on_reply,
+			timeout=timeout, on_timeout=on_timeout), 'history_request', timeout)
+
+	def kernel_info(self, timeout=None):
+		'''
+		Send a kernel_info request; the reply is a tuple of (protocol_version, implementation,
+		implementation_version, language, language_version, banner)
+		:return: a KernelRequest
+		'''
+		return self.__callback_request(lambda on_reply, on_timeout: self.connection.kernel_info_request(
+			on_kernel_info=on_reply, timeout=timeout, on_timeout=on_timeout), 'kernel_info_request', timeout)
+
+
+
+def run_until_complete(connections, future, timeout=None):
+	'''
+	Drive a number of AsyncKernelConnections from a single select loop until a future completes
+
+	:param connections: a list of AsyncKernelConnection instances
+	:param future: a ReplyFuture
+	:param timeout: time in seconds to wait; None to wait indefinitely
+	:return: the result of the future
+	'''
+	deadline = time.time() + timeout   if timeout is not None   else None
+
+	# Connections replace sockets when they reconnect or replace their heartbeat socket, so the file
+	# descriptors are gathered again whenever that happens
+	stale = [True]
+	def on_socket_replaced(old_socket, new_socket):
+		stale[0] = True
+	for conn in connections:
+		conn.connection._add_socket_observer(on_socket_replaced)
+
+	try:
+		while not future.done():
+			# Drain connections whose file descriptors may not signal again
+			for conn in connections:
+				if conn.has_pending():
+					conn.handle_events()
+			if future.done():
+				break
+
+			if stale[0]:
+				stale[0] = False
+				fd_to_connection, wait = _fd_waiter(connections)
+
+			now = time.time()
+			if deadline is not None:
+				remaining = deadline - now
+				if remaining <= 0.0:
+					raise InvalidStateError, 'Future did not complete within {0}s'.format(timeout)
+			else:
+				remaining = None
+
+			# Wake in time for the earliest request deadline
+			for conn in connections:
+				request_deadline = conn.connection._next_deadline()
+				if request_deadline is not None:
+					request_remaining = max(request_deadline - now, 0.0)
+					remaining = request_remaining   if remaining is None   else min(remaining, request_remaining)
+
+			for fd in wait(remaining):
+				# A connection handled earlier in this batch may have replaced the socket
+				conn = fd_to_connection[fd]
+				if not stale[0]  or  fd in conn.file_descriptors():
+					conn.handle_events()
+	finally:
+		for conn in connections:
+			conn.connection._remove_socket_observer(on_socket_replaced)
+
+	return future.result()
+
+
+def _fd_waiter(connections):
+	'''
+	:return: a tuple of (fd_to_connection, wait) where fd_to_connection maps the file descriptors of the
+		connections to the connections and wait is a function of the form f(timeout) -> list of readable fds
+	'''
+	fd_to_connection = {}
+	for conn in connections:
+		for fd in conn.file_descriptors():
+			fd_to_connection[fd] = conn
+
+	if hasattr(select, 'poll'):
+		poller = select.poll()
+		for fd in fd_to_connection:
+			poller.register(fd, select.POLLIN)
+		def wait(wait_timeout):
+			return [fd   for fd, flags in poller.poll(wait_timeout * 1000.0   if wait_timeout is not None   else None)]
+	else:
+		fds = fd_to_connection.keys()
+		def wait(wait_timeout):
+			return select.select(fds, [], [], wait_timeout)[0]
+	return fd_to_connection, wait
+
+
+
+
+import unittest, os
+from .kernel import IPythonKernelProcess
+
+class TestCase_async_connection (unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		ipython_path = os.environ.get('IPYTHON_PATH', 'ipython')
+
+		cls.krn_proc = IPythonKernelProcess(ipython_path=ipython_path)
+
+		cls.krn_proc.wait_ready()
+
+		cls.krn = AsyncKernelConnection(cls.krn_proc.connection)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.krn = None
+		cls.krn_proc.close()
+
+
+	def test_010_execute(self):
+		req1 = self.krn.execute('print "Hello world"\n')
+		req2 = self.krn.execute('raise ValueError\n')
+
+		reply1 = self.krn.run_until_complete(req1.finished, timeout=30.0)
+		self.assertEqual(1, reply1['execution_count'])
+		self.assertIn(krn_event('on_stream', stream_name='stdout', text='Hello world\n'), list(req1))
+		# Iterators do not consume the events; pop_events() does
+		self.assertEqual(list(req1), list(req1))
+		self.assertEqual(req1.events, req1.pop_events())
+		self.assertEqual([], req1.pop_events())
+
+		self.assertRaises(KernelReplyError, lambda: run_until_complete([self.krn], req2.reply, timeout=30.0))
+
+
+	def test_020_kernel_info(self):
+		req = self.krn.kernel_info()
+
+		info = self.krn.run_until_complete(req.reply, timeout=30.0)
+		self.assertEqual('python', info[3])
+
+
+	def test_030_complete(self):
+		self.krn.run_until_complete(self.krn.execute('complete_test_variable = 1\n').finished, timeout=30.0)
+		req = self.krn.complete('complete_test_var', 17)
+
+		reply = self.krn.run_until_complete(req.finished, timeout=30.0)
+		self.assertIn('complete_test_variable', reply['matches'])
+		self.assertEqual(0, self.krn.connection.n_live_requests)
+
+
+	def test_040_timeout(self):
+		req = self.krn.execute('import time\ntime.sleep(0.5)\n', timeout=0.1)
+		self.assertRaises(RequestTimeoutError, lambda: self.krn.run_until_complete(req.finished, timeout=0.4))
+		self.krn.run_until_complete(self.krn.execute('pass\n').finished, timeout=30.0)
+
+
+	def test_050_reconnect(self):
+		# Reconnect from within the loop; it must go on to wait on the new sockets
+		done = ReplyFuture()
+		def on_kernel_info(future):
+			self.krn.connection.reconnect()
+			self.krn.execute('pass\n').reply.add_done_callback(lambda f: done.set_result(f.result()))
+		self.krn.kernel_info().reply.add_done_callback(on_kernel_info)
+		reply = self.krn.run_until_complete(done, timeout=30.0)
+		self.assertIn('execution_count', reply)
@@ -0,0 +1,250 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+from .request_listener import KernelRequestListener
+
+
+
+STATUS_PENDING = 'pending'
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_ABORTED = 'aborted'
+STATUS_NOT_SENT = 'not_sent'
+STATUS_KERNEL_DEAD = 'kernel_dead'
+STATUS_TIMED_OUT = 'timed_out'
+
+
+
+class BatchCellResult (object):
+	'''
+	The result of executing one cell of a batch
+
+	Attributes:
+	code: the code of the cell
+	msg_id: the message ID of the execute request, or None if the cell was not sent
+	status: one of STATUS_PENDING, STATUS_OK, STATUS_ERROR, STATUS_ABORTED (the kernel discarded the request,
+		usually because an earlier request failed), STATUS_NOT_SENT (the batch stopped first, on an error or a
+		timeout), STATUS_KERNEL_DEAD (the kernel died before replying) or STATUS_TIMED_OUT (no reply within the
+		cell or batch timeout, or the request expired)
+	execution_count: the execution count reported in the reply
+	stdout, stderr: the text written to the standard output and error streams
+	outputs: the outputs in the order in which they arrived, as tuples of ('stream', name, text),
+		('display_data', data, metadata), ('execute_result', data, metadata) or ('error', ename, evalue, traceback)
+	result: the data of the execute_result, or None
+	error: a tuple of (ename, evalue, traceback) if status is STATUS_ERROR, otherwise None
+	payload, user_expressions: from the reply
+	finished: True once the reply and all output for this cell have been received
+	'''
+	def __init__(self, code):
+		self.code = code
+		self.msg_id = None
+		self.status = STATUS_PENDING
+		self.execution_count = None
+		self.stdout = ''
+		self.stderr = ''
+		self.outputs = []
+		self.result = None
+		self.error = None
+		self.payload = None
+		self.user_expressions = None
+		self.finished = False
+
+
+	def __repr__(self):
+		return '<BatchCellResult {0} {1}>'.format(self.status, self.msg_id)
+
+
+
+class _BatchCellListener (KernelRequestListener):
+	def __init__(self, batch, cell):
+		super(_BatchCellListener, self).__init__()
+		self.__batch = batch
+		self.__cell = cell
+
+
+	def on_stream(self, stream_name, text):
+		cell = self.__cell
+		if stream_name == 'stdout':
+			cell.stdout += text
+		elif stream_name == 'stderr':
+			cell.stderr += text
+		cell.outputs.append(('stream', stream_name, text))
+
+	def on_display_data(self, data, metadata):
+		self.__cell.outputs.append(('display_data', data, metadata))
+
+	def on_execute_result(self, execution_count, data, metadata):
+		self.__cell.result = data
+		self.__cell.outputs.append(('execute_result', data, metadata))
+
+	def on_error(self, ename, evalue, traceback):
+		self.__cell.outputs.append(('error', ename, evalue, traceback))
+
+	def on_request_finished(self):
+		self.__cell.finished = True
+		self.__batch._on_cell_finished(self.__cell)
+
+	def on_kernel_dead(self):
+		self.__batch._on_kernel_dead(self.__cell)
+
+	def on_request_expired(self):
+		self.__batch._on_cell_timeout(self.__cell)
+
+	def timed_out(self, msg_id):
+		self.__batch._on_cell_timeout(self.__cell)
+
+
+	def on_execute_ok(self, execution_count, payload, user_expressions):
+		cell = self.__cell
+		cell.status = STATUS_OK
+		cell.execution_count = execution_count
+		cell.payload = payload
+		cell.user_expressions = user_expressions
+		self.__on_reply()
+
+	def on_execute_error(self, ename, evalue, traceback):
+		cell = self.__cell
+		cell.status = STATUS_ERROR
+		cell.error = (ename, evalue, traceback)
+		self.__on_reply()
+
+	def on_execute_abort(self):
+		self.__cell.status = STATUS_ABORTED
+		self.__on_reply()
+
+
+	def __on_reply(self):
+		self.__batch._on_cell_reply(self.__cell)
+
+
+
+class ExecuteBatch (object):
+	'''
+	    Pipelined execution of a sequence of cells
+
+	    Up to `window` execute requests are kept in flight on the SHELL socket, so that the kernel has the next
+	    cell queued as soon as it finishes the current one, rather than waiting a round trip for the client to
+	    send it. A further cell is sent whenever a reply arrives.
+
+	    The batch makes progress as its connection is polled; KernelConnection.execute_batch() creates a batch
+	    and polls until it is finished or its timeout expires. If a cell is not finished within the cell
+	    timeout, or time_out() is called, the unfinished cells are marked STATUS_TIMED_OUT and no further
+	    cells are sent.
+
+	    Note that after a cell fails, IPython kernels abort the requests already queued behind it; the cells in
+	    flight at that time will have status STATUS_ABORTED.
+	    '''
+
+	def __init__(self, connection, cells, window=4, stop_on_error=False, silent=False, store_history=True,
+		     user_expressions=None, cell_timeout=None):
+		'''
+		Execute batch constructor; sends the first window of cells
+
+		:param connection: the KernelConnection on which to execute the cells
+		:param cells: sequence of code strings
+		:param window: the maximum number of execute requests in flight at once
+		:param stop_on_error: if True, cells that have not yet been sent when a cell fails are not sent
+		:param silent: passed to each execute request
+		:param store_history: passed to each execute request
+		:param user_expressions: passed to each execute request
+		:param cell_timeout: None, or the time in seconds from sending a cell within which it must finish
+		'''
+		if window < 1:
+			raise ValueError, 'window must be at least 1'
+		self.__connection = connection
+		self.__window = window
+		self.__stop_on_error = stop_on_error
+		self.__silent = silent
+		self.__store_history = store_history
+		self.__user_expressions = user_expressions
+		self.__cell_timeout = cell_timeout
+
+		self.results = [BatchCellResult(code)   for code in cells]
+		self.__next = 0
+		self.__in_flight = 0
+		self.__stopped = False
+		self.__n_finished = 0
+
+		self.__send_more()
+
+
+	@property
+	def finished(self):
+		return self.__n_finished == len(self.results)
+
+	@property
+	def n_in_flight(self):
+		return self.__in_flight
+
+
+	def _on_cell_reply(self, cell):
+		self.__in_flight -= 1
+		if cell.status == STATUS_ERROR  and  self.__stop_on_error:
+			self.__stop()
+		self.__send_more()
+
+	def _on_cell_finished(self, cell):
+		self.__n_finished += 1
+
+	def _on_kernel_dead(self, cell):
+		if cell.status == STATUS_PENDING:
+			cell.status = STATUS_KERNEL_DEAD
+			self.__in_flight -= 1
+		cell.finished = True
+		self.__n_finished += 1
+		if not self.__stopped:
+			self.__stop()
+
+	def _on_cell_timeout(self, cell):
+		# The connection has already detached the cell's listener
+		if cell.status == STATUS_PENDING:
+			cell.status = STATUS_TIMED_OUT
+			self.__in_flight -= 1
+		cell.finished = True
+		self.__n_finished += 1
+		if not self.__stopped:
+			self.__stop()
+
+
+	def time_out(self):
+		'''
+		Give up on the batch: cancel the requests of the cells that have not finished, marking those that have
+		not been replied to STATUS_TIMED_OUT, and do not send the rest
+		'''
+		if not self.__stopped:
+			self.__stop()
+		for cell in self.results:
+			if not cell.finished:
+				self.__connection.cancel_request(cell.msg_id)
+				if cell.status == STATUS_PENDING:
+					cell.status = STATUS_TIMED_OUT
+				cell.finished = True
+				self.__n_finished += 1
+		self.__in_flight = 0
+
+
+	def __send_more(self):
+		while not self.__stopped  and  self.__next < len(self.results)  and  self.__in_flight < self.__window:
+			cell = self.results[self.__next]
+			self.__next += 1
+			listener = _BatchCellListener(self, cell)
+			cell.msg_id = self.__connection.execute_request(cell.code, silent=self.__silent,
+									store_history=self.__store_history,
+									user_expressions=self.__user_expressions,
+									allow_stdin=False, listener=listener,
+									timeout=self.__cell_timeout,
+									on_timeout=listener.timed_out)
+			self.__in_flight += 1
+
+
+	def __stop(self):
+		self.__stopped = True
+		for cell in self.results[self.__next:]:
+			cell.status = STATUS_NOT_SENT
+			cell.finished = True
+			self.__n_finished += 1
+		self.__next = len(self.results)
@@ -0,0 +1,205 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import json, re
+
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+try:
+	import simplejson
+	# simplejson is only worth using when its C speedups are available
+	if not simplejson._speedups:
+		simplejson = None
+except (ImportError, AttributeError):
+	simplejson = None
+
+
+
+_COMPACT_SEPARATORS = (',', ':')
+
+# ujson escapes all non-ASCII text, so any byte outside ASCII in its output is an invalid byte string that it
+# has passed through verbatim
+_NON_ASCII = re.compile('[\x80-\xff]')
+
+
+
+class JSONCodec (object):
+	'''
+	JSON codec using the standard library json module
+
+	A codec has a dumps(x) method that encodes message data to a string and a loads(s) method
+	that decodes it. Output is compact (no whitespace after separators) and ASCII only.
+	'''
+	name = 'json'
+
+	def __init__(self):
+		# Re-use the encoder; json.dumps builds a new encoder on every call unless default options are used
+		self.__encoder = json.JSONEncoder(separators=_COMPACT_SEPARATORS)
+		self.__decoder = json.JSONDecoder()
+
+	def dumps(self, x):
+		return self.__encoder.encode(x)
+
+	def loads(self, s):
+		return self.__decoder.decode(s)
+
+
+
+class SimpleJSONCodec (object):
+	'''
+	JSON codec using simplejson with its C speedups
+	'''
+	name = 'simplejson'
+
+	def __init__(self):
+		if simplejson is None:
+			raise ImportError, 'simplejson (with C speedups) is not available'
+		self.__encoder = simplejson.JSONEncoder(separators=_COMPACT_SEPARATORS)
+		self.__decoder = simplejson.JSONDecoder()
+
+	def dumps(self, x):
+		return self.__encoder.encode(x)
+
+	def loads(self, s):
+		return self.__decoder.decode(s)
+
+
+
+class UJSONCodec (object):
+	'''
+	JSON codec using ujson
+
+	Values that ujson cannot handle (e.g. integers that do not fit in 64 bits) are passed to the
+	standard library codec, as are byte strings that are not valid UTF-8, which ujson would otherwise copy
+	into its output unchecked; the standard library codec rejects them.
+	'''
+	name = 'ujson'
+
+	def __init__(self):
+		if ujson is None:
+			raise ImportError, 'ujson is not available'
+		self.__fallback = JSONCodec()
+
+	def dumps(self, x):
+		try:
+			s = ujson.dumps(x, escape_forward_slashes=False)
+		except (OverflowError, TypeError):
+			return self.__fallback.dumps(x)
+		if _NON_ASCII.search(s) is not None:
+			return self.__fallback.dumps(x)
+		return s
+
+	def loads(self, s):
+		try:
+			return ujson.loads(s)
+		except (OverflowError, ValueError):
+			# Let the standard library codec either decode the value or raise a meaningful error
+			return self.__fallback.loads(s)
+
+
+
+def available_codecs():
+	'''
+	:return: a list of the codec classes whose backends are installed, fastest first
+	'''
+	codecs = []
+	if ujson is not None:
+		codecs.append(UJSONCodec)
+	if simplejson is not None:
+		codecs.append(SimpleJSONCodec)
+	codecs.append(JSONCodec)
+	return codecs
+
+
+def default_codec():
+	'''
+	:return: an instance of the fastest available codec
+	'''
+	return available_codecs()[0]()
+
+
+
+
+def _benchmark_messages():
+	import base64, uuid, datetime
+	def header(msg_type):
+		return {'msg_id': str(uuid.uuid4()), 'msg_type': msg_type, 'username': 'user',
+			'session': str(uuid.uuid4()), 'date': datetime.datetime.now().isoformat(), 'version': '5.0'}
+
+	execute_request = header('execute_request')
+	png = base64.b64encode(''.join([chr(i % 256)   for i in xrange(24 * 1024)]))
+	return [
+		('execute_request', [header('execute_request'), {}, {},
+			{'code': 'for i in range(10):\n    print i\n', 'silent': False, 'store_history': True,
+			 'user_expressions': {}, 'allow_stdin': True}]),
+		('stream', [header('stream'), execute_request, {}, {'name': 'stdout', 'text': 'line of output\n' * 4}]),
+		('display_data', [header('display_data'), execute_request, {},
+			{'data': {'text/plain': '<matplotlib.figure.Figure at 0x10>', 'image/png': png},
+			 'metadata': {'image/png': {'width': 640, 'height': 480}}}]),
+		('execute_reply', [header('execute_reply'), execute_request, {'started': '2014-01-01T00:00:00'},
+			{'status': 'ok', 'execution_count': 12, 'payload': [], 'user_expressions': {}}]),
+	]
+
+
+def test_codec_speed(n_iterations=2000):
+	'''
+	Micro-benchmark comparing the available codecs, encoding and decoding the four parts (header, parent header,
+	metadata, content) of some realistic messages
+	'''
+	import time
+	messages = _benchmark_messages()
+	for codec_cls in available_codecs():
+		codec = codec_cls()
+		for msg_name, parts in messages:
+			t1 = time.time()
+			for i in xrange(n_iterations):
+				encoded = [codec.dumps(p)   for p in parts]
+			t2 = time.time()
+			for i in xrange(n_iterations):
+				decoded = [codec.loads(p)   for p in encoded]
+			t3 = time.time()
+			print '{0:>10} {1:>16}: {2:8.2f}us dumps, {3:8.2f}us loads, {4} bytes'.format(
+				codec.name, msg_name, (t2 - t1) * 1.0e6 / n_iterations, (t3 - t2) * 1.0e6 / n_iterations,
+				sum([len(p)   for p in encoded]))
+
+
+
+
+import unittest
+
+class TestCase_codec (unittest.TestCase):
+	def test_round_trip(self):
+		values = [{'a': [1, 2.5, None, True, False], 'b': {'c': 'd'}}, [], {}, 'x', 0, -1, 2 ** 70,
+			  u'caf\xe9 \u2603', {u'\u2603': [u'\xe9']}, 'http://example.com/a/b']
+		for codec_cls in available_codecs():
+			codec = codec_cls()
+			for value in values:
+				self.assertEqual(value, codec.loads(codec.dumps(value)), codec.name)
+			# UTF-8 byte strings decode as unicode
+			self.assertEqual({u'k\xe9': u'caf\xe9'}, codec.loads(codec.dumps({'k\xc3\xa9': 'caf\xc3\xa9'})), codec.name)
+
+
+	def test_compact_ascii_output(self):
+		for codec_cls in available_codecs():
+			codec = codec_cls()
+			self.assertEqual('{"a":[1,2]}', codec.dumps({'a': [1, 2]}), codec.name)
+			self.assertEqual('"caf\\u00e9"', codec.dumps(u'caf\xe9'), codec.name)
+			self.assertEqual('"caf\\u00e9"', codec.dumps('caf\xc3\xa9'), codec.name)
+			self.assertEqual('"a/b"', codec.dumps('a/b'), codec.name)
+
+
+	def test_invalid_bytes(self):
+		# Every codec rejects byte strings that are not valid UTF-8, rather than emitting invalid JSON
+		for codec_cls in available_codecs():
+			codec = codec_cls()
+			for value in ['\xff\xfe', {'\xff': 1}, ['x', 'caf\xe9']]:
+				self.assertRaises(UnicodeDecodeError, lambda: codec.dumps(value))
+			self.assertRaises(ValueError, lambda: codec.loads('"\xff"'))
+			self.assertRaises(ValueError, lambda: codec.loads('[1,]'))
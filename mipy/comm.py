@@ -6,6 +6,15 @@
 ##-*************************
 
 class Comm(object):
+	'''
+	    A comm; a channel for custom messages between the front end and an object in the kernel
+
+	    Callback attributes:
+	    on_message: 'comm_msg' received; f(comm, data, kernel_request_listener)
+	    on_binary_message: if set, used in place of on_message, so that binary buffers can be received;
+	    	f(comm, data, buffers, kernel_request_listener)
+	    on_closed_remotely: 'comm_close' received; f(comm, data, kernel_request_listener)
+	    '''
 	def __init__(self, kernel_connection, comm_id, target_name, primary):
 		self.__kernel = kernel_connection
 		self.comm_id = comm_id
@@ -13,33 +22,52 @@ class Comm(object):
 		self.primary = primary
 
 		self.on_message = None
+		self.on_binary_message = None
 		self.on_closed_remotely = None
 
 
-	def send(self, data, listener=None):
+	def send(self, data, listener=None, buffers=None, timeout=None, on_timeout=None):
+		'''
+		Send a message to the other end of the comm
+
+		:param data: JSON data
+		:param listener: None, or a KernelRequestListener
+		:param buffers: None, or a list of binary buffers (byte strings or objects supporting the buffer
+			interface, e.g. memoryviews or numpy arrays). Buffers are not copied, so they must not be modified
+			until the message has been sent.
+		:param timeout: None, or the time in seconds within which the kernel must finish handling the message
+		:param on_timeout: None, or callback: f(msg_id) invoked if it does not
+		'''
 		kernel = self.__kernel
 		if kernel._open:
-			msg, msg_id = kernel.session.send(kernel.shell, 'comm_msg', {
+			kernel._send_comm_msg('comm_msg', {
 				'comm_id': self.comm_id,
 				'data': data
-			})
-			if listener is not None:
-				kernel._attach_listener(msg_id, listener)
-
-	def close(self, data, listener=None):
+			}, buffers, listener, timeout, on_timeout)
+
+	def close(self, data, listener=None, buffers=None, timeout=None, on_timeout=None):
+		'''
+		Close the comm
+
+		:param data: JSON data
+		:param listener: None, or a KernelRequestListener
+		:param buffers: None, or a list of binary buffers
+		:param timeout: None, or the time in seconds within which the kernel must finish handling the message
+		:param on_timeout: None, or callback: f(msg_id) invoked if it does not
+		'''
 		kernel = self.__kernel
 		if kernel._open:
-			msg, msg_id = kernel.session.send(kernel.shell, 'comm_close', {
+			kernel._send_comm_msg('comm_close', {
 				'comm_id': self.comm_id,
 				'data': data
-			})
+			}, buffers, listener, timeout, on_timeout)
 			kernel._notify_comm_closed(self)
-			if listener is not None:
-				kernel._attach_listener(msg_id, listener)
 
 
-	def _handle_message(self, data, kernel_request_listener):
-		if self.on_message is not None:
+	def _handle_message(self, data, buffers, kernel_request_listener):
+		if self.on_binary_message is not None:
+			self.on_binary_message(self, data, buffers, kernel_request_listener)
+		elif self.on_message is not None:
 			self.on_message(self, data, kernel_request_listener)
 
 	def _handle_closed_remotely(self, data, kernel_request_listener):
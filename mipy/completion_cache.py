@@ -0,0 +1,420 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import re, collections
+
+from .request_listener import KernelRequestListener
+
+
+
+# Characters that continue the token being completed; typing any other character (e.g. '.' or '(') changes
+# what is being completed, so earlier matches cannot be reused
+_IDENTIFIER_CHARS = re.compile(r'^\w*$', re.UNICODE)
+_NAME_BEFORE = re.compile(r'[\w.]*$', re.UNICODE)
+_NAME_AFTER = re.compile(r'^\w*', re.UNICODE)
+
+
+
+def name_at(code, cursor_pos):
+	'''
+	:return: the dotted name that the cursor is on, e.g. 'os.path.join' for 'os.path.jo|in(a)'
+	'''
+	before = _NAME_BEFORE.search(code[:cursor_pos]).group(0)
+	after = _NAME_AFTER.match(code[cursor_pos:]).group(0)
+	return before + after
+
+
+
+class _CompleteResult (object):
+	__slots__ = ('code', 'cursor_pos', 'matches', 'cursor_start', 'cursor_end', 'metadata')
+
+	def __init__(self, code, cursor_pos, matches, cursor_start, cursor_end, metadata):
+		self.code = code
+		self.cursor_pos = cursor_pos
+		self.matches = matches
+		self.cursor_start = cursor_start
+		self.cursor_end = cursor_end
+		self.metadata = metadata
+
+
+	def narrow(self, code, cursor_pos):
+		'''
+		Derive the result for a cursor position further along the same token
+
+		:return: a tuple of (matches, cursor_start, cursor_end, metadata), or None if this result does not
+			apply to the given code and cursor position
+		'''
+		pos = self.cursor_pos
+		if cursor_pos <= pos  or  self.cursor_end != pos:
+			return None
+		if code[:pos] != self.code[:pos]  or  code[cursor_pos:] != self.code[pos:]:
+			return None
+		if not _IDENTIFIER_CHARS.match(code[pos:cursor_pos]):
+			return None
+		prefix = code[self.cursor_start:cursor_pos]
+		matches = [m   for m in self.matches   if m.startswith(prefix)]
+		metadata = self.metadata
+		types = metadata.get('_jupyter_types_experimental')
+		if types is not None:
+			metadata = dict(metadata)
+			metadata['_jupyter_types_experimental'] = [t   for t in types   if t.get('text', '').startswith(prefix)]
+		return matches, self.cursor_start, cursor_pos, metadata
+
+
+
+class _PendingRequest (KernelRequestListener):
+	'''
+	A request in flight on behalf of one or more callers; forwards its events to their listeners
+	'''
+	def __init__(self, cache, key, generation):
+		super(_PendingRequest, self).__init__()
+		self.cache = cache
+		self.key = key
+		self.generation = generation
+		self.msg_id = None
+		self.listeners = []
+
+
+	def on_complete_ok(self, matches, cursor_start, cursor_end, metadata):
+		self.cache._store(self, (matches, cursor_start, cursor_end, metadata))
+		for listener in self.listeners:
+			listener.on_complete_ok(matches, cursor_start, cursor_end, metadata)
+
+	def on_complete_error(self, ename, evalue, traceback):
+		for listener in self.listeners:
+			listener.on_complete_error(ename, evalue, traceback)
+
+	def on_inspect_ok(self, data, metadata):
+		self.cache._store(self, (data, metadata))
+		for listener in self.listeners:
+			listener.on_inspect_ok(data, metadata)
+
+	def on_inspect_error(self, ename, evalue, traceback):
+		for listener in self.listeners:
+			listener.on_inspect_error(ename, evalue, traceback)
+
+	def on_kernel_dead(self):
+		self.cache._forget(self)
+		for listener in self.listeners:
+			listener.on_kernel_dead()
+
+	def on_request_expired(self):
+		self.cache._forget(self)
+		for listener in self.listeners:
+			listener.on_request_expired()
+
+	def on_request_finished(self):
+		self.cache._forget(self)
+		for listener in self.listeners:
+			listener.on_request_finished()
+
+
+
+class CompletionCache (object):
+	'''
+	    A caching layer over KernelConnection.complete_request and inspect_request, for editors that request
+	    completions as the user types
+
+	    Completions are cached by code and cursor position. A request for a cursor position further along the
+	    token of a cached completion, with the code around it unchanged, is answered by filtering the cached
+	    matches instead of asking the kernel. A new completion request cancels the one in flight, if it is for
+	    a different position; the kernel still answers it, but the reply is dropped unread and its listener
+	    receives no further events. Inspections are cached by the dotted name at the cursor and detail level.
+	    Identical requests made while one is in flight share it.
+
+	    Cached results are discarded whenever an execute_reply received by the connection reports a new
+	    execution count, since executing code may change what names exist; results of requests sent before
+	    then are delivered but not cached. Code executed by other front ends is not noticed.
+
+	    Results served from the cache are delivered to the listener before complete() or inspect() returns,
+	    followed by on_request_finished.
+	    '''
+
+	def __init__(self, connection, max_entries=256):
+		'''
+		Completion cache constructor
+
+		:param connection: the KernelConnection
+		:param max_entries: the most completion results and the most inspection results kept; the least
+			recently used are discarded first
+		'''
+		self.__connection = connection
+		self.__max_entries = max_entries
+		self.__completions = collections.OrderedDict()
+		self.__inspections = collections.OrderedDict()
+		self.__pending = {}
+		self.__pending_completion = None
+		self.__generation = 0
+		self.__execution_count = None
+		connection._add_execute_reply_observer(self.__on_execute_reply)
+
+		self.n_hits = 0
+		self.n_prefix_hits = 0
+		self.n_misses = 0
+		self.n_joined = 0
+		self.n_cancelled = 0
+		self.n_invalidations = 0
+
+
+	def stats(self):
+		'''
+		:return: a dictionary of counters: hits, prefix_hits, misses, joined, cancelled and invalidations
+		'''
+		return {'hits': self.n_hits, 'prefix_hits': self.n_prefix_hits, 'misses': self.n_misses,
+			'joined': self.n_joined, 'cancelled': self.n_cancelled, 'invalidations': self.n_invalidations}
+
+
+	def close(self):
+		'''
+		Stop observing the connection and discard the cached results
+		'''
+		self.__connection._remove_execute_reply_observer(self.__on_execute_reply)
+		self.invalidate()
+
+
+	def invalidate(self):
+		'''
+		Discard the cached results; requests in flight complete, but their results are not cached
+		'''
+		self.__completions.clear()
+		self.__inspections.clear()
+		self.__generation += 1
+		self.n_invalidations += 1
+
+
+	def complete(self, code, cursor_pos, listener=None, timeout=None):
+		'''
+		Request completions, from the cache if possible
+
+		:param code: the code to complete
+		:param cursor_pos: the position of the cursor where completion is requested
+		:param listener: None, or a KernelRequestListener
+		:param timeout: None, or the time in seconds within which a request sent to the kernel must complete
+		:return: the message ID of the request sent to the kernel, or None if no request was sent
+		'''
+		key = ('complete', code, cursor_pos)
+		result = self.__completions.get(key)
+		if result is not None:
+			self.__completions[key] = self.__completions.pop(key)
+			self.n_hits += 1
+			self.__deliver_completion(listener, result.matches, result.cursor_start, result.cursor_end,
+						  result.metadata)
+			return None
+
+		for result in reversed(self.__completions.values()):
+			narrowed = result.narrow(code, cursor_pos)
+			if narrowed is not None:
+				self.n_prefix_hits += 1
+				self.__deliver_completion(listener, *narrowed)
+				return None
+
+		pending = self.__pending_completion
+		if pending is not None  and  pending.key != key:
+			self.__cancel(pending)
+		return self.__request(key, listener, lambda request: self.__connection.complete_request(
+			code, cursor_pos, listener=request, timeout=timeout))
+
+
+	def inspect(self, code, cursor_pos, detail_level=0, listener=None, timeout=None):
+		'''
+		Request information about the object at the cursor, from the cache if possible
+
+		:param code: the code
+		:param cursor_pos: the position of the cursor
+		:param detail_level: the level of detail requested
+		:param listener: None, or a KernelRequestListener
+		:param timeout: None, or the time in seconds within which a request sent to the kernel must complete
+		:return: the message ID of the request sent to the kernel, or None if no request was sent
+		'''
+		name = name_at(code, cursor_pos)
+		key = ('inspect', name, detail_level)   if name != ''   else ('inspect', code, cursor_pos, detail_level)
+		result = self.__inspections.get(key)
+		if result is not None:
+			self.__inspections[key] = self.__inspections.pop(key)
+			self.n_hits += 1
+			if listener is not None:
+				listener.on_inspect_ok(*result)
+				listener.on_request_finished()
+			return None
+		return self.__request(key, listener, lambda request: self.__connection.inspect_request(
+			code, cursor_pos, detail_level, listener=request, timeout=timeout))
+
+
+	def __request(self, key, listener, send):
+		pending = self.__pending.get(key)
+		if pending is not None  and  pending.generation == self.__generation:
+			self.n_joined += 1
+		else:
+			self.n_misses += 1
+			pending = _PendingRequest(self, key, self.__generation)
+			self.__pending[key] = pending
+			pending.msg_id = send(pending)
+		if listener is not None:
+			pending.listeners.append(listener)
+		if key[0] == 'complete':
+			self.__pending_completion = pending
+		return pending.msg_id
+
+
+	def __cancel(self, pending):
+		self.n_cancelled += 1
+		self.__forget_pending(pending)
+		self.__connection.cancel_request(pending.msg_id)
+
+
+	def __deliver_completion(self, listener, matches, cursor_start, cursor_end, metadata):
+		if listener is not None:
+			listener.on_complete_ok(matches, cursor_start, cursor_end, metadata)
+			listener.on_request_finished()
+
+
+	def __forget_pending(self, pending):
+		if self.__pending.get(pending.key) is pending:
+			del self.__pending[pending.key]
+		if self.__pending_completion is pending:
+			self.__pending_completion = None
+
+
+	def __on_execute_reply(self, parent_msg_id, execution_count):
+		if execution_count != self.__execution_count:
+			self.__execution_count = execution_count
+			self.invalidate()
+
+
+	def _store(self, pending, result):
+		if pending.generation != self.__generation:
+			return
+		key = pending.key
+		if key[0] == 'complete':
+			cache = self.__completions
+			result = _CompleteResult(key[1], key[2], *result)
+		else:
+			cache = self.__inspections
+		cache[key] = result
+		if len(cache) > self.__max_entries:
+			cache.popitem(last=False)
+
+
+	def _forget(self, pending):
+		self.__forget_pending(pending)
+
+
+
+
+import unittest
+
+class TestCase_completion_cache (unittest.TestCase):
+	class _Listener (KernelRequestListener):
+		def __init__(self):
+			super(TestCase_completion_cache._Listener, self).__init__()
+			self.events = []
+
+		def on_complete_ok(self, matches, cursor_start, cursor_end, metadata):
+			self.events.append(('complete', matches, cursor_start, cursor_end))
+
+		def on_inspect_ok(self, data, metadata):
+			self.events.append(('inspect', data))
+
+		def on_request_finished(self):
+			self.events.append(('finished',))
+
+
+	class _FakeConnection (object):
+		def __init__(self):
+			self.sent = []
+			self.cancelled = []
+			self.observers = []
+
+		def _add_execute_reply_observer(self, observer):
+			self.observers.append(observer)
+
+		def _remove_execute_reply_observer(self, observer):
+			self.observers.remove(observer)
+
+		def complete_request(self, code, cursor_pos, listener=None, timeout=None):
+			self.sent.append(('complete', code, cursor_pos, listener))
+			return 'msg-{0}'.format(len(self.sent))
+
+		def inspect_request(self, code, cursor_pos, detail_level=0, listener=None, timeout=None):
+			self.sent.append(('inspect', code, cursor_pos, listener))
+			return 'msg-{0}'.format(len(self.sent))
+
+		def cancel_request(self, msg_id):
+			self.cancelled.append(msg_id)
+
+		def reply(self, index, *result):
+			request = self.sent[index][3]
+			if self.sent[index][0] == 'complete':
+				request.on_complete_ok(*result)
+			else:
+				request.on_inspect_ok(*result)
+			request.on_request_finished()
+
+
+	def test_name_at(self):
+		self.assertEqual('os.path.jo', name_at('x = os.path.jo(a)', 14))
+		self.assertEqual('os.path.join', name_at('x = os.path.join(a)', 12))
+		self.assertEqual('', name_at('x = (', 5))
+
+
+	def test_complete(self):
+		connection = self._FakeConnection()
+		cache = CompletionCache(connection)
+
+		a = self._Listener()
+		self.assertEqual('msg-1', cache.complete('import o', 8, listener=a))
+		# Typing on before the reply arrives supersedes the first request
+		b = self._Listener()
+		self.assertEqual('msg-2', cache.complete('import os', 9, listener=b))
+		self.assertEqual(['msg-1'], connection.cancelled)
+		# Identical requests share the one in flight
+		c = self._Listener()
+		self.assertEqual('msg-2', cache.complete('import os', 9, listener=c))
+		connection.reply(1, ['os', 'ossaudiodev'], 7, 9, {})
+		self.assertEqual([('complete', ['os', 'ossaudiodev'], 7, 9), ('finished',)], b.events)
+		self.assertEqual(b.events, c.events)
+		self.assertEqual([], a.events)
+
+		# Exact hit
+		d = self._Listener()
+		self.assertEqual(None, cache.complete('import os', 9, listener=d))
+		self.assertEqual(b.events, d.events)
+		# Extending the token narrows the cached matches
+		e = self._Listener()
+		self.assertEqual(None, cache.complete('import oss', 10, listener=e))
+		self.assertEqual([('complete', ['ossaudiodev'], 7, 10), ('finished',)], e.events)
+		# Starting a new token needs the kernel; nothing is in flight to cancel
+		self.assertEqual('msg-3', cache.complete('import os.', 10))
+		self.assertEqual(['msg-1'], connection.cancelled)
+
+		self.assertEqual({'hits': 1, 'prefix_hits': 1, 'misses': 3, 'joined': 1, 'cancelled': 1,
+				  'invalidations': 0}, cache.stats())
+
+
+	def test_inspect_and_invalidate(self):
+		connection = self._FakeConnection()
+		cache = CompletionCache(connection)
+
+		self.assertEqual('msg-1', cache.inspect('os.path.join(', 9))
+		connection.reply(0, {'text/plain': 'join'}, {})
+		a = self._Listener()
+		# Same name, different code and cursor
+		self.assertEqual(None, cache.inspect('x = os.path.join', 14, listener=a))
+		self.assertEqual([('inspect', {'text/plain': 'join'}), ('finished',)], a.events)
+
+		# A request in flight when code is executed is answered but not cached
+		self.assertEqual('msg-2', cache.complete('x', 1))
+		connection.observers[0]('msg-0', 1)
+		connection.reply(1, ['x'], 0, 1, {})
+		self.assertEqual('msg-3', cache.inspect('os.path.join', 3))
+		self.assertEqual('msg-4', cache.complete('x', 1))
+		# The same execution count does not invalidate again
+		connection.observers[0]('msg-0', 1)
+		self.assertEqual(1, cache.stats()['invalidations'])
+
+		cache.close()
+		self.assertEqual([], connection.observers)
@@ -0,0 +1,222 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import time, traceback, sys
+
+from .util import *
+
+
+
+STATE_UNKNOWN = 'unknown'
+STATE_ALIVE = 'alive'
+STATE_DEAD = 'dead'
+
+
+
+class HeartbeatMonitor (object):
+	'''
+	    Monitors the liveness of a kernel through its heartbeat channel
+
+	    A ping is sent on a REQ socket every `interval` seconds, and the kernel echoes it back. A ping that has
+	    not been answered by the time the next one is due counts as a miss; once `max_misses` consecutive pings
+	    are missed the kernel is declared dead. A REQ socket cannot send again until it has received a reply,
+	    so after a miss the socket is closed and replaced (the 'lazy pirate' pattern); the owner is notified
+	    so that it can poll the new socket.
+
+	    The monitor is driven by its owner: handle_read() must be called when the socket becomes readable, and
+	    the timers passed to the constructor must be run. Pinging continues after the kernel is declared dead;
+	    if it answers again, its state returns to STATE_ALIVE.
+	    '''
+
+	def __init__(self, ctx, address, timers, interval=1.0, max_misses=3, on_dead=None, on_socket_replaced=None):
+		'''
+		Heartbeat monitor constructor; sends the first ping
+
+		:param ctx: the ZeroMQ context in which to create the socket
+		:param address: the address of the kernel's heartbeat socket, e.g. tcp://127.0.0.1:5678
+		:param timers: a TimerQueue used to schedule pings
+		:param interval: the time in seconds between pings
+		:param max_misses: the number of consecutive unanswered pings after which the kernel is declared dead
+		:param on_dead: None, or a function of the form f() invoked when the kernel is declared dead
+		:param on_socket_replaced: None, or a function of the form f(old_socket, new_socket) invoked after a miss,
+			before the old socket is closed
+		'''
+		if max_misses < 1:
+			raise ValueError, 'max_misses must be at least 1'
+		self.__ctx = ctx
+		self.__address = address
+		self.__timers = timers
+		self.__interval = interval
+		self.__max_misses = max_misses
+		self.__on_dead = on_dead
+		self.__on_socket_replaced = on_socket_replaced
+
+		self.state = STATE_UNKNOWN
+		self.n_misses = 0
+		self.n_pings = 0
+		self.n_replies = 0
+		self.last_rtt = None
+		self.min_rtt = None
+		self.max_rtt = None
+		self.__total_rtt = 0.0
+
+		self.__ping = None
+		self.__ping_sent_at = None
+		self.__timer = None
+		self.socket = self.__create_socket()
+		self.__send_ping()
+
+
+	@property
+	def mean_rtt(self):
+		'''
+		The mean round trip time in seconds of the pings answered so far, or None
+		'''
+		return self.__total_rtt / self.n_replies   if self.n_replies > 0   else None
+
+
+	def stats(self):
+		'''
+		:return: a dictionary of counters: state, pings, replies, misses, last_rtt, min_rtt, max_rtt and mean_rtt
+		'''
+		return {'state': self.state, 'pings': self.n_pings, 'replies': self.n_replies, 'misses': self.n_misses,
+			'last_rtt': self.last_rtt, 'min_rtt': self.min_rtt, 'max_rtt': self.max_rtt,
+			'mean_rtt': self.mean_rtt}
+
+
+	def handle_read(self):
+		'''
+		Receive the reply waiting on the socket
+		'''
+		frames = zmq_recv_multipart(self.socket)
+		if self.__ping is not None  and  bytes(frames[0]) == self.__ping:
+			rtt = self.__timers.clock() - self.__ping_sent_at
+			self.__ping = None
+			self.last_rtt = rtt
+			self.min_rtt = rtt   if self.min_rtt is None   else min(self.min_rtt, rtt)
+			self.max_rtt = rtt   if self.max_rtt is None   else max(self.max_rtt, rtt)
+			self.__total_rtt += rtt
+			self.n_replies += 1
+			self.n_misses = 0
+			self.state = STATE_ALIVE
+
+
+	def close(self):
+		if self.__timer is not None:
+			self.__timer.cancel()
+			self.__timer = None
+		self.socket.close()
+
+
+	def __create_socket(self):
+		socket = self.__ctx.socket(ZMQ.REQ)
+		# Never hold up closing the context with a ping that a dead kernel will not receive
+		zmq_set_linger(socket, 0)
+		socket.connect(self.__address)
+		return socket
+
+
+	def __send_ping(self):
+		self.n_pings += 1
+		self.__ping = str_to_bytes('ping-{0}'.format(self.n_pings))
+		self.__ping_sent_at = self.__timers.clock()
+		zmq_send_multipart(self.socket, [self.__ping])
+		self.__timer = self.__timers.add(self.__interval, self.__on_ping_due)
+
+
+	def __on_ping_due(self):
+		self.__timer = None
+		# The reply may be waiting if the socket is not being polled, e.g. in io_thread mode
+		while self.__ping is not None  and  zmq_socket_readable(self.socket):
+			self.handle_read()
+
+		if self.__ping is not None:
+			self.n_misses += 1
+			old_socket = self.socket
+			self.socket = self.__create_socket()
+			if self.__on_socket_replaced is not None:
+				self.__on_socket_replaced(old_socket, self.socket)
+			old_socket.close()
+			if self.n_misses >= self.__max_misses  and  self.state != STATE_DEAD:
+				self.state = STATE_DEAD
+				if self.__on_dead is not None:
+					try:
+						self.__on_dead()
+					except:
+						type, value, tb = sys.exc_info()
+						print 'WARNING: {0}:{1} exception in heartbeat on_dead callback'.format(type, value)
+						traceback.print_tb(tb)
+
+		self.__send_ping()
+
+
+
+
+import unittest
+from .timers import TimerQueue
+
+class TestCase_heartbeat (unittest.TestCase):
+	def test_liveness(self):
+		ctx = ZMQ_new_context(1)
+		echo = ctx.socket(ZMQ.REP)
+		zmq_set_linger(echo, 0)
+		port = echo.bind_to_random_port('tcp://127.0.0.1')
+
+		def echo_ping(monitor):
+			while not zmq_socket_readable(echo):
+				time.sleep(0.001)
+			zmq_send_multipart(echo, zmq_recv_multipart(echo))
+			while not zmq_socket_readable(monitor.socket):
+				time.sleep(0.001)
+			monitor.handle_read()
+
+		now = [0.0]
+		timers = TimerQueue(clock=lambda: now[0])
+		dead = []
+		replaced = []
+		monitor = HeartbeatMonitor(ctx, 'tcp://127.0.0.1:{0}'.format(port), timers, interval=1.0, max_misses=2,
+					   on_dead=lambda: dead.append(now[0]),
+					   on_socket_replaced=lambda old, new: replaced.append((old, new)))
+		try:
+			self.assertEqual(STATE_UNKNOWN, monitor.state)
+			now[0] = 0.25
+			echo_ping(monitor)
+			self.assertEqual(STATE_ALIVE, monitor.state)
+			self.assertEqual(0.25, monitor.last_rtt)
+
+			now[0] = 1.0
+			timers.run_expired()
+			now[0] = 1.5
+			echo_ping(monitor)
+			self.assertEqual((0.25, 0.5), (monitor.min_rtt, monitor.max_rtt))
+
+			# Stop answering
+			for t in [2.0, 3.0, 4.0]:
+				now[0] = t
+				timers.run_expired()
+			self.assertEqual(STATE_DEAD, monitor.state)
+			self.assertEqual([4.0], dead)
+			self.assertEqual(2, len(replaced))
+			self.assertIs(monitor.socket, replaced[-1][1])
+
+			# Each replacement socket sends a fresh ping; answering the latest revives the kernel
+			while True:
+				self.assertTrue(echo.poll(1000))
+				frames = zmq_recv_multipart(echo)
+				zmq_send_multipart(echo, frames)
+				if bytes(frames[0]) == 'ping-5':
+					break
+			while not zmq_socket_readable(monitor.socket):
+				time.sleep(0.001)
+			monitor.handle_read()
+			self.assertEqual(STATE_ALIVE, monitor.state)
+			self.assertEqual({'state': STATE_ALIVE, 'pings': 5, 'replies': 3, 'misses': 0, 'last_rtt': 0.0,
+					  'min_rtt': 0.0, 'max_rtt': 0.5, 'mean_rtt': 0.25}, monitor.stats())
+		finally:
+			monitor.close()
+			echo.close()
+			ctx.term()
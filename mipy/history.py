@@ -0,0 +1,410 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import re, bisect, fnmatch, collections
+
+
+
+# Runs of characters in a glob pattern that must appear literally in a match
+_GLOB_LITERALS = re.compile(r'\[!?\]?[^\]]*\]|[*?]')
+
+_TRIGRAM = 3
+
+
+
+def _trigrams(text):
+	return set(text[i:i+_TRIGRAM]   for i in xrange(len(text) - _TRIGRAM + 1))
+
+
+def glob_literals(pattern):
+	'''
+	:return: the list of literal runs of characters in a glob pattern, e.g. ['import ', 'path'] for
+		'import *path*'
+	'''
+	return [x   for x in _GLOB_LITERALS.split(pattern)   if x != '']
+
+
+
+class HistoryMirror (object):
+	'''
+	    A local copy of the current session's input history, kept up to date and indexed for search
+
+	    sync() fetches the entries that the mirror does not yet have with a range history_request, starting at
+	    the first line that it has not confirmed. The mirror also follows execute_input events, so inputs
+	    appear as soon as the kernel starts executing them, including those sent by other front ends. The
+	    kernel does not store inputs executed with store_history=False, but their execute_input events look
+	    the same; an input from this connection is confirmed or dropped when its execute_reply arrives, while
+	    one from another front end is provisional until the next sync().
+
+	    tail(), range() and search() are answered locally, without a round trip to the kernel. Entries are
+	    (session, line_number, input) tuples, as in a history reply, where session is 0 (the current session).
+	    Substring and glob searches are narrowed with an index of the three character sequences (trigrams)
+	    found in each input, and the candidates checked against the pattern.
+
+	    Call reset() after the kernel restarts, as line numbers start again from 1.
+	    '''
+
+	def __init__(self, connection):
+		'''
+		History mirror constructor
+
+		:param connection: the KernelConnection
+		'''
+		self.__connection = connection
+		self.__inputs = {}
+		self.__lines = []
+		self.__index = collections.defaultdict(set)
+		# Lines known only from execute_input events, mapped to (parent_msg_id, sequence number)
+		self.__provisional = {}
+		self.__n_events = 0
+		# Every line up to and including this one has been received from the kernel or confirmed
+		self.__synced_through = 0
+		self.__sync_msg_id = None
+		self.__sync_callbacks = []
+		connection._add_execute_input_observer(self.__on_execute_input)
+		connection._add_execute_reply_observer(self.__on_execute_reply)
+
+		self.n_syncs = 0
+		self.n_fetched = 0
+		self.n_live_updates = 0
+
+
+	def __len__(self):
+		return len(self.__lines)
+
+
+	def stats(self):
+		'''
+		:return: a dictionary of counters: entries, provisional, syncs, fetched and live_updates
+		'''
+		return {'entries': len(self.__lines), 'provisional': len(self.__provisional), 'syncs': self.n_syncs,
+			'fetched': self.n_fetched, 'live_updates': self.n_live_updates}
+
+
+	def close(self):
+		'''
+		Stop following the connection
+		'''
+		self.__connection._remove_execute_input_observer(self.__on_execute_input)
+		self.__connection._remove_execute_reply_observer(self.__on_execute_reply)
+
+
+	def reset(self):
+		'''
+		Discard the mirrored history, e.g. after the kernel has restarted; call sync() to fetch it again
+
+		The reply to a sync in flight is ignored; its on_synced callbacks are invoked when the next sync
+		completes.
+		'''
+		for line in list(self.__lines):
+			self.__remove(line)
+		self.__provisional.clear()
+		self.__synced_through = 0
+		self.__sync_msg_id = None
+
+
+	def sync(self, on_synced=None, timeout=None, on_timeout=None):
+		'''
+		Fetch the entries that the mirror has not yet received from the kernel
+
+		If a sync is already in flight, no request is sent and on_synced is invoked when it completes.
+
+		:param on_synced: None, or callback: f(n_fetched) invoked once the entries have been received
+		:param timeout: None, or the time in seconds within which the kernel must reply
+		:param on_timeout: None, or callback: f(msg_id) invoked if the kernel does not reply in time; the sync
+			is abandoned, and its on_synced callbacks dropped, whether or not one is given
+		:return: the message ID of the history request
+		'''
+		if on_synced is not None:
+			self.__sync_callbacks.append(on_synced)
+		if self.__sync_msg_id is None:
+			start = self.__synced_through + 1
+			events_before = self.__n_events
+			def on_history(history):
+				self.__on_sync_reply(msg_id, start, events_before, history)
+			def on_sync_timeout(msg_id):
+				if self.__sync_msg_id == msg_id:
+					self.__sync_msg_id = None
+					del self.__sync_callbacks[:]
+				if on_timeout is not None:
+					on_timeout(msg_id)
+			msg_id = self.__connection.history_request_range(output=False, raw=True, session=0, start=start,
+									stop=0, on_history=on_history, timeout=timeout,
+									on_timeout=on_sync_timeout)
+			self.__sync_msg_id = msg_id
+			self.n_syncs += 1
+		return self.__sync_msg_id
+
+
+	def get(self, line):
+		'''
+		:return: the input at the given line number, or None
+		'''
+		return self.__inputs.get(line)
+
+
+	def tail(self, n=10):
+		'''
+		:return: the last n entries
+		'''
+		return [self.__entry(line)   for line in self.__lines[-n:]]   if n > 0   else []
+
+
+	def range(self, start=1, stop=None):
+		'''
+		:param start: the first line number
+		:param stop: None for the last, or the line number after the last
+		:return: the entries in the given range of line numbers
+		'''
+		lines = self.__lines
+		i = bisect.bisect_left(lines, start)
+		j = bisect.bisect_left(lines, stop)   if stop is not None   else len(lines)
+		return [self.__entry(line)   for line in lines[i:j]]
+
+
+	def search(self, pattern='*', n=None, unique=False):
+		'''
+		Find the inputs that match a glob pattern, as a history_request search would
+
+		:param pattern: glob pattern that must match the whole input; e.g. '*import*' finds inputs containing
+			'import'
+		:param n: None, or the most entries returned; the most recent are kept
+		:param unique: if True, only the most recent of identical inputs is returned
+		:return: the matching entries, oldest first
+		'''
+		regex = re.compile(fnmatch.translate(pattern), re.DOTALL)
+		literals = [x   for x in glob_literals(pattern)   if len(x) >= _TRIGRAM]
+		if len(literals) > 0:
+			index = self.__index
+			trigrams = set.union(*[_trigrams(x)   for x in literals])
+			if not all(trigram in index   for trigram in trigrams):
+				return []
+			# Intersect the smallest sets first
+			postings = sorted([index[trigram]   for trigram in trigrams], key=len)
+			candidates = set(postings[0])
+			for lines in postings[1:]:
+				candidates &= lines
+				if len(candidates) == 0:
+					return []
+			candidates = sorted(candidates)
+		else:
+			candidates = self.__lines
+
+		inputs = self.__inputs
+		matches = []
+		seen = set()
+		for line in reversed(candidates):
+			code = inputs[line]
+			if regex.match(code) is not None:
+				if unique:
+					if code in seen:
+						continue
+					seen.add(code)
+				matches.append(line)
+				if n is not None  and  len(matches) >= n:
+					break
+		return [self.__entry(line)   for line in reversed(matches)]
+
+
+	def find(self, text, n=None, unique=False):
+		'''
+		Find the inputs that contain the given text
+
+		:param text: the text to look for
+		:param n: None, or the most entries returned; the most recent are kept
+		:param unique: if True, only the most recent of identical inputs is returned
+		:return: the matching entries, oldest first
+		'''
+		escaped = ''.join('[{0}]'.format(c)   if c in '*?['   else c   for c in text)
+		return self.search('*' + escaped + '*', n=n, unique=unique)
+
+
+	def __entry(self, line):
+		return (0, line, self.__inputs[line])
+
+
+	def __put(self, line, code):
+		previous = self.__inputs.get(line)
+		if previous == code:
+			return
+		if previous is not None:
+			self.__remove(line)
+		self.__inputs[line] = code
+		bisect.insort(self.__lines, line)
+		for trigram in _trigrams(code):
+			self.__index[trigram].add(line)
+
+
+	def __remove(self, line):
+		code = self.__inputs.pop(line)
+		del self.__lines[bisect.bisect_left(self.__lines, line)]
+		index = self.__index
+		for trigram in _trigrams(code):
+			lines = index[trigram]
+			lines.discard(line)
+			if len(lines) == 0:
+				del index[trigram]
+
+
+	def __confirm(self, line):
+		self.__provisional.pop(line, None)
+		self.__advance()
+
+
+	def __advance(self):
+		synced = self.__synced_through
+		while synced + 1 in self.__inputs  and  synced + 1 not in self.__provisional:
+			synced += 1
+		self.__synced_through = synced
+
+
+	def __on_execute_input(self, parent_msg_id, execution_count, code):
+		self.__n_events += 1
+		if execution_count <= self.__synced_through:
+			# Already received from the kernel, or an input that is not stored in the history
+			return
+		self.__put(execution_count, code)
+		self.__provisional[execution_count] = (parent_msg_id, self.__n_events)
+		self.n_live_updates += 1
+
+
+	def __on_execute_reply(self, parent_msg_id, execution_count):
+		for line, (msg_id, seq) in self.__provisional.items():
+			if msg_id == parent_msg_id:
+				if line == execution_count:
+					self.__confirm(line)
+				else:
+					# The kernel did not store the input, so did not advance the execution count
+					del self.__provisional[line]
+					self.__remove(line)
+				break
+
+
+	def __on_sync_reply(self, msg_id, start, events_before, history):
+		if self.__sync_msg_id != msg_id:
+			# Superseded by reset()
+			return
+		self.__sync_msg_id = None
+		end = start
+		for session, line, code in history:
+			self.__put(line, code)
+			self.__provisional.pop(line, None)
+			end = line + 1
+		self.n_fetched += len(history)
+		# Provisional inputs that were executed before the request but are not in the history were not stored;
+		# those executed since may not have been
+		for line, (parent_msg_id, seq) in self.__provisional.items():
+			if line >= end  and  seq <= events_before:
+				del self.__provisional[line]
+				self.__remove(line)
+		self.__synced_through = max(self.__synced_through, end - 1)
+		self.__advance()
+		callbacks = self.__sync_callbacks
+		self.__sync_callbacks = []
+		for on_synced in callbacks:
+			on_synced(len(history))
+
+
+
+
+import unittest
+
+class TestCase_history (unittest.TestCase):
+	class _FakeConnection (object):
+		def __init__(self):
+			self.requests = []
+			self.input_observers = []
+			self.reply_observers = []
+
+		def _add_execute_input_observer(self, observer):
+			self.input_observers.append(observer)
+
+		def _remove_execute_input_observer(self, observer):
+			self.input_observers.remove(observer)
+
+		def _add_execute_reply_observer(self, observer):
+			self.reply_observers.append(observer)
+
+		def _remove_execute_reply_observer(self, observer):
+			self.reply_observers.remove(observer)
+
+		def history_request_range(self, output=True, raw=False, session=0, start=0, stop=0, on_history=None,
+					  timeout=None, on_timeout=None):
+			self.requests.append((start, on_history))
+			return 'hist-{0}'.format(len(self.requests))
+
+		def execute_input(self, msg_id, execution_count, code):
+			for observer in self.input_observers:
+				observer(msg_id, execution_count, code)
+
+		def execute_reply(self, msg_id, execution_count):
+			for observer in self.reply_observers:
+				observer(msg_id, execution_count)
+
+
+	def test_glob_literals(self):
+		self.assertEqual(['import ', 'path'], glob_literals('import *path*'))
+		self.assertEqual(['a', 'bc', 'd'], glob_literals('a?bc[xy]d'))
+		self.assertEqual(['x', 'y'], glob_literals('x[]z]y'))
+
+
+	def test_sync_and_live_updates(self):
+		connection = self._FakeConnection()
+		mirror = HistoryMirror(connection)
+		synced = []
+		self.assertEqual('hist-1', mirror.sync(on_synced=synced.append))
+		# Joins the sync in flight
+		self.assertEqual('hist-1', mirror.sync(on_synced=synced.append))
+		self.assertEqual(1, connection.requests[0][0])
+		connection.requests[0][1]([(0, 1, 'import os'), (0, 2, 'x = 1')])
+		self.assertEqual([2, 2], synced)
+		self.assertEqual([(0, 1, 'import os'), (0, 2, 'x = 1')], mirror.tail(5))
+
+		# Executed by this connection; stored
+		connection.execute_input('ex-1', 3, 'import sys')
+		self.assertEqual((0, 3, 'import sys'), mirror.tail(1)[0])
+		connection.execute_reply('ex-1', 3)
+		# Executed with store_history=False; the execution count does not advance
+		connection.execute_input('ex-2', 4, 'print 1')
+		connection.execute_reply('ex-2', 3)
+		self.assertEqual(None, mirror.get(4))
+		# Executed by another front end; no reply is seen
+		connection.execute_input('other-1', 4, 'y = 2')
+		connection.execute_input('other-2', 5, 'z = 3')
+		self.assertEqual(2, mirror.stats()['provisional'])
+
+		# The sync starts at the first line not confirmed, and drops the inputs that the kernel did not store
+		mirror.sync()
+		self.assertEqual(4, connection.requests[1][0])
+		connection.requests[1][1]([(0, 4, 'y = 2')])
+		self.assertEqual([(0, 3, 'import sys'), (0, 4, 'y = 2')], mirror.range(3))
+		self.assertEqual(0, mirror.stats()['provisional'])
+		mirror.sync()
+		self.assertEqual(5, connection.requests[2][0])
+
+		mirror.reset()
+		self.assertEqual(0, len(mirror))
+		mirror.close()
+		self.assertEqual([], connection.input_observers)
+		self.assertEqual([], connection.reply_observers)
+
+
+	def test_search(self):
+		connection = self._FakeConnection()
+		mirror = HistoryMirror(connection)
+		mirror.sync()
+		connection.requests[0][1]([(0, 1, 'import os'), (0, 2, 'os.path.join(a, b)'), (0, 3, 'import os'),
+					   (0, 4, 'x = [1, 2]\nprint x'), (0, 5, 'import sys')])
+
+		self.assertEqual([(0, 1, 'import os'), (0, 3, 'import os'), (0, 5, 'import sys')], mirror.search('import*'))
+		self.assertEqual([(0, 3, 'import os'), (0, 5, 'import sys')], mirror.search('import*', unique=True))
+		self.assertEqual([(0, 5, 'import sys')], mirror.search('import*', n=1))
+		self.assertEqual([(0, 2, 'os.path.join(a, b)')], mirror.search('*path.j?in*'))
+		self.assertEqual([], mirror.search('*missing*'))
+		self.assertEqual([(0, 4, 'x = [1, 2]\nprint x')], mirror.find('[1, 2]\nprint'))
+		self.assertEqual(5, len(mirror.search()))
+		self.assertEqual(3, len(mirror.find('os')))
@@ -0,0 +1,225 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import time, heapq, itertools
+
+from .util import ZMQReadPoller
+from .timers import limit_poll_timeout
+
+
+
+class KernelHub (object):
+	'''
+	    Services many kernel connections with a single poller
+
+	    Each KernelConnection normally polls its own four sockets; driving many connections that way costs
+	    one poll system call per connection. The hub registers the sockets of all of its connections with
+	    one poller, so that a single call to poll() services every connection, dispatching each message
+	    to the connection that owns the socket on which it arrived.
+
+	    The hub keeps a heap of the earliest timer deadline of each connection, which the connections keep up
+	    to date as they schedule timers, so that a poll only wakes and runs the timers of connections that
+	    are due, rather than visiting every connection. Connections that are closed remove themselves.
+
+	    Connections added to a hub should not be polled individually.
+	    '''
+
+	def __init__(self):
+		self.__poller = ZMQReadPoller()
+		self.__socket_to_connection = {}
+		self.__connections = []
+		self.__observers = {}
+		# Heap of (deadline, counter, connection); an entry is live only while its deadline matches that
+		# recorded for its connection in __scheduled, so superseded entries are discarded as they surface
+		self.__deadlines = []
+		self.__scheduled = {}
+		self.__counter = itertools.count()
+		self.__pending_errors = []
+
+
+	@property
+	def connections(self):
+		return self.__connections[:]
+
+
+	def add(self, connection):
+		'''
+		Add a connection to the hub
+
+		:param connection: a KernelConnection; it must not use a background I/O thread
+		'''
+		if connection.uses_io_thread:
+			raise ValueError, 'Connections that use a background I/O thread cannot be added to a hub'
+		if connection in self.__connections:
+			raise ValueError, 'Connection is already attached to this hub'
+		for socket in connection._poll_sockets():
+			self.__poller.register(socket)
+			self.__socket_to_connection[socket] = connection
+		# Follow the connection when it replaces a socket, e.g. its heartbeat socket
+		socket_observer = lambda old_socket, new_socket: self.__replace_socket(connection, old_socket, new_socket)
+		connection._add_socket_observer(socket_observer)
+		connection._add_deadline_observer(self.__schedule)
+		connection._add_close_observer(self.remove)
+		self.__observers[connection] = socket_observer
+		self.__connections.append(connection)
+		self.__schedule(connection, connection._next_deadline())
+
+
+	def remove(self, connection):
+		'''
+		Remove a connection from the hub
+
+		:param connection: a KernelConnection that was previously added
+		'''
+		self.__connections.remove(connection)
+		connection._remove_socket_observer(self.__observers.pop(connection))
+		connection._remove_deadline_observer(self.__schedule)
+		connection._remove_close_observer(self.remove)
+		self.__scheduled.pop(connection, None)
+		for socket in [s   for s, c in self.__socket_to_connection.items()   if c is connection]:
+			del self.__socket_to_connection[socket]
+			self.__poller.unregister(socket)
+
+
+	def poll(self, timeout=0):
+		'''
+		Poll the sockets of all connections for incoming messages
+
+		:param timeout: The amount of time to wait for a message in milliseconds.
+			-1 = wait indefinitely, 0 = return immediately,
+		:return: a boolean indicating if events were processed
+		'''
+		self.__raise_pending_error()
+
+		# Wake in time for the earliest timer deadline of any connection
+		heap = self.__deadlines
+		while len(heap) > 0  and  self.__scheduled.get(heap[0][2]) != heap[0][0]:
+			heapq.heappop(heap)
+		if len(heap) > 0:
+			timeout = limit_poll_timeout(timeout, heap[0][0], time.time())
+
+		n_events = self.__poller.poll(timeout, self.__on_read_event)
+
+		# Run the timers of the connections that are due
+		now = time.time()
+		due = []
+		while len(heap) > 0  and  heap[0][0] <= now:
+			deadline, _, connection = heapq.heappop(heap)
+			if self.__scheduled.get(connection) == deadline:
+				del self.__scheduled[connection]
+				due.append(connection)
+		for connection in due:
+			try:
+				n_events += connection._run_timers()
+			except Exception, e:
+				# Do not let one connection's error prevent the timers of the others from running
+				self.__pending_errors.append(e)
+			if connection in self.__observers:
+				self.__schedule(connection, connection._next_deadline())
+		self.__raise_pending_error()
+		return n_events > 0
+
+
+	def __schedule(self, connection, deadline):
+		if deadline is not None:
+			scheduled = self.__scheduled.get(connection)
+			if scheduled is None  or  deadline < scheduled:
+				self.__scheduled[connection] = deadline
+				heapq.heappush(self.__deadlines, (deadline, next(self.__counter), connection))
+
+
+	def __raise_pending_error(self):
+		if len(self.__pending_errors) > 0:
+			raise self.__pending_errors.pop(0)
+
+
+	def __replace_socket(self, connection, old_socket, new_socket):
+		del self.__socket_to_connection[old_socket]
+		self.__poller.unregister(old_socket)
+		self.__poller.register(new_socket)
+		self.__socket_to_connection[new_socket] = connection
+
+
+	def __on_read_event(self, socket):
+		self.__socket_to_connection[socket]._handle_socket_read(socket)
+
+
+
+
+import unittest, os, time
+from .kernel import IPythonKernelProcess
+from .request_listener import EventLogKernelRequestListener
+
+class TestCase_hub (unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		ipython_path = os.environ.get('IPYTHON_PATH', 'ipython')
+
+		cls.krn_procs = [IPythonKernelProcess(ipython_path=ipython_path)   for i in xrange(2)]
+
+		for krn_proc in cls.krn_procs:
+			krn_proc.wait_ready()
+
+		cls.hub = KernelHub()
+		for krn_proc in cls.krn_procs:
+			cls.hub.add(krn_proc.connection)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		for krn_proc in cls.krn_procs:
+			krn_proc.close()
+
+
+	def test_010_execute_on_all(self):
+		evs = []
+		for i, krn_proc in enumerate(self.krn_procs):
+			ev = EventLogKernelRequestListener(lambda prompt: '')
+			krn_proc.connection.execute_request('print {0}\n'.format(i), listener=ev)
+			evs.append(ev)
+
+		while any([len(ev.events) < 5   for ev in evs]):
+			self.hub.poll(-1)
+
+		for i, ev in enumerate(evs):
+			streams = [e['text']   for e in ev.events   if e['event_name'] == 'on_stream']
+			self.assertEqual(['{0}\n'.format(i)], streams)
+
+
+	def test_020_remove(self):
+		krn = self.krn_procs[1].connection
+		self.hub.remove(krn)
+		self.assertEqual([self.krn_procs[0].connection], self.hub.connections)
+		self.hub.add(krn)
+		self.assertRaises(ValueError, lambda: self.hub.add(krn))
+
+
+	def test_030_timers_and_close(self):
+		from .stub_kernel import StubKernel
+		stubs = [StubKernel(execute_handler=lambda code: time.sleep(float(code)) or [])   for i in xrange(2)]
+		hub = KernelHub()
+		try:
+			krns = [stub.connect()   for stub in stubs]
+			for krn in krns:
+				hub.add(krn)
+			timed_out = []
+			krns[0].execute_request('0.5', timeout=0.1, on_timeout=timed_out.append)
+			krns[1].execute_request('0.5', timeout=0.3, on_timeout=timed_out.append)
+			t_end = time.time() + 5.0
+			while len(timed_out) < 2  and  time.time() < t_end:
+				hub.poll(-1)
+			self.assertEqual(2, len(timed_out))
+
+			# A closed connection leaves the hub at once
+			krns[0].close()
+			self.assertEqual([krns[1]], hub.connections)
+			krns[1].close()
+			self.assertEqual([], hub.connections)
+			self.assertFalse(hub.poll(0))
+		finally:
+			for stub in stubs:
+				stub.close()
@@ -0,0 +1,193 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import threading, uuid, traceback, sys
+from collections import deque
+from Queue import Queue, Empty, Full
+
+from .util import *
+
+
+
+class KernelIOThread (object):
+	'''
+	    Background I/O thread for a kernel connection
+
+	    The thread takes ownership of a set of ZeroMQ sockets; it receives messages from them, verifies and
+	    decodes them using the session, and passes them to the application through a bounded queue, or to
+	    an executor if one is provided. As ZeroMQ sockets are not thread safe, outgoing messages are
+	    serialized by the calling thread and handed to the I/O thread to be sent.
+
+	    When the queue is full, the I/O thread stops receiving until the application catches up, leaving
+	    further messages in ZeroMQ's own queues.
+	    '''
+
+	def __init__(self, ctx, session, sockets, queue_size=1024, executor=None, dispatch=None):
+		'''
+		I/O thread constructor
+
+		:param ctx: the ZeroMQ context in which the sockets were created
+		:param session: the Session used to verify and decode messages
+		:param sockets: the sockets to receive from; ownership passes to the I/O thread
+		:param queue_size: the maximum number of decoded messages that can be waiting for the application
+		:param executor: None, or an object with a submit(fn, *args) method (e.g. a concurrent.futures
+			executor) on which messages are dispatched; use a single threaded executor to preserve ordering
+		:param dispatch: function of the form f(socket, idents, msg); messages are dispatched by calling it.
+			Required when an executor is given; otherwise messages are dispatched by calling dispatch_pending()
+		'''
+		if executor is not None  and  dispatch is None:
+			raise ValueError, 'A dispatch function is required when using an executor'
+
+		self.__session = session
+		self.__sockets = list(sockets)
+		self.__executor = executor
+		self.__dispatch = dispatch
+
+		self.__queue = Queue(queue_size)
+		self.__outgoing = deque()
+		self.__lock = threading.Lock()
+
+		# Wake-up pipe; lets other threads interrupt the I/O thread's poll when they queue a message to send
+		address = 'inproc://mipy-io-{0}'.format(uuid.uuid4())
+		self.__wake_recv = ctx.socket(ZMQ.PAIR)
+		self.__wake_recv.bind(address)
+		self.__wake_send = ctx.socket(ZMQ.PAIR)
+		self.__wake_send.connect(address)
+		self.__wake_token = str_to_bytes('w')
+		# At most one wake-up token is in flight at a time, so senders never block on the wake-up pipe
+		self.__wake_pending = False
+
+		self.__poller = ZMQReadPoller()
+		for socket in self.__sockets:
+			self.__poller.register(socket)
+		self.__poller.register(self.__wake_recv)
+
+		self.__running = True
+		self.__thread = threading.Thread(target=self.__run, name='mipy-io')
+		self.__thread.daemon = True
+		self.__thread.start()
+
+
+	def send(self, socket, msg_parts, copy=True):
+		'''
+		Queue a serialized message to be sent by the I/O thread
+
+		:param socket: the socket on which the message should be sent
+		:param msg_parts: the message parts
+		:param copy: if False, ZeroMQ sends the parts without copying them
+		'''
+		with self.__lock:
+			self.__outgoing.append((socket, msg_parts, copy))
+			self.__wake()
+
+
+	def get(self, timeout):
+		'''
+		Wait for a received message
+
+		:param timeout: time to wait in milliseconds; -1 to wait indefinitely, 0 to return immediately
+		:return: a tuple of (socket, idents, msg), or None if no message arrived in time
+		'''
+		try:
+			if timeout < 0:
+				# Wait in slices so that the calling thread remains responsive to KeyboardInterrupt
+				while True:
+					try:
+						return self.__queue.get(True, 0.5)
+					except Empty:
+						if not self.__running:
+							return None
+			elif timeout == 0:
+				return self.__queue.get(False)
+			else:
+				return self.__queue.get(True, timeout * 0.001)
+		except Empty:
+			return None
+
+
+	def dispatch_pending(self, timeout, dispatch):
+		'''
+		Dispatch received messages
+
+		Waits up to timeout for the first message, then dispatches any further messages that are
+		already waiting.
+
+		:param timeout: time to wait in milliseconds; -1 to wait indefinitely, 0 to return immediately
+		:param dispatch: function of the form f(socket, idents, msg)
+		:return: the number of messages dispatched
+		'''
+		item = self.get(timeout)
+		n = 0
+		while item is not None:
+			dispatch(*item)
+			n += 1
+			item = self.get(0)
+		return n
+
+
+	def stop(self):
+		'''
+		Stop the I/O thread and wait for it to exit; ownership of the sockets passes back to the caller
+		'''
+		if self.__running:
+			self.__running = False
+			with self.__lock:
+				self.__wake()
+			self.__thread.join()
+			self.__wake_send.close()
+			self.__wake_recv.close()
+
+
+	def __run(self):
+		def _on_read_event(socket):
+			if socket is self.__wake_recv:
+				zmq_recv_multipart(socket)
+				with self.__lock:
+					self.__wake_pending = False
+				self.__flush_outgoing()
+			else:
+				try:
+					idents, msg = self.__session.recv(socket)
+				except:
+					type, value, tb = sys.exc_info()
+					print 'WARNING: {0}:{1} exception while receiving message'.format(type, value)
+					traceback.print_tb(tb)
+					return
+				self.__deliver(socket, idents, msg)
+
+		while self.__running:
+			self.__poller.poll(-1, _on_read_event)
+		self.__flush_outgoing()
+
+
+	def __wake(self):
+		# Call with self.__lock held
+		if not self.__wake_pending:
+			self.__wake_pending = True
+			zmq_send_multipart(self.__wake_send, [self.__wake_token])
+
+
+	def __flush_outgoing(self):
+		while True:
+			with self.__lock:
+				if len(self.__outgoing) == 0:
+					return
+				socket, msg_parts, copy = self.__outgoing.popleft()
+			zmq_send_multipart(socket, msg_parts, copy)
+
+
+	def __deliver(self, socket, idents, msg):
+		if self.__executor is not None:
+			self.__executor.submit(self.__dispatch, socket, idents, msg)
+		else:
+			while self.__running:
+				try:
+					self.__queue.put((socket, idents, msg), True, 0.1)
+					return
+				except Full:
+					# Keep sending while the application catches up
+					self.__flush_outgoing()
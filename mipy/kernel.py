@@ -5,12 +5,20 @@
 ##-* This source code is (C)copyright Geoffrey French 1999-2014.
 ##-*************************
 
-import uuid, datetime, subprocess, tempfile, json, traceback, sys
+import uuid, datetime, subprocess, tempfile, json, traceback, sys, threading, signal, collections, functools
 
 from .util import *
 from .session import Session
 from .comm import Comm, CommManager
 from .request_listener import *
+from .io_thread import KernelIOThread
+from .batch import ExecuteBatch
+from .request_tracker import RequestTracker
+from .timers import TimerQueue
+from .stream_coalescer import StreamCoalescer
+from .output_budget import OutputMeter, SuppressedOutput, BUDGETED_MSG_TYPES
+from .heartbeat import HeartbeatMonitor, STATE_UNKNOWN
+from .tracing import Tracer
 
 
 
@@ -20,6 +28,41 @@ class ConnectionFileNotFoundError (Exception):
 class InvalidConnectionFileError (Exception):
 	pass
 
+class RequestTimeoutError (Exception):
+	'''
+	Raised by KernelConnection.poll() when a request that was given a timeout but no on_timeout callback
+	does not complete in time
+	'''
+	def __init__(self, msg_id, msg_type, timeout):
+		super(RequestTimeoutError, self).__init__('{0} {1} did not complete within {2}s'.format(msg_type, msg_id, timeout))
+		self.msg_id = msg_id
+		self.msg_type = msg_type
+		self.timeout = timeout
+
+class RequestExpiredError (Exception):
+	'''
+	The error given to futures of requests that receive no events within the connection's request_ttl
+	'''
+	def __init__(self, msg_id):
+		super(RequestExpiredError, self).__init__('{0} received no events within the request time to live'.format(msg_id))
+		self.msg_id = msg_id
+
+class KernelDeadError (Exception):
+	'''
+	Raised by KernelConnection.poll() when the heartbeat monitor declares the kernel dead and the connection
+	has no on_kernel_dead callback
+	'''
+	def __init__(self, msg_ids):
+		super(KernelDeadError, self).__init__('Kernel stopped responding to heartbeats; {0} requests failed'.format(
+			len(msg_ids)))
+		self.msg_ids = msg_ids
+
+class KernelStartupError (Exception):
+	'''
+	Raised by IPythonKernelProcess.wait_ready() when the kernel process exits before it answers
+	'''
+	pass
+
 
 
 
@@ -42,11 +85,61 @@ def load_connection_file(kernel_name=None, kernel_path=None):
 		raise ConnectionFileNotFoundError, 'Could not find connection file for kernel {0} at {1}'.format(kernel_name, kernel_path)
 
 
+def write_connection_file(path, connection):
+	'''
+	Write a connection file in one step, so that a process polling for it never reads part of it
+
+	:param path: the path of the connection file
+	:param connection: a dictionary of the ports, ip, transport, key and signature_scheme
+	'''
+	with open(path + '.tmp', 'w') as f:
+		json.dump(connection, f)
+	# os.rename does not replace an existing file on Windows
+	if os.name == 'nt'  and  os.path.exists(path):
+		os.remove(path)
+	os.rename(path + '.tmp', path)
+
+
+def _allocate_tcp_ports(ip, n):
+	'''
+	Find n free TCP ports by binding to port 0 and letting the OS choose; the ports are released again, so
+	another process could take one before the kernel binds to it
+	'''
+	import socket
+	sockets = []
+	try:
+		for i in xrange(n):
+			s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sockets.append(s)
+			s.bind((ip, 0))
+		return [s.getsockname()[1]   for s in sockets]
+	finally:
+		for s in sockets:
+			s.close()
+
+
+def _is_local_transport(transport, address):
+	return transport == 'ipc'  or  address == 'localhost'  or  address.startswith('127.')  or  address == '::1'
+
+
 def _unpack_ident(ident):
 	return [bytes_to_str(x) for x in ident]
 
 
 
+# The most requests whose send times are held at once, for measuring reply latency. Only requests that
+# expect a reply are timed, and a request is forgotten once its reply arrives or it is finished, cancelled
+# or expires, so this is only reached if replies are being lost; the oldest request is then forgotten
+_MAX_TIMED_REQUESTS = 4096
+
+# The most cancelled requests remembered at once; a cancelled request is forgotten once both its reply and the
+# idle status that follows it have arrived (in either order, as they arrive on different sockets), so only
+# requests that never receive both, such as comm messages, accumulate
+_MAX_CANCELLED_REQUESTS = 1024
+_CANCELLED_REPLY_SEEN = 1
+_CANCELLED_IDLE_SEEN = 2
+
+
 def _get_parent_msg_id(msg):
 	return msg['parent_header'].get('msg_id')
 
@@ -54,6 +147,35 @@ def _get_parent_msg_type(msg):
 	return msg['parent_header'].get('msg_type')
 
 
+class _JoinedCall (object):
+	'''
+	A caller that has attached to an identical request already in flight, rather than sending its own
+	'''
+	__slots__ = ('on_reply', 'on_timeout', 'timer')
+
+	def __init__(self, on_reply, on_timeout):
+		self.on_reply = on_reply
+		self.on_timeout = on_timeout
+		self.timer = None
+
+
+def _synchronized(method):
+	'''
+	Decorator for KernelConnection methods that read or modify request state (listeners, deadlines, timers
+	and the like). When messages are dispatched on an executor, the method holds the connection's state lock,
+	so that it cannot interleave with dispatch; e.g. a reply cannot be dispatched before its request has been
+	registered. Otherwise all of this happens on one thread and no lock is taken.
+	'''
+	@functools.wraps(method)
+	def synchronized(self, *args, **kwargs):
+		lock = self._state_lock
+		if lock is None:
+			return method(self, *args, **kwargs)
+		with lock:
+			return method(self, *args, **kwargs)
+	return synchronized
+
+
 def _show_handler_exception(kernel, context):
 	type, value, tb = sys.exc_info()
 	print 'WARNING: {0}:{1} exception during {2}'.format(type, value, context)
@@ -66,6 +188,8 @@ def _show_handler_exception(kernel, context):
 class KernelConnection(object):
 	__ctx = None
 	__ctx_ref_count = 0
+	# Protects the shared context; connections may be created and closed on different threads (e.g. KernelPool)
+	__ctx_lock = threading.Lock()
 
 	'''
 	    An IPython kernel connection
@@ -81,9 +205,38 @@ class KernelConnection(object):
 	    on_status: 'status' message on IOPUB socket; f(busy)
 	    on_execute_input: 'execute_input' message on IOPUB socket; f(execution_count, code)
 	    on_clear_output: 'clear_output' message on IOPUB socket; f(wait)
+	    on_kernel_dead: the heartbeat monitor declared the kernel dead; f(failed_msg_ids)
+
+	    Deadlines
+
+	    Request methods accept a timeout in seconds. A request with a listener must finish (see
+	    KernelRequestListener.on_request_finished) within the timeout, other requests must receive their reply.
+	    A request that does not is abandoned; its listener or reply callback is detached and its on_timeout
+	    callback is invoked, or if none was given, the next call to poll() raises RequestTimeoutError.
+	    Deadlines are kept in a heap, and poll() waits no longer than the time to the earliest of them.
+
+	    Output budgets
+
+	    An OutputBudget limits the output (stream, display_data and execute_result messages) delivered for a
+	    request, or across the whole connection. Messages beyond the budget are dropped before their content
+	    is decoded. A request whose output was suppressed receives a single on_output_suppressed event
+	    summarising what was dropped, just before on_request_finished. A budget can also interrupt the kernel
+	    once it is used up, if the connection was given an interrupt handler.
+
+	    Heartbeat
+
+	    If a heartbeat interval is given, the connection pings the kernel's heartbeat socket and measures the
+	    round trip time. A kernel that misses heartbeat_max_misses consecutive pings is declared dead: every
+	    request in flight fails at once (listeners receive on_kernel_dead, reply callbacks are dropped) and
+	    on_kernel_dead is invoked, or if it is None, the next call to poll() raises KernelDeadError. Kernels
+	    answer heartbeats on a separate thread, so a kernel busy executing code is not declared dead.
 	    '''
 
-	def __init__(self, kernel_name=None, kernel_path=None, username=''):
+	def __init__(self, kernel_name=None, kernel_path=None, username='', io_thread=False, io_queue_size=1024,
+		     io_executor=None, trusted_local_transport=False, request_ttl=None, coalesce_streams=False,
+		     coalesce_max_bytes=65536, coalesce_interval=0.05, output_budget=None, request_output_budget=None,
+		     interrupt_handler=None, heartbeat_interval=None, heartbeat_max_misses=3, metrics=None,
+		     tracer=None):
 		'''
 		IPython kernel connection constructor
 
@@ -92,67 +245,138 @@ class KernelConnection(object):
 		:param kernel_name: kernel name used to identify connection file
 		:param kernel_path: path of connection file
 		:param username: username
+		:param io_thread: if True, a background thread receives, verifies and decodes incoming messages as
+			they arrive, rather than waiting for poll() to be called. poll() then dispatches the decoded
+			messages to listeners on the calling thread.
+		:param io_queue_size: (io_thread mode) the maximum number of decoded messages awaiting dispatch; once
+			reached, the I/O thread stops receiving until poll() catches up
+		:param io_executor: (io_thread mode) None, or an executor with a submit(fn, *args) method; if given,
+			messages are dispatched on the executor instead of by poll(). Use a single threaded executor;
+			listeners will be invoked on its thread. Dispatch and the request methods then serialize on a
+			lock, so requests may be made from any thread; poll() must still be called to run timeouts.
+		:param trusted_local_transport: if True, skip verifying the signatures of incoming messages. Only
+			permitted for ipc or loopback connections, and should only be used with kernels that you launched
+			yourself. Outgoing messages are still signed.
+		:param request_ttl: None, or a time in seconds; requests whose listeners receive no events for this long
+			are expired, so that requests whose reply or idle status never arrives do not accumulate. Their
+			listeners receive on_request_expired. Requests are otherwise discarded once they finish.
+		:param coalesce_streams: if True, consecutive 'stream' messages for the same request and stream are
+			merged into a single on_stream event; text is delivered once coalesce_max_bytes have accumulated,
+			coalesce_interval seconds after the first chunk arrived, or before any other event for the request
+		:param coalesce_max_bytes: (coalesce_streams mode) the amount of text after which it is delivered
+		:param coalesce_interval: (coalesce_streams mode) the longest time in seconds for which text is held
+			back; requires poll() to be called to be honoured
+		:param output_budget: None, or an OutputBudget limiting the output delivered across all requests made on
+			this connection; see reset_output_budget()
+		:param request_output_budget: None, or the OutputBudget applied to each execute request that is not
+			given its own
+		:param interrupt_handler: None, or a function of the form f() that interrupts the kernel; used by
+			interrupt() and by output budgets that interrupt the kernel
+		:param heartbeat_interval: None, or the time in seconds between heartbeat pings; enables monitoring of
+			the kernel's liveness. Requires poll() to be called, so cannot be used with io_executor.
+		:param heartbeat_max_misses: (heartbeat mode) the number of consecutive unanswered pings after which the
+			kernel is declared dead
+		:param metrics: None, or a MetricsRegistry in which to record message counts and sizes, time spent
+			serializing, deserializing and handling messages, and the latency of replies to requests
+		:param tracer: None, or a Tracer on which to record the timeline of each request and the time spent
+			dispatching each incoming message; see mipy.tracing
 		:return:
 		'''
-		# Load the connection file and find out where we have to connect to
-		connection = load_connection_file(kernel_name=kernel_name, kernel_path=kernel_path)
+		if heartbeat_interval is not None  and  io_executor is not None:
+			raise ValueError, 'heartbeat monitoring requires poll() to be called, so cannot be used with io_executor'
 
-		key = connection['key'].encode('utf8')
-		transport = connection['transport']
-		address = connection['ip']
-
-		shell_port = connection['shell_port']
-		iopub_port = connection['iopub_port']
-		stdin_port = connection['stdin_port']
-		control_port = connection['control_port']
+		# Load the connection file and find out where we have to connect to
+		self.__kernel_name = kernel_name
+		self.__kernel_path = kernel_path
+		self.__trusted_local_transport = trusted_local_transport
+		connection = self.__load_connection_file()
 
 		# JeroMQ context
-		cls = type(self)
-		if cls.__ctx is None:
-			cls.__ctx = ZMQ_new_context(1)
-		cls.__ctx_ref_count += 1
+		cls = KernelConnection
+		with cls.__ctx_lock:
+			if cls.__ctx is None:
+				cls.__ctx = ZMQ_new_context(1)
+			cls.__ctx_ref_count += 1
+			self.__ctx = cls.__ctx
 
-		# Create the four IPython sockets; SHELL, IOPUB, STDIN and CONTROL
-		self.shell = self.__ctx.socket(ZMQ.DEALER)
-		self.iopub = self.__ctx.socket(ZMQ.SUB)
-		self.stdin = self.__ctx.socket(ZMQ.DEALER)
-		self.control = self.__ctx.socket(ZMQ.DEALER)
-		# Connect
-		self.shell.connect('{0}://{1}:{2}'.format(transport, address, shell_port))
-		self.iopub.connect('{0}://{1}:{2}'.format(transport, address, iopub_port))
-		self.stdin.connect('{0}://{1}:{2}'.format(transport, address, stdin_port))
-		self.control.connect('{0}://{1}:{2}'.format(transport, address, control_port))
-		# Subscribe IOPUB to everything
-		zmq_subscribe_socket(self.iopub, '')
+		# Create a session for message packing and unpacking
+		self.session = Session(connection['key'].encode('utf8'), username,
+				       verify_signatures=not trusted_local_transport)
 
-		# Create a poller to monitor the four sockets for incoming messages
+		# Create a poller to monitor the sockets for incoming messages
 		self.__poller = ZMQReadPoller()
-		self.__shell_poll_index = self.__poller.register(self.shell)
-		self.__iopub_poll_index = self.__poller.register(self.iopub)
-		self.__stdin_poll_index = self.__poller.register(self.stdin)
-		self.__control_poll_index = self.__poller.register(self.control)
-
-		# Create a session for message packing and unpacking
-		self.session = Session(key, username)
 
 		# Create a message handler for each socket
 		self._shell_handler = MessageRouter(self, 'shell')
 		self._iopub_handler = MessageRouter(self, 'iopub')
-		self._stdin_handler = MessageRouter(self, 'stdio')
+		self._stdin_handler = MessageRouter(self, 'stdin')
 		self._control_handler = MessageRouter(self, 'control')
-
 		self.__socket_handlers = {}
-		self.__socket_handlers[self.shell] = self._shell_handler
-		self.__socket_handlers[self.iopub] = self._iopub_handler
-		self.__socket_handlers[self.stdin] = self._stdin_handler
-		self.__socket_handlers[self.control] = self._control_handler
+
+		# Metrics
+		self.__metrics = metrics
+		self.__request_sent_at = collections.OrderedDict()
+		if metrics is not None:
+			self.session.metrics = metrics
+			for router in [self._shell_handler, self._iopub_handler, self._stdin_handler, self._control_handler]:
+				router.set_metrics(metrics)
+			self.__reply_latency = metrics.histogram('reply_latency_seconds',
+								 'Time from sending a request to receiving its reply',
+								 ('msg_type',))
+			self.__requests_timed_out = metrics.counter('requests_timed_out_total',
+								    'Requests that did not complete within their timeout',
+								    ('msg_type',))
+			self.__requests_coalesced = metrics.counter('requests_coalesced_total',
+								    'Requests joined to an identical request in flight or '
+								    'answered from a cached reply', ('msg_type',))
+
+		# Tracing
+		self.__tracer = tracer
+		if tracer is not None:
+			for router in [self._shell_handler, self._iopub_handler, self._stdin_handler, self._control_handler]:
+				router.set_tracer(tracer)
+
+		self.__n_reconnects = 0
+		self.__open_sockets(connection)
 
 		# Reply handlers
-		self.__request_listeners = {}
+		self.__requests = RequestTracker(ttl=request_ttl)
+		self.__sweep_timer = None
+		self.__deadline_observers = []
+		self.__close_observers = []
+		self.__timers = TimerQueue(on_earliest=self.__on_earliest_deadline)
+		self.__deadlines = {}
+		# Messages that elicit no reply and have no listener; their deadlines are met by their idle status
+		self.__idle_deadlines = set()
+		self.__pending_errors = []
+		if coalesce_streams:
+			self.__stream_coalescer = StreamCoalescer(self.__deliver_stream, self.__timers,
+								  max_bytes=coalesce_max_bytes, interval=coalesce_interval)
+		else:
+			self.__stream_coalescer = None
+		self.__output_meter = OutputMeter(output_budget)   if output_budget is not None   else None
+		self.__request_output_budget = request_output_budget
+		self.__request_output_meters = {}
+		self.__suppressed_output = {}
+		self.__n_suppressed_messages = 0
+		self.__n_suppressed_bytes = 0
+		self.__interrupt_handler = interrupt_handler
 		self.__history_reply_handlers = {}
 		self.__connect_reply_handlers = {}
 		self.__kernel_info_reply_handlers = {}
 		self.__shutdown_reply_handlers = {}
+		self.__cancelled = collections.OrderedDict()
+		self.__execute_reply_observers = []
+		self.__execute_input_observers = []
+		self.__status_observers = []
+		# Single flight coalescing of idempotent requests; maps a request key to the message ID of the
+		# request in flight, and back
+		self.__in_flight = {}
+		self.__in_flight_keys = {}
+		self.__joined_calls = {}
+		# (msg_id, reply) of the most recent kernel_info and connect replies
+		self.__kernel_info = None
+		self.__connect_info = None
 
 		# Comms
 		self.__comm_id_to_comm = {}
@@ -160,33 +384,199 @@ class KernelConnection(object):
 		# Event callbacks
 		self.on_status = None
 		self.on_clear_output = None
+		self.on_kernel_dead = None
 
 		# State
 		self.__busy = False
 		self._open = True
+		# Held by dispatch and by the methods that touch request state when dispatch runs on an executor thread
+		self._state_lock = threading.RLock()   if io_executor is not None   else None
+
+		# Background I/O thread
+		self.__io_executor = io_executor
+		self.__io_queue_size = io_queue_size
+		if io_thread:
+			self.__io_thread = self.__start_io_thread()
+		else:
+			if io_executor is not None:
+				raise ValueError, 'io_executor requires io_thread mode'
+			self.__io_thread = None
+
+		# Heartbeat
+		self.__socket_observers = []
+		self.__heartbeat_interval = heartbeat_interval
+		self.__heartbeat_max_misses = heartbeat_max_misses
+		self.__heartbeat = self.__open_heartbeat(connection)   if heartbeat_interval is not None   else None
+
+
+
+	def __load_connection_file(self):
+		connection = load_connection_file(kernel_name=self.__kernel_name, kernel_path=self.__kernel_path)
+		if self.__trusted_local_transport  and  not _is_local_transport(connection['transport'], connection['ip']):
+			raise ValueError, 'trusted_local_transport requires an ipc or loopback connection, not {0}://{1}'.format(
+				connection['transport'], connection['ip'])
+		return connection
+
+
+	def __open_sockets(self, connection):
+		'''
+		Create the SHELL, IOPUB, STDIN and CONTROL sockets, connect them to the kernel described by the
+		connection file and register them with the poller
+		'''
+		transport = connection['transport']
+		address = connection['ip']
+
+		# Create the four IPython sockets; SHELL, IOPUB, STDIN and CONTROL
+		self.shell = self.__ctx.socket(ZMQ.DEALER)
+		self.iopub = self.__ctx.socket(ZMQ.SUB)
+		self.stdin = self.__ctx.socket(ZMQ.DEALER)
+		self.control = self.__ctx.socket(ZMQ.DEALER)
+		# The kernel sends input requests on STDIN to the identity of the SHELL socket that made the request,
+		# so the SHELL and STDIN sockets must share an identity. The kernel refuses a connection whose identity
+		# is still in use, so sockets created by reconnect() cannot reuse that of the sockets they replace.
+		identity = self.session.session
+		if self.__n_reconnects > 0:
+			identity += '-{0}'.format(self.__n_reconnects)
+		zmq_set_identity(self.shell, identity)
+		zmq_set_identity(self.stdin, identity)
+		# Connect
+		self.shell.connect('{0}://{1}:{2}'.format(transport, address, connection['shell_port']))
+		self.iopub.connect('{0}://{1}:{2}'.format(transport, address, connection['iopub_port']))
+		self.stdin.connect('{0}://{1}:{2}'.format(transport, address, connection['stdin_port']))
+		self.control.connect('{0}://{1}:{2}'.format(transport, address, connection['control_port']))
+		# Subscribe IOPUB to everything
+		zmq_subscribe_socket(self.iopub, '')
+
+		# Sockets replaced by reconnect() are left in the handler map, so that messages received on them
+		# that are still waiting to be dispatched (io_thread mode) can be handled
+		self.__socket_handlers[self.shell] = self._shell_handler
+		self.__socket_handlers[self.iopub] = self._iopub_handler
+		self.__socket_handlers[self.stdin] = self._stdin_handler
+		self.__socket_handlers[self.control] = self._control_handler
+
+		for socket in [self.shell, self.iopub, self.stdin, self.control]:
+			self.__poller.register(socket)
+
+
+	def __open_heartbeat(self, connection):
+		heartbeat = HeartbeatMonitor(self.__ctx, '{0}://{1}:{2}'.format(connection['transport'], connection['ip'],
+										 connection['hb_port']),
+					     self.__timers, interval=self.__heartbeat_interval,
+					     max_misses=self.__heartbeat_max_misses, on_dead=self.__on_kernel_dead,
+					     on_socket_replaced=self.__replace_heartbeat_socket)
+		# In io_thread mode the poller is not used; the monitor collects replies when each ping is due
+		self.__poller.register(heartbeat.socket)
+		return heartbeat
 
 
+	def __start_io_thread(self):
+		io_executor = self.__io_executor
+		return KernelIOThread(self.__ctx, self.session, [self.shell, self.iopub, self.stdin, self.control],
+				      queue_size=self.__io_queue_size, executor=io_executor,
+				      dispatch=self.__dispatch_on_executor   if io_executor is not None   else None)
+
+
+	def __dispatch_on_executor(self, socket, ident, msg):
+		with self._state_lock:
+			# Messages may still be queued on the executor after the connection has been closed
+			if self._open:
+				self._dispatch_msg(socket, ident, msg)
+
 
 	def is_open(self):
 		return self._open
 
 
+	@_synchronized
+	def reconnect(self, on_ready=None, timeout=None, on_timeout=None):
+		'''
+		Re-establish the connection to the kernel, e.g. after it has restarted or the transport has failed
+
+		Re-reads the connection file and replaces the sockets with new ones connected to the addresses that
+		it gives. The session, listeners, reply callbacks, comms and deadlines are kept. The new sockets have
+		a new identity, so replies to requests sent before the reconnect are not received; such requests are
+		left to their timeouts (or request_ttl). The cached kernel_info and connect replies are discarded, and
+		a kernel_info request is then sent to confirm that the kernel is ready.
+
+		Note that the socket attributes (shell, iopub, etc.) refer to new objects afterwards; a KernelHub
+		and run_until_complete() in mipy.async_connection follow the change, but event loops that wait on the
+		file_descriptors() of an AsyncKernelConnection must fetch them again.
+
+		:param on_ready: None, or callback: f(protocol_version, implementation, implementation_version,
+			language, language_version, banner) invoked when the kernel replies to the kernel_info request
+		:param timeout: None, or the time in seconds within which the kernel must reply
+		:param on_timeout: None, or callback: f(msg_id) invoked if the kernel does not reply in time
+		:return: the message ID of the kernel_info request
+		'''
+		if not self._open:
+			raise ValueError, 'Cannot reconnect a closed connection'
+		connection = self.__load_connection_file()
+		# A restarted kernel normally keeps its key, but may have been given a new one
+		self.session.key = connection['key']
+
+		if self.__io_thread is not None:
+			self.__io_thread.stop()
+			if self.__io_executor is None:
+				self.__io_thread.dispatch_pending(0, self._dispatch_msg)
+
+		old_sockets = self._poll_sockets()
+		old_heartbeat = self.__heartbeat
+		self.__n_reconnects += 1
+		self.__open_sockets(connection)
+		if old_heartbeat is not None:
+			self.__heartbeat = self.__open_heartbeat(connection)
+		for old_socket, new_socket in zip(old_sockets, self._poll_sockets()):
+			self.__poller.unregister(old_socket)
+			for observer in self.__socket_observers:
+				observer(old_socket, new_socket)
+		# Anything still queued on the old sockets is addressed to a kernel that may no longer exist
+		for socket in old_sockets[:4]:
+			zmq_set_linger(socket, 0)
+			socket.close()
+		if old_heartbeat is not None:
+			old_heartbeat.close()
+
+		if self.__io_thread is not None:
+			self.__io_thread = self.__start_io_thread()
+
+		# Requests sent before the reconnect will not be answered, so must not be joined, and the kernel may
+		# have been replaced
+		self.__in_flight.clear()
+		self.__in_flight_keys.clear()
+		self.__kernel_info = None
+		self.__connect_info = None
+
+		return self.kernel_info_request(on_kernel_info=on_ready, timeout=timeout, on_timeout=on_timeout,
+						cached=False)
+
+
+	@_synchronized
 	def close(self):
 		'''
 		Shutdown
 		:return: None
 		'''
 		if self._open:
+			if self.__io_thread is not None:
+				self.__io_thread.stop()
+				self.__io_thread = None
+			if self.__stream_coalescer is not None:
+				self.__stream_coalescer.flush_all()
+			if self.__heartbeat is not None:
+				self.__heartbeat.close()
 			self.shell.close()
 			self.iopub.close()
 			self.stdin.close()
 			self.control.close()
-			cls = type(self)
-			cls.__ctx_ref_count -= 1
-			if cls.__ctx_ref_count == 0:
-				cls.__ctx.term()
-				cls.__ctx = None
+			cls = KernelConnection
+			with cls.__ctx_lock:
+				cls.__ctx_ref_count -= 1
+				if cls.__ctx_ref_count == 0:
+					cls.__ctx.term()
+					cls.__ctx = None
 			self._open = False
+			for observer in self.__close_observers[:]:
+				observer(self)
 
 
 	def poll(self, timeout=0):
@@ -199,16 +589,259 @@ class KernelConnection(object):
 		'''
 		n_events = 0
 		if self._open:
-			def _on_read_event(socket):
-				handler = self.__socket_handlers[socket]
-				ident, msg = self.session.recv(socket)
-				ident = _unpack_ident(ident)
-				handler.handle(ident, msg)
+			self.__raise_pending_error()
+			timeout = self.__wait_time(timeout)
+			if self.__io_thread is not None:
+				n_events = self.__io_thread.dispatch_pending(timeout, self._dispatch_msg)
+			else:
+				n_events = self.__poller.poll(timeout, self._handle_socket_read)
+			n_events += self._run_timers()
 
+		return n_events > 0
 
-			n_events = self.__poller.poll(timeout, _on_read_event)
 
-		return n_events > 0
+	@_synchronized
+	def __wait_time(self, timeout):
+		return self.__timers.wait_time(timeout)
+
+
+	@_synchronized
+	def _next_deadline(self):
+		'''
+		:return: the time at which the earliest request deadline expires, or None
+		'''
+		return self.__timers.next_deadline()
+
+
+	@_synchronized
+	def _run_timers(self):
+		'''
+		Expire requests whose deadlines have passed
+
+		:return: the number of requests expired
+		'''
+		n = self.__timers.run_expired()
+		self.__raise_pending_error()
+		return n
+
+
+	def __raise_pending_error(self):
+		if len(self.__pending_errors) > 0:
+			raise self.__pending_errors.pop(0)
+
+
+	@property
+	def uses_io_thread(self):
+		return self.__io_thread is not None
+
+
+	def _poll_sockets(self):
+		'''
+		:return: the sockets that must be polled for incoming messages
+		'''
+		sockets = [self.shell, self.iopub, self.stdin, self.control]
+		if self.__heartbeat is not None:
+			sockets.append(self.__heartbeat.socket)
+		return sockets
+
+
+	def _add_socket_observer(self, observer):
+		'''
+		Register a function to be notified when one of the sockets returned by _poll_sockets() is replaced
+
+		:param observer: function of the form f(old_socket, new_socket)
+		'''
+		self.__socket_observers.append(observer)
+
+	def _remove_socket_observer(self, observer):
+		self.__socket_observers.remove(observer)
+
+
+	def _add_deadline_observer(self, observer):
+		'''
+		Register a function to be notified when a timer is scheduled that is due before any other, so that
+		whoever polls the connection can wake in time to call _run_timers()
+
+		:param observer: function of the form f(connection, deadline)
+		'''
+		self.__deadline_observers.append(observer)
+
+	def _remove_deadline_observer(self, observer):
+		self.__deadline_observers.remove(observer)
+
+	def __on_earliest_deadline(self, deadline):
+		for observer in self.__deadline_observers:
+			observer(self, deadline)
+
+
+	def _add_close_observer(self, observer):
+		'''
+		Register a function to be notified when the connection is closed
+
+		:param observer: function of the form f(connection)
+		'''
+		self.__close_observers.append(observer)
+
+	def _remove_close_observer(self, observer):
+		self.__close_observers.remove(observer)
+
+
+	def _add_execute_reply_observer(self, observer):
+		'''
+		Register a function to be notified of every execute_reply received, whether or not the request has a
+		listener
+
+		:param observer: function of the form f(parent_msg_id, execution_count)
+		'''
+		self.__execute_reply_observers.append(observer)
+
+	def _remove_execute_reply_observer(self, observer):
+		self.__execute_reply_observers.remove(observer)
+
+
+	def _add_execute_input_observer(self, observer):
+		'''
+		Register a function to be notified of every execute_input received, including those resulting from
+		requests made by other front ends
+
+		:param observer: function of the form f(parent_msg_id, execution_count, code)
+		'''
+		self.__execute_input_observers.append(observer)
+
+	def _remove_execute_input_observer(self, observer):
+		self.__execute_input_observers.remove(observer)
+
+
+	def _add_status_observer(self, observer):
+		'''
+		Register a function to be notified of every status message received, including those resulting from
+		cancelled requests and requests made by other front ends
+
+		:param observer: function of the form f(parent_msg_id, busy)
+		'''
+		self.__status_observers.append(observer)
+
+	def _remove_status_observer(self, observer):
+		self.__status_observers.remove(observer)
+
+
+	def _handle_socket_read(self, socket):
+		'''
+		Receive a message from a socket that is ready for reading, and route it to its handler
+		'''
+		heartbeat = self.__heartbeat
+		if heartbeat is not None  and  socket is heartbeat.socket:
+			heartbeat.handle_read()
+		else:
+			ident, msg = self.session.recv(socket)
+			self._dispatch_msg(socket, ident, msg)
+
+
+	def _dispatch_msg(self, socket, ident, msg):
+		msg_type = msg['msg_type']
+		if len(self.__cancelled) > 0:
+			parent_msg_id = _get_parent_msg_id(msg)
+			seen = self.__cancelled.get(parent_msg_id)
+			if seen is not None:
+				if msg_type == 'status':
+					if msg['content']['execution_state'] == 'idle':
+						seen |= _CANCELLED_IDLE_SEEN
+				elif msg_type.endswith('_reply'):
+					seen |= _CANCELLED_REPLY_SEEN
+				if seen == _CANCELLED_REPLY_SEEN | _CANCELLED_IDLE_SEEN:
+					del self.__cancelled[parent_msg_id]
+				else:
+					self.__cancelled[parent_msg_id] = seen
+				if msg_type != 'status':
+					# Dropped before its content is decoded
+					return
+		if self.__tracer is not None:
+			self.__tracer.message_received(_get_parent_msg_id(msg), msg_type)
+		if self.__metrics is not None  and  msg_type.endswith('_reply'):
+			sent = self.__request_sent_at.pop(_get_parent_msg_id(msg), None)
+			if sent is not None:
+				self.__reply_latency.observe(clock() - sent[1], (sent[0],))
+		if msg_type not in BUDGETED_MSG_TYPES  or  self.__admit_output(msg):
+			handler = self.__socket_handlers[socket]
+			coalescer = self.__stream_coalescer
+			if coalescer is not None  and  msg_type != 'stream':
+				# Deliver merged text before any other event for the same request
+				coalescer.flush(_get_parent_msg_id(msg))
+			handler.handle(_unpack_ident(ident), msg)
+
+
+	def __admit_output(self, msg):
+		'''
+		Charge an output message against the request and connection output budgets. Uses the size of the
+		serialized content, so that suppressed messages are never decoded.
+
+		:return: True if the message should be delivered, False if it has been suppressed
+		'''
+		connection_meter = self.__output_meter
+		if connection_meter is not None  and  msg['parent_header'].get('session') != self.session.session:
+			# IOPUB is broadcast to every front end; output resulting from requests made by others is not charged
+			connection_meter = None
+		if connection_meter is None  and  len(self.__request_output_meters) == 0:
+			return True
+
+		parent_msg_id = _get_parent_msg_id(msg)
+		request_meter = self.__request_output_meters.get(parent_msg_id)
+		size = msg.content_size or 0
+		for buf in msg.buffers:
+			size += len(buf)
+
+		meter = None
+		reason = None
+		if request_meter is not None:
+			meter = request_meter
+			reason = request_meter.check(size)
+		if reason is None  and  connection_meter is not None:
+			meter = connection_meter
+			reason = connection_meter.check(size)
+
+		if reason is None:
+			if request_meter is not None:
+				request_meter.charge(size)
+			if connection_meter is not None:
+				connection_meter.charge(size)
+			return True
+
+		self.__n_suppressed_messages += 1
+		self.__n_suppressed_bytes += size
+		if self.__requests.get_listener(parent_msg_id) is not None:
+			suppressed = self.__suppressed_output.get(parent_msg_id)
+			if suppressed is None:
+				suppressed = SuppressedOutput(reason, meter is connection_meter)
+				self.__suppressed_output[parent_msg_id] = suppressed
+			suppressed.add(msg['msg_type'], size)
+		if meter.budget.interrupt  and  not meter.interrupted  and  meter.exhausted is not None:
+			meter.interrupted = True
+			self.interrupt()
+		return False
+
+
+	def _send(self, socket, msg_type, content=None, parent=None, metadata=None, buffers=None):
+		'''
+		Send a message on one of the kernel sockets
+
+		:return: a tuple of (message structure, message ID)
+		'''
+		tracer = self.__tracer
+		t0 = tracer.clock()   if tracer is not None   else None
+		if self.__io_thread is not None:
+			to_send, msg, msg_id = self.session.build_multipart(msg_type, content, parent, metadata,
+									    buffers=buffers)
+			self.__io_thread.send(socket, to_send, copy=not buffers)
+		else:
+			msg, msg_id = self.session.send(socket, msg_type, content, parent, metadata, buffers=buffers)
+		if self.__metrics is not None  and  msg_type.endswith('_request'):
+			# Comm messages and input replies get no reply, so are not timed
+			self.__request_sent_at[msg_id] = (msg_type, clock())
+			if len(self.__request_sent_at) > _MAX_TIMED_REQUESTS:
+				self.__request_sent_at.popitem(last=False)
+		if tracer is not None  and  socket is not self.stdin:
+			tracer.request_sent(msg_id, msg_type, t0, tracer.clock())
+		return msg, msg_id
 
 
 	@property
@@ -216,24 +849,399 @@ class KernelConnection(object):
 		return self.__busy
 
 
-	def _attach_listener(self, source_msg_id, listener):
+	@property
+	def n_live_requests(self):
+		'''
+		The number of requests whose listeners are still awaiting events
+		'''
+		return self.__requests.n_live
+
+	@property
+	def request_stats(self):
+		'''
+		A dictionary of request counters: live, tracked, finished, expired and detached
+		'''
+		return self.__requests.stats()
+
+	@property
+	def metrics(self):
+		'''
+		The MetricsRegistry given to the constructor, or None
+		'''
+		return self.__metrics
+
+	@property
+	def tracer(self):
+		'''
+		The Tracer given to the constructor, or None
+		'''
+		return self.__tracer
+
+
+	@property
+	def kernel_state(self):
+		'''
+		The liveness of the kernel according to the heartbeat monitor; one of the STATE_ constants from
+		mipy.heartbeat. STATE_UNKNOWN if heartbeat monitoring is disabled or the kernel has not yet replied.
+		'''
+		return self.__heartbeat.state   if self.__heartbeat is not None   else STATE_UNKNOWN
+
+	@property
+	def heartbeat_stats(self):
+		'''
+		A dictionary of heartbeat counters and round trip times (see HeartbeatMonitor.stats()), or None if
+		heartbeat monitoring is disabled
+		'''
+		return self.__heartbeat.stats()   if self.__heartbeat is not None   else None
+
+	@property
+	def output_stats(self):
+		'''
+		A dictionary of output budget counters: suppressed_messages and suppressed_bytes
+		'''
+		return {'suppressed_messages': self.__n_suppressed_messages,
+			'suppressed_bytes': self.__n_suppressed_bytes}
+
+
+	@_synchronized
+	def reset_output_budget(self, output_budget=None):
+		'''
+		Restore the connection's output budget to its full allowance
+
+		:param output_budget: None to keep the current budget, or a new OutputBudget to replace it
+		'''
+		if output_budget is None  and  self.__output_meter is not None:
+			output_budget = self.__output_meter.budget
+		self.__output_meter = OutputMeter(output_budget)   if output_budget is not None   else None
+
+
+	def interrupt(self):
+		'''
+		Interrupt the kernel using the interrupt handler given to the constructor
+
+		:return: True if the kernel was interrupted, False if there is no interrupt handler
+		'''
+		if self.__interrupt_handler is None:
+			return False
+		self.__interrupt_handler()
+		return True
+
+
+	@_synchronized
+	def cancel_request(self, msg_id):
+		'''
+		Cancel a request that is in flight, e.g. a completion request superseded by a newer one
+
+		The kernel still handles the request, but its listener or reply callback is detached at once, its
+		deadline is cancelled, and the reply and output that it produces are dropped on arrival, without their
+		content being decoded. Status messages are still delivered to on_status. Cancelling a request that
+		has been coalesced with others (see kernel_info_request) detaches all of their callbacks.
+
+		:param msg_id: the message ID of the request
+		'''
+		self.__discard_listener(msg_id)
+		for reply_handlers in [self.__history_reply_handlers, self.__connect_reply_handlers,
+				       self.__kernel_info_reply_handlers, self.__shutdown_reply_handlers]:
+			reply_handlers.pop(msg_id, None)
+		self.__cancel_deadline(msg_id)
+		self.__end_single_flight(msg_id)
+		self.__request_sent_at.pop(msg_id, None)
+		if self.__tracer is not None:
+			self.__tracer.request_abandoned(msg_id, 'cancelled')
+		self.__cancelled[msg_id] = 0
+		if len(self.__cancelled) > _MAX_CANCELLED_REQUESTS:
+			self.__cancelled.popitem(last=False)
+
+
+	@_synchronized
+	def _supersede_kernel_info_request(self, msg_id, on_kernel_info):
+		'''
+		Withdraw one caller's callback from a kernel_info request that it is about to send again
+
+		Callers that joined the request keep waiting for its reply; identical requests made from now on no
+		longer join it. If no other caller is waiting, the request is cancelled.
+
+		:param msg_id: the message ID of the request
+		:param on_kernel_info: the callback to withdraw
+		'''
+		callbacks = self.__kernel_info_reply_handlers.get(msg_id)
+		if callbacks is not None  and  on_kernel_info in callbacks:
+			callbacks.remove(on_kernel_info)
+		if not callbacks  and  not self.__joined_calls.get(msg_id):
+			self.cancel_request(msg_id)
+		else:
+			self.__stop_joining(msg_id)
+
+
+	@_synchronized
+	def _attach_listener(self, source_msg_id, listener, expects_reply=True):
 		self._detach_listener(listener)
 
 		listener._source_msg_id = source_msg_id
 		listener._kernel = self
-		self.__request_listeners[source_msg_id] = listener
+		self.__requests.add(source_msg_id, listener, expects_reply)
+		if self.__requests.ttl is not None  and  self.__sweep_timer is None:
+			self.__sweep_timer = self.__timers.add(self.__requests.ttl, self.__sweep_requests)
 
 
+	@_synchronized
 	def _detach_listener(self, listener):
 		if listener._source_msg_id is not None:
-			del self.__request_listeners[listener._source_msg_id]
-			listener._source_msg_id = None
-			listener._kernel = None
+			self.__requests.remove(listener._source_msg_id)
+			self.__release_listener(listener)
+
+
+	def __release_listener(self, listener):
+		self.__cancel_deadline(listener._source_msg_id)
+		self.__request_sent_at.pop(listener._source_msg_id, None)
+		self.__request_output_meters.pop(listener._source_msg_id, None)
+		self.__suppressed_output.pop(listener._source_msg_id, None)
+		listener._source_msg_id = None
+		listener._kernel = None
+
+
+	def __track(self, msg_id, msg_type, timeout, on_timeout, listener=None, expects_reply=True,
+		    reply_handlers=None, on_reply=None):
+		'''
+		Register the listener or reply callback for a request that has been sent, and its deadline
+		'''
+		if listener is not None:
+			self._attach_listener(msg_id, listener, expects_reply)
+			discard = self.__discard_listener
+		elif reply_handlers is not None:
+			# A list, as callers of identical requests may join this one
+			if on_reply is not None:
+				reply_handlers[msg_id] = [on_reply]
+			discard = lambda msg_id: reply_handlers.pop(msg_id, None)
+		else:
+			discard = None
+
+		if timeout is not None:
+			def expire():
+				del self.__deadlines[msg_id]
+				self.__idle_deadlines.discard(msg_id)
+				self.__request_sent_at.pop(msg_id, None)
+				if self.__metrics is not None:
+					self.__requests_timed_out.inc((msg_type,))
+				if self.__tracer is not None:
+					self.__tracer.request_abandoned(msg_id, 'timeout')
+				if discard is not None:
+					discard(msg_id)
+				joined_calls = self.__end_single_flight(msg_id)
+				self.__report_timeout(msg_id, msg_type, timeout, on_timeout)
+				# Callers that joined this request and asked for a timeout of their own have timed out too
+				for call in joined_calls:
+					if call.timer is not None:
+						self.__report_timeout(msg_id, msg_type, timeout, call.on_timeout)
+			self.__deadlines[msg_id] = self.__timers.add(timeout, expire)
+			if listener is None  and  not expects_reply:
+				self.__idle_deadlines.add(msg_id)
+
+
+	@_synchronized
+	def _send_comm_msg(self, msg_type, content, buffers, listener, timeout, on_timeout):
+		'''
+		Send a comm message on the SHELL socket on behalf of a Comm, and register its listener and deadline
+
+		:return: the message ID
+		'''
+		msg, msg_id = self._send(self.shell, msg_type, content, buffers=buffers)
+		self.__track(msg_id, msg_type, timeout, on_timeout, listener=listener, expects_reply=False)
+		return msg_id
+
+
+	def __report_timeout(self, msg_id, msg_type, timeout, on_timeout):
+		if on_timeout is not None:
+			try:
+				on_timeout(msg_id)
+			except:
+				_show_handler_exception(self, 'timeout')
+		else:
+			self.__pending_errors.append(RequestTimeoutError(msg_id, msg_type, timeout))
+
+
+	def __single_flight(self, key, msg_type, reply_handlers, on_reply, timeout, on_timeout, send):
+		'''
+		Join an identical request that is already in flight, or send a new one
+
+		:param key: a tuple that identifies requests that are identical
+		:param msg_type: the message type of the request
+		:param reply_handlers: the reply callback dictionary for the request type
+		:param on_reply: None, or the caller's reply callback
+		:param timeout: None, or the time in seconds within which the caller requires the reply
+		:param on_timeout: None, or the caller's timeout callback
+		:param send: function of the form f() -> msg_id that sends the request
+		:return: the message ID of the request
+		'''
+		msg_id = self.__in_flight.get(key)
+		if msg_id is None:
+			msg_id = send()
+			self.__in_flight[key] = msg_id
+			self.__in_flight_keys[msg_id] = key
+			return msg_id
+
+		call = _JoinedCall(on_reply, on_timeout)
+		if on_reply is not None:
+			reply_handlers.setdefault(msg_id, []).append(on_reply)
+		if timeout is not None:
+			# The caller's own deadline; it leaves the request in flight for the others
+			def expire():
+				callbacks = reply_handlers.get(msg_id)
+				if callbacks is not None  and  on_reply in callbacks:
+					callbacks.remove(on_reply)
+				self.__joined_calls[msg_id].remove(call)
+				self.__report_timeout(msg_id, msg_type, timeout, on_timeout)
+			call.timer = self.__timers.add(timeout, expire)
+		self.__joined_calls.setdefault(msg_id, []).append(call)
+		if self.__metrics is not None:
+			self.__requests_coalesced.inc((msg_type,))
+		return msg_id
+
+
+	def __end_single_flight(self, msg_id):
+		'''
+		Stop new requests from joining a request that has completed or been abandoned
+
+		:return: the list of _JoinedCall describing the callers that joined it
+		'''
+		self.__stop_joining(msg_id)
+		joined_calls = self.__joined_calls.pop(msg_id, [])
+		for call in joined_calls:
+			if call.timer is not None:
+				call.timer.cancel()
+		return joined_calls
+
+
+	def __stop_joining(self, msg_id):
+		key = self.__in_flight_keys.pop(msg_id, None)
+		if key is not None:
+			del self.__in_flight[key]
+
 
+	def __reply_from_cache(self, msg_type, cached_reply, on_reply, context):
+		'''
+		Answer a request from a cached reply without sending it; the callback is invoked from the next poll
+
+		:return: the message ID of the request whose reply was cached
+		'''
+		msg_id, reply = cached_reply
+		if on_reply is not None:
+			def deliver():
+				try:
+					on_reply(*reply)
+				except:
+					_show_handler_exception(self, context)
+			self.__timers.add(0.0, deliver)
+		if self.__metrics is not None:
+			self.__requests_coalesced.inc((msg_type,))
+		return msg_id
+
+
+	def __discard_listener(self, msg_id):
+		listener = self.__requests.remove(msg_id)
+		if listener is not None:
+			self.__release_listener(listener)
+
+
+	def __cancel_deadline(self, msg_id):
+		timer = self.__deadlines.pop(msg_id, None)
+		if timer is not None:
+			timer.cancel()
+			self.__idle_deadlines.discard(msg_id)
+
+
+	def __replace_heartbeat_socket(self, old_socket, new_socket):
+		self.__poller.unregister(old_socket)
+		self.__poller.register(new_socket)
+		for observer in self.__socket_observers:
+			observer(old_socket, new_socket)
+
+
+	def __on_kernel_dead(self):
+		'''
+		Fail every request in flight
+		'''
+		if self.__stream_coalescer is not None:
+			self.__stream_coalescer.flush_all()
+		failed = []
+		for listener in self.__requests.remove_all():
+			failed.append(listener._source_msg_id)
+			self.__release_listener(listener)
+			try:
+				listener.on_kernel_dead()
+			except:
+				_show_handler_exception(self, 'kernel_dead')
+		for reply_handlers in [self.__history_reply_handlers, self.__connect_reply_handlers,
+				       self.__kernel_info_reply_handlers, self.__shutdown_reply_handlers]:
+			failed.extend(reply_handlers.keys())
+			reply_handlers.clear()
+		for msg_id, timer in self.__deadlines.items():
+			timer.cancel()
+			if msg_id not in failed:
+				failed.append(msg_id)
+		self.__deadlines.clear()
+		for msg_id in self.__joined_calls.keys():
+			self.__end_single_flight(msg_id)
+		self.__in_flight.clear()
+		self.__in_flight_keys.clear()
+		self.__kernel_info = None
+		self.__connect_info = None
+		self.__request_sent_at.clear()
+		if self.__tracer is not None:
+			self.__tracer.abandon_all('kernel_dead')
+
+		if self.on_kernel_dead is not None:
+			try:
+				self.on_kernel_dead(failed)
+			except:
+				_show_handler_exception(self, 'kernel_dead')
+		else:
+			self.__pending_errors.append(KernelDeadError(failed))
+
+
+	def __sweep_requests(self):
+		# Driven by the timer queue, so that requests expire even when no messages arrive
+		self.__sweep_timer = None
+		for listener in self.__requests.sweep(force=True):
+			if self.__tracer is not None:
+				self.__tracer.request_abandoned(listener._source_msg_id, 'expired')
+			self.__release_listener(listener)
+			try:
+				listener.on_request_expired()
+			except:
+				_show_handler_exception(self, 'request_expired')
+		if self.__requests.n_live > 0:
+			self.__sweep_timer = self.__timers.add(self.__requests.ttl, self.__sweep_requests)
+
+
+	def __finish_request(self, listener):
+		if listener is not None:
+			if self.__tracer is not None:
+				self.__tracer.request_finished(listener._source_msg_id)
+			suppressed = self.__suppressed_output.get(listener._source_msg_id)
+			self.__release_listener(listener)
+			if suppressed is not None:
+				try:
+					listener.on_output_suppressed(suppressed)
+				except:
+					_show_handler_exception(self, 'output_suppressed')
+			try:
+				listener.on_request_finished()
+			except:
+				_show_handler_exception(self, 'request_finished')
+
+
+
+	def __warn_no_listener(self, msg):
+		# IOPUB is broadcast to every front end; output resulting from requests made by others is not ours
+		if msg['parent_header'].get('session') == self.session.session:
+			print 'No listener for {0} responding to {1}'.format(msg['msg_type'], _get_parent_msg_type(msg))
 
 
+
+	@_synchronized
 	def execute_request(self, code, silent=False, store_history=True, user_expressions=None, allow_stdin=True,
-			    listener=None):
+			    listener=None, buffers=None, timeout=None, on_timeout=None, output_budget=None):
 		'''
 		Send an execute request to the remote kernel via the SHELL socket
 
@@ -247,24 +1255,67 @@ class KernelConnection(object):
 		if stdin is attempted
 		:param listener: None, or a KernelRequestListener. Note that the listener will be disconnected from any prior requests
 			to which it was attached; it will no longer receive any events resulting from that request.
+		:param buffers: None, or a list of binary buffers to attach to the request; they are sent without being
+			copied, so must not be modified until sent
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
+		:param output_budget: None, or an OutputBudget limiting the output delivered to the listener; defaults
+			to the connection's request_output_budget
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'execute_request', {
+			msg, msg_id = self._send(self.shell, 'execute_request', {
 				'code': code,
 				'silent': silent,
 				'store_history': store_history,
 				'user_expressions': user_expressions if user_expressions is not None   else {},
 				'allow_stdin': allow_stdin
-			})
+			}, buffers=buffers)
 
-			if listener is not None:
-				self._attach_listener(msg_id, listener)
+			self.__track(msg_id, 'execute_request', timeout, on_timeout, listener=listener)
+			if output_budget is None:
+				output_budget = self.__request_output_budget
+			if output_budget is not None  and  listener is not None:
+				self.__request_output_meters[msg_id] = OutputMeter(output_budget)
 
 			return msg_id
 
 
-	def inspect_request(self, code, cursor_pos, detail_level=0, listener=None):
+	def execute_batch(self, cells, window=4, stop_on_error=False, silent=False, store_history=True,
+			  user_expressions=None, cell_timeout=None, timeout=None):
+		'''
+		Execute a sequence of cells, keeping up to `window` execute requests in flight so that the kernel
+		does not sit idle waiting for the next cell. Polls the connection until every cell has finished, or
+		the timeout expires, in which case the cells that have not finished are marked STATUS_TIMED_OUT or
+		STATUS_NOT_SENT.
+
+		Cells are executed with allow_stdin=False.
+
+		:param cells: sequence of code strings
+		:param window: the maximum number of execute requests in flight at once
+		:param stop_on_error: if True, do not send the remaining cells once a cell fails
+		:param silent: passed to each execute request
+		:param store_history: passed to each execute request
+		:param user_expressions: passed to each execute request
+		:param cell_timeout: None, or the time in seconds from sending a cell within which it must finish;
+			the batch stops at the first cell that does not
+		:param timeout: None, or the time in seconds within which the whole batch must finish
+		:return: a list of BatchCellResult objects, in the same order as cells
+		'''
+		if self.__io_executor is not None:
+			raise ValueError, 'execute_batch requires a connection that dispatches messages via poll()'
+		batch = ExecuteBatch(self, cells, window=window, stop_on_error=stop_on_error, silent=silent,
+				     store_history=store_history, user_expressions=user_expressions, cell_timeout=cell_timeout)
+		timer = self.__timers.add(timeout, batch.time_out)   if timeout is not None   else None
+		while not batch.finished  and  self._open:
+			self.poll(-1)
+		if timer is not None:
+			timer.cancel()
+		return batch.results
+
+
+	@_synchronized
+	def inspect_request(self, code, cursor_pos, detail_level=0, listener=None, timeout=None, on_timeout=None):
 		'''
 		Send an inspect request to the remote kernel via the SHELL socket
 
@@ -273,22 +1324,24 @@ class KernelConnection(object):
 		:param detail_level: 0 or 1
 		:param listener: None, or a KernelRequestListener. Note that the listener will be disconnected from any prior requests
 			to which it was attached; it will no longer receive any events resulting from that request.
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'inspect_request', {
+			msg, msg_id = self._send(self.shell, 'inspect_request', {
 				'code': code,
 				'cursor_pos': cursor_pos,
 				'detail_level': detail_level
 			})
 
-			if listener is not None:
-				self._attach_listener(msg_id, listener)
+			self.__track(msg_id, 'inspect_request', timeout, on_timeout, listener=listener)
 
 			return msg_id
 
 
-	def complete_request(self, code, cursor_pos, listener=None):
+	@_synchronized
+	def complete_request(self, code, cursor_pos, listener=None, timeout=None, on_timeout=None):
 		'''
 		Send a complete request to the remote kernel via the SHELL socket
 
@@ -296,22 +1349,24 @@ class KernelConnection(object):
 		:param cursor_pos: the position of the cursor (in unicode characters) where completion is requested
 		:param listener: None, or a KernelRequestListener. Note that the listener will be disconnected from any prior requests
 			to which it was attached; it will no longer receive any events resulting from that request.
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'complete_request', {
+			msg, msg_id = self._send(self.shell, 'complete_request', {
 				'code': code,
 				'cursor_pos': cursor_pos
 			})
 
-			if listener is not None:
-				self._attach_listener(msg_id, listener)
+			self.__track(msg_id, 'complete_request', timeout, on_timeout, listener=listener)
 
 			return msg_id
 
 
+	@_synchronized
 	def history_request_range(self, output=True, raw=False,
-				  session=0, start=0, stop=0, on_history=None):
+				  session=0, start=0, stop=0, on_history=None, timeout=None, on_timeout=None):
 		'''
 		Send a range history_request to the remote kernel via the SHELL socket
 
@@ -321,43 +1376,55 @@ class KernelConnection(object):
 		:param start:
 		:param stop:
 		:param on_history: callback: f(history)
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'history_request',
+			msg, msg_id = self._send(self.shell, 'history_request',
 							{'output': output, 'raw': raw, 'hist_access_type': 'range',
 							 'session': session, 'start': start, 'stop': stop})
 
-			if on_history is not None:
-				self.__history_reply_handlers[msg_id] = on_history
+			self.__track(msg_id, 'history_request', timeout, on_timeout,
+				     reply_handlers=self.__history_reply_handlers, on_reply=on_history)
 
 			return msg_id
 
 
+	@_synchronized
 	def history_request_tail(self, output=True, raw=False,
-				 n=1, on_history=None):
+				 n=1, on_history=None, timeout=None, on_timeout=None):
 		'''
 		Send a tail history_request to the remote kernel via the SHELL socket
 
+		If an identical request is already in flight, no request is sent; on_history is invoked with its
+		reply instead.
+
 		:param output:
 		:param raw:
 		:param n: show the last n entries
 		:param on_history: callback: f(history)
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'history_request',
-							{'output': output, 'raw': raw, 'hist_access_type': 'tail',
-							 'n': n})
+			def send():
+				msg, msg_id = self._send(self.shell, 'history_request',
+								{'output': output, 'raw': raw, 'hist_access_type': 'tail',
+								 'n': n})
 
-			if on_history is not None:
-				self.__history_reply_handlers[msg_id] = on_history
+				self.__track(msg_id, 'history_request', timeout, on_timeout,
+					     reply_handlers=self.__history_reply_handlers, on_reply=on_history)
+				return msg_id
 
-			return msg_id
+			return self.__single_flight(('history_request', 'tail', bool(output), bool(raw), n), 'history_request',
+						    self.__history_reply_handlers, on_history, timeout, on_timeout, send)
 
 
+	@_synchronized
 	def history_request_search(self, output=True, raw=False,
-				   pattern='', unique=False, n=1, on_history=None):
+				   pattern='', unique=False, n=1, on_history=None, timeout=None, on_timeout=None):
 		'''
 		Send a search history_request to the remote kernel via the SHELL socket
 
@@ -367,69 +1434,108 @@ class KernelConnection(object):
 		:param unique:
 		:param n: show the last n entries
 		:param on_history: callback: f(history)
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'history_request',
+			msg, msg_id = self._send(self.shell, 'history_request',
 							{'output': output, 'raw': raw, 'hist_access_type': 'search',
 							 'n': n, 'pattern': pattern, 'unique': unique})
 
-			if on_history is not None:
-				self.__history_reply_handlers[msg_id] = on_history
+			self.__track(msg_id, 'history_request', timeout, on_timeout,
+				     reply_handlers=self.__history_reply_handlers, on_reply=on_history)
 
 			return msg_id
 
 
-	def connect_request(self, on_connect=None):
+	@_synchronized
+	def connect_request(self, on_connect=None, timeout=None, on_timeout=None, cached=True):
 		'''
 		Send a connect_request to the remote kernel via the SHELL socket
 
-		:param on_connect: callback: f(shell_port, iopub_port, stdin_port, hb_port)
+		The reply is cached until the connection is re-established; see kernel_info_request.
+
+		:param on_connect: callback: f(shell_port, iopub_port, stdin_port, hb_port); the ports are None if the
+			kernel has not recorded them
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
+		:param cached: if False, ask the kernel even if its reply has been cached
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'connect_request', {})
+			if cached  and  self.__connect_info is not None:
+				return self.__reply_from_cache('connect_request', self.__connect_info, on_connect,
+							       'shell:connect_reply')
 
-			if on_connect is not None:
-				self.__connect_reply_handlers[msg_id] = on_connect
+			def send():
+				msg, msg_id = self._send(self.shell, 'connect_request', {})
 
-			return msg_id
+				self.__track(msg_id, 'connect_request', timeout, on_timeout,
+					     reply_handlers=self.__connect_reply_handlers, on_reply=on_connect)
+				return msg_id
 
+			return self.__single_flight(('connect_request',), 'connect_request', self.__connect_reply_handlers,
+						    on_connect, timeout, on_timeout, send)
 
-	def kernel_info_request(self, on_kernel_info=None):
+
+	@_synchronized
+	def kernel_info_request(self, on_kernel_info=None, timeout=None, on_timeout=None, cached=True):
 		'''
 		Send a kernel_info request to the remote kernel via the SHELL socket
 
+		Identical requests are coalesced: if a kernel_info request is already in flight, no request is sent and
+		on_kernel_info is invoked with its reply, and the message ID of that request is returned. Once a reply
+		has arrived it is cached until the connection is re-established (see reconnect) or the kernel dies;
+		later requests are answered from the cache, with on_kernel_info invoked from the next call to poll and
+		the message ID of the cached reply's request returned. Pass cached=False to check that the kernel is
+		responding.
+
 		:param on_kernel_info: callback: f(protocol_version, implementation, implementation_version, language,
 			language_version, banner)
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
+		:param cached: if False, ask the kernel even if its reply has been cached
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'kernel_info', {})
+			if cached  and  self.__kernel_info is not None:
+				return self.__reply_from_cache('kernel_info_request', self.__kernel_info, on_kernel_info,
+							       'shell:kernel_info_reply')
 
-			if on_kernel_info is not None:
-				self.__kernel_info_reply_handlers[msg_id] = on_kernel_info
+			def send():
+				msg, msg_id = self._send(self.shell, 'kernel_info_request', {})
 
-			return msg_id
+				self.__track(msg_id, 'kernel_info_request', timeout, on_timeout,
+					     reply_handlers=self.__kernel_info_reply_handlers, on_reply=on_kernel_info)
+				return msg_id
+
+			return self.__single_flight(('kernel_info_request',), 'kernel_info_request',
+						    self.__kernel_info_reply_handlers, on_kernel_info, timeout, on_timeout, send)
 
 
-	def shutdown_request(self, on_shutdown=None):
+	@_synchronized
+	def shutdown_request(self, restart=False, on_shutdown=None, timeout=None, on_timeout=None):
 		'''
 		Send a shutdown request to the remote kernel via the SHELL socket
 
+		:param restart: if True, the kernel is being restarted rather than shut down for good
 		:param on_shutdown: callback: f(restart)
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: message ID
 		'''
 		if self._open:
-			msg, msg_id = self.session.send(self.shell, 'shutdown', {})
+			msg, msg_id = self._send(self.shell, 'shutdown_request', {'restart': restart})
 
-			if on_shutdown is not None:
-				self.__shutdown_reply_handlers[msg_id] = on_shutdown
+			self.__track(msg_id, 'shutdown_request', timeout, on_timeout,
+				     reply_handlers=self.__shutdown_reply_handlers, on_reply=on_shutdown)
 
 			return msg_id
 
 
-	def open_comm(self, target_name, data=None, listener=None):
+	@_synchronized
+	def open_comm(self, target_name, data=None, listener=None, buffers=None, timeout=None, on_timeout=None):
 		'''
 		Open a comm
 
@@ -437,6 +1543,9 @@ class KernelConnection(object):
 		:param data: extra initialisation data
 		:param listener: None, or a KernelRequestListener. Note that the listener will be disconnected from any prior requests
 			to which it was attached; it will no longer receive any events resulting from that request.
+		:param buffers: None, or a list of binary buffers to send with the comm_open message
+		:param timeout: None, or the time in seconds within which the request must complete
+		:param on_timeout: None, or callback: f(msg_id) invoked if the request times out
 		:return: a Comm object
 		'''
 		if self._open:
@@ -447,16 +1556,16 @@ class KernelConnection(object):
 			comm = Comm(self, comm_id, target_name, True)
 			self.__comm_id_to_comm[comm_id] = comm
 
-			msg, msg_id = self.session.send(self.shell, 'comm_open',
-					  {'comm_id': str(comm_id), 'target_name': target_name, 'data': data})
+			msg, msg_id = self._send(self.shell, 'comm_open',
+					  {'comm_id': str(comm_id), 'target_name': target_name, 'data': data}, buffers=buffers)
 
-			if listener is not None:
-				self._attach_listener(msg_id, listener)
+			self.__track(msg_id, 'comm_open', timeout, on_timeout, listener=listener, expects_reply=False)
 
 			return comm
 
 
-	def _notity_comm_closed(self, comm):
+	@_synchronized
+	def _notify_comm_closed(self, comm):
 		del self.__comm_id_to_comm[comm.comm_id]
 
 
@@ -464,7 +1573,13 @@ class KernelConnection(object):
 		content = msg['content']
 		status = content['status']
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		if len(self.__execute_reply_observers) > 0  and  'execution_count' in content:
+			for observer in self.__execute_reply_observers:
+				try:
+					observer(parent_msg_id, content['execution_count'])
+				except:
+					_show_handler_exception(self, 'shell:execute_reply:observer')
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
 			if status == 'ok':
 				execution_count = content['execution_count']
@@ -489,54 +1604,56 @@ class KernelConnection(object):
 					_show_handler_exception(self, 'shell:execute_reply:abort')
 			else:
 				raise ValueError, 'Unknown execute_reply status {0}'.format(status)
+			self.__finish_request(self.__requests.reply_received(parent_msg_id, status != 'ok'  and  status != 'error'))
 		else:
+			self.__cancel_deadline(parent_msg_id)
 			print 'No listener for execute_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_iopub_pyout(self, ident, msg):
 		self._handle_msg_iopub_execute_result(ident, msg)
 
 	def _handle_msg_iopub_execute_result(self, ident, msg):
-		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		execution_count = content['execution_count']
-		data = content['data']
-		metadata = content['metadata']
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
+			content = msg['content']
+			execution_count = content['execution_count']
+			data = content['data']
+			metadata = content['metadata']
+			if msg['buffers']:
+				try:
+					kernel_request_listener.on_buffers('execute_result', msg['buffers'])
+				except:
+					_show_handler_exception(self, 'iopub:execute_result:buffers')
 			try:
 				kernel_request_listener.on_execute_result(execution_count, data, metadata)
 			except:
 				_show_handler_exception(self, 'iopub:execute_result')
 		else:
-			print 'No listener for execute_result responding to {0}'.format(_get_parent_msg_type(msg))
+			self.__warn_no_listener(msg)
 
 	def _handle_msg_iopub_pyerr(self, ident, msg):
 		self._handle_msg_iopub_error(ident, msg)
 
 	def _handle_msg_iopub_error(self, ident, msg):
-		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		ename = content['ename']
-		evalue = content['evalue']
-		traceback = content['traceback']
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
+			content = msg['content']
 			try:
-				kernel_request_listener.on_error(ename, evalue, traceback)
+				kernel_request_listener.on_error(content['ename'], content['evalue'], content['traceback'])
 			except:
 				_show_handler_exception(self, 'iopub:error')
 		else:
-			print 'No listener for error responding to {0}'.format(_get_parent_msg_type(msg))
+			self.__warn_no_listener(msg)
 
 
 	def _handle_msg_shell_inspect_reply(self, ident, msg):
 		content = msg['content']
 		status = content['status']
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
-			if kernel_request_listener.unref():
-				del self.__request_listeners[parent_msg_id]
 			if status == 'ok':
 				data = content['data']
 				metadata = content['metadata']
@@ -554,17 +1671,17 @@ class KernelConnection(object):
 					_show_handler_exception(self, 'shell:inspect_reply:error')
 			else:
 				raise ValueError, 'Unknown inspect_reply status'
+			self.__finish_request(self.__requests.reply_received(parent_msg_id))
 		else:
+			self.__cancel_deadline(parent_msg_id)
 			print 'No listener for inspect_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_shell_complete_reply(self, ident, msg):
 		content = msg['content']
 		status = content['status']
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
-			if kernel_request_listener.unref():
-				del self.__request_listeners[parent_msg_id]
 			if status == 'ok':
 				matches = content['matches']
 				cursor_start = content['cursor_start']
@@ -584,102 +1701,153 @@ class KernelConnection(object):
 					_show_handler_exception(self, 'shell:complete_reply:error')
 			else:
 				raise ValueError, 'Unknown complete_reply status'
+			self.__finish_request(self.__requests.reply_received(parent_msg_id))
 		else:
+			self.__cancel_deadline(parent_msg_id)
 			print 'No listener for complete_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_shell_history_reply(self, ident, msg):
 		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		on_history = self.__history_reply_handlers.pop(parent_msg_id, None)
-		if on_history is not None:
-			try:
-				on_history(content['history'])
-			except:
-				_show_handler_exception(self, 'shell:history_reply')
+		callbacks = self.__history_reply_handlers.pop(parent_msg_id, None)
+		self.__cancel_deadline(parent_msg_id)
+		self.__end_single_flight(parent_msg_id)
+		if callbacks is not None:
+			for on_history in callbacks:
+				try:
+					on_history(content['history'])
+				except:
+					_show_handler_exception(self, 'shell:history_reply')
 		else:
 			print 'No listener for history_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_shell_connect_reply(self, ident, msg):
 		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		on_connect = self.__connect_reply_handlers.pop(parent_msg_id, None)
-		if on_connect is not None:
-			try:
-				on_connect(content['shell_port'], content['iopub_port'], content['stdin_port'],
-					   content['hb_port'])
-			except:
-				_show_handler_exception(self, 'shell:connect_reply')
+		callbacks = self.__connect_reply_handlers.pop(parent_msg_id, None)
+		self.__cancel_deadline(parent_msg_id)
+		self.__end_single_flight(parent_msg_id)
+		# A kernel that has not recorded its ports replies with empty content
+		reply = (content.get('shell_port'), content.get('iopub_port'), content.get('stdin_port'),
+			 content.get('hb_port'))
+		self.__connect_info = (parent_msg_id, reply)
+		if callbacks is not None:
+			for on_connect in callbacks:
+				try:
+					on_connect(*reply)
+				except:
+					_show_handler_exception(self, 'shell:connect_reply')
 		else:
 			print 'No listener for connect_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_shell_kernel_info_reply(self, ident, msg):
 		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		on_kernel_info = self.__kernel_info_reply_handlers.pop(parent_msg_id, None)
-		if on_kernel_info is not None:
-			try:
-				on_kernel_info(content['protocol_version'],
-					       content['implementation'],
-					       content['implementation_version'],
-					       content['language'],
-					       content['language_version'],
-					       content['banner'])
-			except:
-				_show_handler_exception(self, 'shell:kernel_info_reply')
+		callbacks = self.__kernel_info_reply_handlers.pop(parent_msg_id, None)
+		self.__cancel_deadline(parent_msg_id)
+		self.__end_single_flight(parent_msg_id)
+		# Protocol 5.0 moved the language details into language_info
+		language_info = content.get('language_info')
+		if language_info is not None:
+			language = language_info['name']
+			language_version = language_info['version']
+		else:
+			language = content['language']
+			language_version = content['language_version']
+		reply = (content['protocol_version'],
+			 content['implementation'],
+			 content['implementation_version'],
+			 language,
+			 language_version,
+			 content['banner'])
+		self.__kernel_info = (parent_msg_id, reply)
+		if callbacks is not None:
+			for on_kernel_info in callbacks:
+				try:
+					on_kernel_info(*reply)
+				except:
+					_show_handler_exception(self, 'shell:kernel_info_reply')
 		else:
 			print 'No listener for kernel_info_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_shell_shutdown_reply(self, ident, msg):
 		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		on_shutdown = self.__shutdown_reply_handlers.pop(parent_msg_id, None)
-		if on_shutdown is not None:
-			try:
-				on_shutdown(content['restart'])
-			except:
-				_show_handler_exception(self, 'shell:shutdown_reply')
+		callbacks = self.__shutdown_reply_handlers.pop(parent_msg_id, None)
+		self.__cancel_deadline(parent_msg_id)
+		if callbacks is not None:
+			for on_shutdown in callbacks:
+				try:
+					on_shutdown(content['restart'])
+				except:
+					_show_handler_exception(self, 'shell:shutdown_reply')
 		else:
 			print 'No listener for shutdown_reply responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_iopub_stream(self, ident, msg):
-		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		stream_name = content['name']
-		text = content['text']
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
+		if kernel_request_listener is not None:
+			content = msg['content']
+			stream_name = content['name']
+			text = content['text']
+			if self.__stream_coalescer is not None:
+				self.__stream_coalescer.add(parent_msg_id, stream_name, text)
+			else:
+				try:
+					kernel_request_listener.on_stream(stream_name, text)
+				except:
+					_show_handler_exception(self, 'iopub:stream')
+		else:
+			self.__warn_no_listener(msg)
+
+	def __deliver_stream(self, parent_msg_id, stream_name, text):
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
 			try:
 				kernel_request_listener.on_stream(stream_name, text)
 			except:
 				_show_handler_exception(self, 'iopub:stream')
-		else:
-			print 'No listener for stream responding to {0}'.format(_get_parent_msg_type(msg))
 
 	def _handle_msg_iopub_display_data(self, ident, msg):
-		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		data = content['data']
-		metadata = content['metadata']
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
+			content = msg['content']
+			data = content['data']
+			metadata = content['metadata']
+			if msg['buffers']:
+				try:
+					kernel_request_listener.on_buffers('display_data', msg['buffers'])
+				except:
+					_show_handler_exception(self, 'iopub:display_data:buffers')
 			try:
 				kernel_request_listener.on_display_data(data, metadata)
 			except:
 				_show_handler_exception(self, 'iopub:display_data')
 		else:
-			print 'No listener for display_data responding to {0}'.format(_get_parent_msg_type(msg))
+			self.__warn_no_listener(msg)
 
 	def _handle_msg_iopub_status(self, ident, msg):
 		content = msg['content']
 		execution_state = content['execution_state']
 		parent_msg_id = _get_parent_msg_id(msg)
 		self.__busy = execution_state == 'busy'
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
 			try:
 				kernel_request_listener.on_status(self.__busy)
 			except:
 				_show_handler_exception(self, 'iopub:status')
+			if not self.__busy:
+				self.__finish_request(self.__requests.idle_received(parent_msg_id))
+		elif not self.__busy  and  parent_msg_id in self.__idle_deadlines:
+			self.__cancel_deadline(parent_msg_id)
+		for observer in self.__status_observers:
+			try:
+				observer(parent_msg_id, self.__busy)
+			except:
+				_show_handler_exception(self, 'iopub:status:observer')
 		if self.on_status is not None:
 			self.on_status(parent_msg_id, self.__busy)
 
@@ -687,18 +1855,26 @@ class KernelConnection(object):
 		self._handle_msg_iopub_execute_input(ident, msg)
 
 	def _handle_msg_iopub_execute_input(self, ident, msg):
-		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
+		if kernel_request_listener is None  and  len(self.__execute_input_observers) == 0:
+			self.__warn_no_listener(msg)
+			return
+		content = msg['content']
 		execution_count = content['execution_count']
 		code = content['code']
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		for observer in self.__execute_input_observers:
+			try:
+				observer(parent_msg_id, execution_count, code)
+			except:
+				_show_handler_exception(self, 'iopub:execute_input:observer')
 		if kernel_request_listener is not None:
 			try:
 				kernel_request_listener.on_execute_input(execution_count, code)
 			except:
 				_show_handler_exception(self, 'iopub:execute_input')
 		else:
-			print 'No listener for execute_input responding to {0}'.format(_get_parent_msg_type(msg))
+			self.__warn_no_listener(msg)
 
 	def _handle_msg_iopub_clear_output(self, ident, msg):
 		content = msg['content']
@@ -708,12 +1884,12 @@ class KernelConnection(object):
 	def _handle_msg_stdin_input_request(self, ident, msg):
 		content = msg['content']
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
 			request_header = msg['header']
 
 			def reply_callback(value):
-				self.session.send(self.stdin, 'input_reply', {'value': value}, parent=request_header)
+				self._send(self.stdin, 'input_reply', {'value': value}, parent=request_header)
 
 			try:
 				kernel_request_listener.on_input_request(content['prompt'], content['password'], reply_callback)
@@ -731,7 +1907,7 @@ class KernelConnection(object):
 		self.__comm_id_to_comm[comm_id] = comm
 
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 		if kernel_request_listener is not None:
 			try:
 				kernel_request_listener.on_comm_open(comm, data)
@@ -745,11 +1921,14 @@ class KernelConnection(object):
 		data = content['data']
 
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 
-		comm = self.__comm_id_to_comm[comm_id]
+		# IOPUB is broadcast to every front end, so comms opened by other connections to the kernel are seen too
+		comm = self.__comm_id_to_comm.get(comm_id)
+		if comm is None:
+			return
 		try:
-			comm._handle_message(data, kernel_request_listener)
+			comm._handle_message(data, msg['buffers'], kernel_request_listener)
 		except:
 			_show_handler_exception(self, 'iopub:comm_msg')
 
@@ -760,9 +1939,11 @@ class KernelConnection(object):
 		data = content['data']
 
 		parent_msg_id = _get_parent_msg_id(msg)
-		kernel_request_listener = self.__request_listeners.get(parent_msg_id)
+		kernel_request_listener = self.__requests.get_listener(parent_msg_id)
 
-		comm = self.__comm_id_to_comm[comm_id]
+		comm = self.__comm_id_to_comm.get(comm_id)
+		if comm is None:
+			return
 		try:
 			comm._handle_closed_remotely(data, kernel_request_listener)
 		except:
@@ -777,57 +1958,218 @@ __ipython_processes = []
 
 
 class IPythonKernelProcess (object):
+	'''
+	    An IPython kernel running in a sub-process
+
+	    The ports and key are chosen and the connection file written before the kernel is spawned, so the
+	    connection is opened at once rather than once the kernel has written the file; ZeroMQ queues the
+	    connection attempts until the kernel binds its sockets. The kernel is ready once it has answered a
+	    kernel_info request and the status messages that it publishes while handling one have arrived on
+	    IOPUB; IOPUB subscriptions take effect some time after connecting, and output published before then
+	    is lost. Call wait_ready() to wait for that; requests sent before then are queued. If the kernel is
+	    not ready within handshake_interval the request is re-sent, doubling the interval each time up to
+	    max_handshake_interval.
+
+	    startup_times breaks down how long the kernel took to become ready.
+	    '''
 	__kernels = []
 
-	def __init__(self, ipython_path='ipython', connection_file_path=None):
+	def __init__(self, ipython_path='ipython', connection_file_path=None, ip='127.0.0.1', handshake_interval=0.05,
+		     max_handshake_interval=1.0, stdout=None):
+		'''
+		IPython kernel process constructor; spawns the kernel and connects to it
+
+		:param ipython_path: the path of the ipython executable
+		:param connection_file_path: the path at which to write the connection file; None for a temporary file
+		:param ip: the address on which the kernel listens
+		:param handshake_interval: the time in seconds to wait for a reply to the first kernel_info request
+		:param max_handshake_interval: the most time in seconds to wait for a reply to any one kernel_info
+			request
+		:param stdout: None to discard the kernel's standard output, or a file to which to write it. Output is
+			never left in an unread pipe, as a long lived kernel would block once the pipe filled up.
+		'''
+		started_at = clock()
 		# If no connection file path was specified, generate one
 		if connection_file_path is None:
 			handle, connection_file_path = tempfile.mkstemp(suffix='.json', prefix='kernel')
 			os.close(handle)
-			os.remove(connection_file_path)
 
 		self.__connection_file_path = connection_file_path
 
+		# Choose the ports and key ourselves; the kernel uses those given in an existing connection file
+		connection = dict(zip(['shell_port', 'iopub_port', 'stdin_port', 'control_port', 'hb_port'],
+				      _allocate_tcp_ports(ip, 5)))
+		connection.update({'ip': ip, 'transport': 'tcp', 'key': str(uuid.uuid4()),
+				   'signature_scheme': 'hmac-sha256'})
+		write_connection_file(connection_file_path, connection)
+		file_written_at = clock()
+
 		# Spawn the kernel in a sub-process
 		env = None
 
-		self.__proc = subprocess.Popen([ipython_path, 'kernel', '-f', self.__connection_file_path],
-					       env=env, stdout=subprocess.PIPE)
-
-		self.__connection = None
+		devnull = open(os.devnull, 'w')   if stdout is None   else None
+		try:
+			self.__proc = subprocess.Popen([ipython_path, 'kernel', '-f', self.__connection_file_path],
+						       env=env, stdout=stdout   if devnull is None   else devnull)
+		finally:
+			if devnull is not None:
+				devnull.close()
+		spawned_at = clock()
+
+		self.__connection = KernelConnection(kernel_path=self.__connection_file_path,
+						     interrupt_handler=self.interrupt)
+
+		self.__startup = [started_at, file_written_at, spawned_at]
+		self.__ready_at = None
+		self.__kernel_info = None
+		self.__iopub_ready = False
+		self.__handshake_interval = handshake_interval
+		self.__max_handshake_interval = max_handshake_interval
+		self.__handshake_msg_ids = set()
+		self.__handshake_msg_id = None
+		self.__handshake_deadline = None
+		self.__n_handshakes = 0
+		self.__connection._add_status_observer(self.__on_status)
+		self.__send_handshake()
 
 		self.__kernels.append(self)
 
 
+	@property
+	def connection_file_path(self):
+		return self.__connection_file_path
+
+
+	@property
+	def connection(self):
+		'''
+		The KernelConnection; available at once, but see wait_ready()
+		'''
+		return self.__connection
+
+
+	@property
+	def ready(self):
+		'''
+		True once the kernel has answered a kernel_info request, and its IOPUB messages are being received
+		'''
+		return self.__ready_at is not None
+
+
+	@property
+	def kernel_info(self):
+		'''
+		None until the kernel is ready, then the tuple of (protocol_version, implementation,
+		implementation_version, language, language_version, banner) from its kernel_info reply
+		'''
+		return self.__kernel_info
+
+
+	@property
+	def startup_times(self):
+		'''
+		A dictionary of the time in seconds spent in each stage of starting the kernel:
+		connection_file: choosing ports and writing the connection file
+		spawn: starting the kernel process
+		handshake: from spawning the process until the kernel was ready
+		total: the sum of the above
+		and handshakes: the number of kernel_info requests sent. The handshake and total times are None until
+		the kernel is ready.
+		'''
+		started_at, file_written_at, spawned_at = self.__startup
+		ready_at = self.__ready_at
+		return {'connection_file': file_written_at - started_at, 'spawn': spawned_at - file_written_at,
+			'handshake': ready_at - spawned_at   if ready_at is not None   else None,
+			'total': ready_at - started_at   if ready_at is not None   else None,
+			'handshakes': self.__n_handshakes}
+
+
+	def wait_ready(self, timeout=None):
+		'''
+		Wait until the kernel is ready, polling the connection meanwhile
+
+		:param timeout: None to wait indefinitely, or the most time in seconds to wait
+		:return: True if the kernel is ready, False if it did not become ready within the timeout
+		:raises KernelStartupError: if the kernel process exits first
+		'''
+		deadline = clock() + timeout   if timeout is not None   else None
+		connection = self.__connection
+		while self.__ready_at is None:
+			if self.__proc.poll() is not None:
+				raise KernelStartupError, 'Kernel process exited with status {0} before answering'.format(
+					self.__proc.returncode)
+			now = clock()
+			if now >= self.__handshake_deadline:
+				# Not answered in time; ask again. A late reply to the earlier request is dropped, unless
+				# others made kernel_info requests that joined it, in which case it is still delivered to them
+				connection._supersede_kernel_info_request(self.__handshake_msg_id, self.__on_kernel_info)
+				self.__handshake_interval = min(self.__handshake_interval * 2.0, self.__max_handshake_interval)
+				self.__send_handshake()
+			wait = self.__handshake_deadline - now
+			if deadline is not None:
+				wait = min(wait, deadline - now)
+			connection.poll(max(int(wait * 1000.0), 0))
+			if self.__ready_at is None  and  deadline is not None  and  clock() >= deadline:
+				return False
+		return True
+
+
 	def is_open(self):
-		return self.__connection.is_open()   if self.__connection is not None   else None
+		return self.__connection.is_open()
+
+
+	def interrupt(self):
+		'''
+		Interrupt the code that the kernel is executing by sending it SIGINT
+		'''
+		self.__proc.send_signal(signal.SIGINT)
 
 
 	def close(self):
-		if self.__connection is not None:
-			self.__connection.close()
-		self.__proc.terminate()
+		connection = self.__connection
+		if connection.is_open():
+			# Requests that the kernel never received would otherwise hold up terminating the ZeroMQ context
+			for socket in [connection.shell, connection.iopub, connection.stdin, connection.control]:
+				zmq_set_linger(socket, 0)
+			connection.close()
+		if self.__proc.poll() is None:
+			self.__proc.terminate()
 		if os.path.exists(self.__connection_file_path):
 			os.remove(self.__connection_file_path)
+		if self in self.__kernels:
+			self.__kernels.remove(self)
 
 
+	def __send_handshake(self):
+		self.__n_handshakes += 1
+		self.__handshake_deadline = clock() + self.__handshake_interval
+		self.__handshake_msg_id = self.__connection.kernel_info_request(on_kernel_info=self.__on_kernel_info,
+										cached=False)
+		self.__handshake_msg_ids.add(self.__handshake_msg_id)
 
 
+	def __on_kernel_info(self, *info):
+		self.__kernel_info = info
+		self.__check_ready()
 
-	@property
-	def connection(self):
-		if self.__connection is None:
-			if os.path.exists(self.__connection_file_path):
-				try:
-					self.__connection = KernelConnection(kernel_path=self.__connection_file_path)
-				except InvalidConnectionFileError:
-					# Try again
-					pass
-		return self.__connection
+
+	def __on_status(self, parent_msg_id, busy):
+		if parent_msg_id in self.__handshake_msg_ids:
+			self.__iopub_ready = True
+			self.__check_ready()
 
 
+	def __check_ready(self):
+		if self.__ready_at is None  and  self.__kernel_info is not None  and  self.__iopub_ready:
+			self.__ready_at = clock()
+			self.__connection._remove_status_observer(self.__on_status)
+			self.__handshake_msg_ids.clear()
 
-import unittest, sys, os, time
+
+
+
+import unittest, sys, os, time, Queue
+from .output_budget import OutputBudget, REASON_MESSAGES
 
 class TestCase_kernel (unittest.TestCase):
 	@classmethod
@@ -837,8 +2179,7 @@ class TestCase_kernel (unittest.TestCase):
 		# Start the IPython kernel process
 		cls.krn_proc = IPythonKernelProcess(ipython_path=ipython_path)
 
-		while cls.krn_proc.connection is None:
-			time.sleep(0.1)
+		cls.krn_proc.wait_ready()
 
 		cls.krn = cls.krn_proc.connection
 
@@ -886,13 +2227,64 @@ class TestCase_kernel (unittest.TestCase):
 		return ListenerType(on_input, comm_manager=comm_manager)
 
 
+	def test_001_ready(self):
+		self.assertTrue(self.krn_proc.wait_ready(0))
+		self.assertEqual('python', self.krn_proc.kernel_info[3])
+		times = self.krn_proc.startup_times
+		self.assertGreaterEqual(times['handshakes'], 1)
+		self.assertAlmostEqual(times['total'], times['connection_file'] + times['spawn'] + times['handshake'])
+
+		ports = _allocate_tcp_ports('127.0.0.1', 5)
+		self.assertEqual(5, len(set(ports)))
+
+		# A kernel process that exits at once
+		krn_proc = IPythonKernelProcess(ipython_path='false')
+		try:
+			self.assertRaises(KernelStartupError, lambda: krn_proc.wait_ready(30.0))
+			self.assertEqual(None, krn_proc.startup_times['total'])
+		finally:
+			krn_proc.close()
+		self.assertNotIn(krn_proc, IPythonKernelProcess._IPythonKernelProcess__kernels)
+
+		# A kernel_info request made before the kernel is ready joins the handshake, and is still answered when
+		# the handshake is sent again
+		ipython_path = os.environ.get('IPYTHON_PATH', 'ipython')
+		krn_proc = IPythonKernelProcess(ipython_path=ipython_path, handshake_interval=0.001)
+		try:
+			info = []
+			krn_proc.connection.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+			self.assertTrue(krn_proc.wait_ready(30.0))
+			self.assertGreater(krn_proc.startup_times['handshakes'], 1)
+			t_end = time.time() + 30.0
+			while len(info) == 0  and  time.time() < t_end:
+				krn_proc.connection.poll(100)
+			self.assertEqual(1, len(info))
+			self.assertEqual('python', info[0][3])
+		finally:
+			krn_proc.close()
+
+
+	def test_002_unlistened_output_not_decoded(self):
+		# Output for a request that has no listener is dropped without decoding its content
+		session = self.krn.session
+		for msg_type, content in [('stream', {'name': 'stdout', 'text': 'hi\n'}),
+					  ('display_data', {'data': {}, 'metadata': {}}),
+					  ('execute_result', {'execution_count': 1, 'data': {}, 'metadata': {}}),
+					  ('error', {'ename': 'E', 'evalue': '', 'traceback': []}),
+					  ('execute_input', {'code': '', 'execution_count': 1})]:
+			msg, msg_id = session.build_msg(msg_type, content, parent={'msg_id': 'unknown', 'session': 'other'})
+			received = session.deserialize(session.serialize(msg)[1:])
+			getattr(self.krn, '_handle_msg_iopub_' + msg_type)([], received)
+			self.assertFalse(received.content_decoded, msg_type)
+
+
 	def test_010_krn_import_time(self):
 		ev = self._make_event_log_listener(EventLogKernelRequestListener)
 
 		code = 'import time, sys\n'
 
 		self.krn.execute_request(code, listener=ev)
-		while len(ev.events) < 4:
+		while len(ev.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev.events, [
@@ -900,6 +2292,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_input', code=code, execution_count=1),
 			krn_event('on_execute_ok', execution_count=1, payload=[], user_expressions={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -909,7 +2302,7 @@ class TestCase_kernel (unittest.TestCase):
 		code = 'time.sleep(0.1)\n'
 
 		self.krn.execute_request(code, listener=ev)
-		while len(ev.events) < 4:
+		while len(ev.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev.events, [
@@ -917,6 +2310,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_input', code=code, execution_count=2),
 			krn_event('on_execute_ok', execution_count=2, payload=[], user_expressions={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -926,7 +2320,7 @@ class TestCase_kernel (unittest.TestCase):
 		code = 'print "Hello world"\n'
 
 		self.krn.execute_request(code, listener=ev)
-		while len(ev.events) < 5:
+		while len(ev.events) < 6:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev.events, [
@@ -935,6 +2329,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_ok', execution_count=3, payload=[], user_expressions={}),
 			krn_event('on_stream', stream_name='stdout', text='Hello world\n'),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -944,7 +2339,7 @@ class TestCase_kernel (unittest.TestCase):
 		code = '3.141\n'
 
 		self.krn.execute_request(code, listener=ev)
-		while len(ev.events) < 5:
+		while len(ev.events) < 6:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev.events, [
@@ -953,6 +2348,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_ok', execution_count=4, payload=[], user_expressions={}),
 			krn_event('on_execute_result', execution_count=4, data={'text/plain': '3.141'}, metadata={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -962,7 +2358,7 @@ class TestCase_kernel (unittest.TestCase):
 		code = 'raise ValueError\n'
 
 		self.krn.execute_request(code, listener=ev)
-		while len(ev.events) < 5:
+		while len(ev.events) < 6:
 			self.krn.poll(-1)
 
 		tb = [u'---------------------------------------------------------------------------',
@@ -979,6 +2375,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_error', ename=u'ValueError', evalue=u'', traceback=tb),
 			krn_event('on_error', ename=u'ValueError', evalue=u'', traceback=tb_list),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -988,7 +2385,7 @@ class TestCase_kernel (unittest.TestCase):
 		code = 'print "Hello world"\n3.141\n'
 
 		self.krn.execute_request(code, listener=ev, store_history=False)
-		while len(ev.events) < 6:
+		while len(ev.events) < 7:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev.events, [
@@ -998,6 +2395,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_result', execution_count=6, data={'text/plain': '3.141'}, metadata={}),
 			krn_event('on_stream', stream_name='stdout', text='Hello world\n'),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -1007,7 +2405,7 @@ class TestCase_kernel (unittest.TestCase):
 		code = 'print "Hello world"\n3.141\n'
 
 		self.krn.execute_request(code, listener=ev, silent=True)
-		while len(ev.events) < 4:
+		while len(ev.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev.events, [
@@ -1015,6 +2413,7 @@ class TestCase_kernel (unittest.TestCase):
 			krn_event('on_execute_ok', execution_count=5, payload=[], user_expressions={}),
 			krn_event('on_stream', stream_name='stdout', text='Hello world\n'),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
@@ -1046,7 +2445,7 @@ received_comm.send({'text': 'Hi there'})
 """
 
 		self.krn.execute_request(code1, listener=ev_exec, store_history=False)
-		while len(ev_exec.events) < 4:
+		while len(ev_exec.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev_exec.events, [
@@ -1054,6 +2453,7 @@ received_comm.send({'text': 'Hi there'})
 			krn_event('on_execute_input', code=code1, execution_count=6),
 			krn_event('on_execute_ok', execution_count=5, payload=[], user_expressions={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 		ev_open_comm = self._make_event_log_listener(EventLogKernelRequestListener)
@@ -1064,19 +2464,20 @@ received_comm.send({'text': 'Hi there'})
 			received_messages.append((data, request_listener))
 		comm.on_message = on_comm_message
 
-		while len(ev_open_comm.events) < 3:
+		while len(ev_open_comm.events) < 4:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev_open_comm.events, [
 			krn_event('on_status', busy=True),
 			krn_event('on_stream', stream_name='stdout', text="mipy test opened {u'a': 1}\n"),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
 		ev_exec.clear()
 		self.krn.execute_request(code2, listener=ev_exec, store_history=False)
-		while len(ev_exec.events) < 4:
+		while len(ev_exec.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev_exec.events, [
@@ -1084,6 +2485,7 @@ received_comm.send({'text': 'Hi there'})
 			krn_event('on_execute_input', code=code2, execution_count=6),
 			krn_event('on_execute_ok', execution_count=5, payload=[], user_expressions={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 		self.assertEqual(received_messages, [({'text': 'Hi there'}, ev_exec)])
@@ -1133,7 +2535,7 @@ comm.send({'text': 'Hi there'})
 """
 
 		self.krn.execute_request(code1, listener=ev_exec, store_history=False)
-		while len(ev_exec.events) < 5:
+		while len(ev_exec.events) < 6:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev_exec.events, [
@@ -1142,6 +2544,7 @@ comm.send({'text': 'Hi there'})
 			krn_event('on_comm_open'),
 			krn_event('on_execute_ok', execution_count=5, payload=[], user_expressions={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 		self.assertEqual(1, len(open_comms))
@@ -1150,7 +2553,7 @@ comm.send({'text': 'Hi there'})
 
 		ev_exec.clear()
 		self.krn.execute_request(code2, listener=ev_exec, store_history=False)
-		while len(ev_exec.events) < 4:
+		while len(ev_exec.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev_exec.events, [
@@ -1158,13 +2561,376 @@ comm.send({'text': 'Hi there'})
 			krn_event('on_execute_input', code=code2, execution_count=6),
 			krn_event('on_execute_ok', execution_count=5, payload=[], user_expressions={}),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
 		self.assertEqual([({'text': 'Hi there'}, ev_exec)], received_messages)
 
 
-	def test_100_shutdown_during_execution(self):
+	def test_095_comm_binary_buffers(self):
+		manager = CommManager()
+
+		received_messages = []
+		def on_binary_message(comm, msg, buffers, request_listener):
+			received_messages.append((msg, buffers))
+
+		open_comms = []
+		def on_mipy_echo_opened(comm, data):
+			open_comms.append(comm)
+			comm.on_binary_message = on_binary_message
+
+		manager.register_comm_open_handler('mipy_echo', on_mipy_echo_opened)
+
+		ev_exec = self._make_event_log_listener(EventLogKernelRequestListener, comm_manager=manager)
+
+		code = """
+from IPython.kernel.comm.comm import Comm
+
+echo_comm = Comm(target_name='mipy_echo', data={})
+echo_comm.on_msg(lambda msg: echo_comm.send(msg['content']['data'], buffers=msg['buffers']))
+"""
+
+		self.krn.execute_request(code, listener=ev_exec, store_history=False)
+		while len(open_comms) == 0  or  len(ev_exec.events) < 5:
+			self.krn.poll(-1)
+
+		small = 'small buffer'
+		large = ''.join([chr(i % 256)   for i in xrange(128 * 1024)])
+		open_comms[0].send({'n': 2}, buffers=[small, memoryview(large)])
+		while len(received_messages) == 0:
+			self.krn.poll(-1)
+
+		msg, buffers = received_messages[0]
+		self.assertEqual({'n': 2}, msg)
+		self.assertEqual(2, len(buffers))
+		self.assertEqual(small, bytes(buffers[0]))
+		# Frames above the copy threshold are received without being copied
+		self.assertIsInstance(buffers[1], memoryview)
+		self.assertEqual(large, buffers[1].tobytes())
+
+		# Without a listener, the deadline of a comm message is met by its idle status
+		timed_out = []
+		open_comms[0].send({'n': 3}, timeout=5.0, on_timeout=timed_out.append)
+		while self.krn._next_deadline() is not None:
+			self.krn.poll(-1)
+		self.assertEqual([], timed_out)
+		self.assertEqual({'n': 3}, received_messages[1][0])
+
+
+	def test_096_execute_batch(self):
+		from .batch import STATUS_OK, STATUS_ERROR, STATUS_NOT_SENT, STATUS_TIMED_OUT
+		n_finished = self.krn.request_stats['finished']
+		n_live = self.krn.n_live_requests
+		cells = ['batch_x = {0}\nprint batch_x\n'.format(i)   for i in xrange(8)]
+		results = self.krn.execute_batch(cells, window=3, store_history=False)
+		# Finished requests are evicted
+		self.assertEqual(n_finished + 8, self.krn.request_stats['finished'])
+		self.assertEqual(n_live, self.krn.n_live_requests)
+		self.assertEqual(cells, [r.code   for r in results])
+		self.assertEqual([STATUS_OK] * 8, [r.status   for r in results])
+		self.assertEqual(['{0}\n'.format(i)   for i in xrange(8)], [r.stdout   for r in results])
+
+		results = self.krn.execute_batch(['1 + 1', 'raise ValueError', 'print 1', 'print 2', 'print 3'],
+						 window=1, stop_on_error=True, store_history=False)
+		self.assertEqual({'text/plain': '2'}, results[0].result)
+		self.assertEqual(STATUS_ERROR, results[1].status)
+		self.assertEqual('ValueError', results[1].error[0])
+		self.assertEqual([STATUS_NOT_SENT] * 3, [r.status   for r in results[2:]])
+
+		# A lost or slow reply does not hang the batch
+		results = self.krn.execute_batch(['import time\ntime.sleep(0.3)\n', 'pass', 'pass'], window=1,
+						 store_history=False, timeout=0.1)
+		self.assertEqual([STATUS_TIMED_OUT, STATUS_NOT_SENT, STATUS_NOT_SENT], [r.status   for r in results])
+		results = self.krn.execute_batch(['import time\ntime.sleep(0.3)\n', 'pass'], window=2,
+						 store_history=False, cell_timeout=0.1)
+		self.assertEqual([STATUS_TIMED_OUT, STATUS_TIMED_OUT], [r.status   for r in results])
+		self.assertEqual(n_live, self.krn.n_live_requests)
+
+
+	def test_097_request_ttl(self):
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path, request_ttl=0.1)
+		try:
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			krn.execute_request('import time\ntime.sleep(0.6)\n', listener=ev, store_history=False)
+			# No messages arrive while the kernel sleeps; the request expires regardless
+			t_end = time.time() + 5.0
+			while krn_event('on_request_expired') not in ev.events  and  time.time() < t_end:
+				krn.poll(-1)
+			self.assertEqual(krn_event('on_request_expired'), ev.events[-1])
+			self.assertEqual(0, krn.n_live_requests)
+			self.assertEqual(1, krn.request_stats['expired'])
+			self.assertEqual(None, krn._next_deadline())
+		finally:
+			krn.close()
+
+
+	def test_098_timeout(self):
+		ev1 = self._make_event_log_listener(EventLogKernelRequestListener)
+		t1 = time.time()
+		msg_id1 = self.krn.execute_request('import time\ntime.sleep(0.5)\n', listener=ev1, store_history=False,
+						   timeout=0.1)
+		try:
+			while True:
+				self.krn.poll(-1)
+		except RequestTimeoutError, e:
+			self.assertEqual(msg_id1, e.msg_id)
+		self.assertLess(time.time() - t1, 0.45)
+		self.assertEqual(None, ev1._source_msg_id)
+
+		# Queued behind the sleep, so also times out
+		timed_out = []
+		msg_id2 = self.krn.execute_request('pass\n', store_history=False, timeout=0.05, on_timeout=timed_out.append)
+		while len(timed_out) == 0:
+			self.krn.poll(-1)
+		self.assertEqual([msg_id2], timed_out)
+
+		ev3 = self._make_event_log_listener(EventLogKernelRequestListener)
+		self.krn.execute_request('pass\n', listener=ev3, store_history=False, timeout=30.0)
+		while krn_event('on_request_finished') not in ev3.events:
+			self.krn.poll(-1)
+		self.assertEqual(None, self.krn._next_deadline())
+
+
+	def test_099_coalesce_streams(self):
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path, coalesce_streams=True,
+				       coalesce_interval=None)
+		try:
+			# Make sure that the IOPUB subscription is in place before executing
+			info = []
+			krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+			while len(info) == 0:
+				krn.poll(-1)
+			time.sleep(0.2)
+
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			code = 'import sys\nfor i in range(200):\n\tprint i\n\tsys.stdout.flush()\n'
+			krn.execute_request(code, listener=ev, store_history=False)
+			while krn_event('on_request_finished') not in ev.events:
+				krn.poll(-1)
+
+			streams = [e   for e in ev.events   if e['event_name'] == 'on_stream']
+			self.assertEqual(''.join(['{0}\n'.format(i)   for i in xrange(200)]), ''.join([e['text']   for e in streams]))
+			self.assertLess(len(streams), 200)
+			# Text is delivered before the idle status
+			names = [e['event_name']   for e in ev.events]
+			self.assertLess(names.index('on_stream'), names.index('on_status', 1))
+		finally:
+			krn.close()
+
+
+	def test_100_output_budget(self):
+		ev = self._make_event_log_listener(EventLogKernelRequestListener)
+		code = 'import sys\nfor i in range(50):\n\tprint i\n\tsys.stdout.flush()\n'
+		self.krn.execute_request(code, listener=ev, store_history=False,
+					 output_budget=OutputBudget(max_messages=5))
+		while krn_event('on_request_finished') not in ev.events:
+			self.krn.poll(-1)
+
+		streams = [e   for e in ev.events   if e['event_name'] == 'on_stream']
+		self.assertEqual(5, len(streams))
+		self.assertEqual('0\n', streams[0]['text'])
+		names = [e['event_name']   for e in ev.events]
+		self.assertEqual(['on_output_suppressed', 'on_request_finished'], names[-2:])
+		self.assertEqual(45, ev.events[-2]['n_messages'])
+		self.assertEqual({'stream': 45}, ev.events[-2]['msg_types'])
+		self.assertEqual(REASON_MESSAGES, ev.events[-2]['reason'])
+
+		# Interrupt a cell that would otherwise never finish
+		ev = self._make_event_log_listener(EventLogKernelRequestListener)
+		code = 'import sys, time\nwhile True:\n\tprint "x"\n\tsys.stdout.flush()\n\ttime.sleep(0.01)\n'
+		self.krn.execute_request(code, listener=ev, store_history=False,
+					 output_budget=OutputBudget(max_messages=3, interrupt=True), timeout=30.0)
+		while krn_event('on_request_finished') not in ev.events:
+			self.krn.poll(-1)
+		errors = [e   for e in ev.events   if e['event_name'] == 'on_execute_error']
+		self.assertEqual('KeyboardInterrupt', errors[0]['ename'])
+		self.assertEqual(3, len([e   for e in ev.events   if e['event_name'] == 'on_stream']))
+
+		# Output from requests made by another front end is not charged against a connection's budget
+		watcher = KernelConnection(kernel_path=self.krn_proc.connection_file_path,
+					   output_budget=OutputBudget(max_messages=3, interrupt=True))
+		try:
+			# Once a request has finished the watcher's IOPUB subscription is in place
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			watcher.execute_request('pass', listener=ev, store_history=False)
+			while krn_event('on_request_finished') not in ev.events:
+				watcher.poll(-1)
+
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			code = 'import sys, time\nfor i in range(10):\n\tprint i\n\tsys.stdout.flush()\n\ttime.sleep(0.01)\n'
+			self.krn.execute_request(code, listener=ev, store_history=False)
+			while krn_event('on_request_finished') not in ev.events:
+				self.krn.poll(0.01)
+				watcher.poll(0)
+			watcher.poll(0.1)
+			self.assertEqual(0, len([e   for e in ev.events   if e['event_name'] == 'on_execute_error']))
+			self.assertEqual(10, len([e   for e in ev.events   if e['event_name'] == 'on_stream']))
+			self.assertEqual(0, watcher.output_stats['suppressed_messages'])
+		finally:
+			watcher.close()
+
+
+	def test_101_reconnect(self):
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path)
+		try:
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			krn.execute_request('import time\ntime.sleep(0.1)\n', listener=ev, store_history=False)
+
+			old_shell = krn.shell
+			session = krn.session
+			info = []
+			krn.reconnect(on_ready=lambda *args: info.append(args), timeout=30.0)
+			self.assertIsNot(old_shell, krn.shell)
+			self.assertIs(session, krn.session)
+			# The listener of the request in flight is kept
+			self.assertEqual(1, krn.n_live_requests)
+			while len(info) == 0:
+				krn.poll(-1)
+			self.assertEqual('python', info[0][3])
+
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			krn.execute_request('1 + 1\n', listener=ev, store_history=False)
+			while 'on_execute_ok' not in [e['event_name']   for e in ev.events]:
+				krn.poll(-1)
+		finally:
+			krn.close()
+
+
+	def test_102_metrics(self):
+		from .metrics import MetricsRegistry
+		registry = MetricsRegistry()
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path, metrics=registry)
+		try:
+			info = []
+			krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+			while len(info) == 0:
+				krn.poll(-1)
+
+			snapshot = registry.snapshot()
+			counters = snapshot['counters']
+			histograms = snapshot['histograms']
+			self.assertEqual({'msg_type=kernel_info_request': 1}, counters['messages_sent_total'])
+			self.assertEqual(1, counters['messages_received_total']['socket=shell,msg_type=kernel_info_reply'])
+			self.assertGreater(counters['bytes_sent_total'][''], 0)
+			self.assertGreater(counters['bytes_received_total'][''], 0)
+			self.assertEqual(1, histograms['reply_latency_seconds']['msg_type=kernel_info_request']['count'])
+			self.assertEqual(1, histograms['sign_seconds']['']['count'])
+			self.assertGreaterEqual(histograms['deserialize_seconds']['']['count'], 1)
+			self.assertEqual(1, histograms['handle_seconds']['socket=shell,msg_type=kernel_info_reply']['count'])
+			self.assertIn('mipy_reply_latency_seconds_count{msg_type="kernel_info_request"} 1\n',
+				      registry.to_prometheus())
+		finally:
+			krn.close()
+
+		# Comm messages get no reply, so they are not timed and do not crowd out the requests that do
+		from .stub_kernel import StubKernel
+		stub = StubKernel()
+		registry = MetricsRegistry()
+		krn = stub.connect(metrics=registry)
+		try:
+			comm = krn.open_comm('echo')
+			for i in xrange(_MAX_TIMED_REQUESTS + 100):
+				comm.send({'i': i})
+			info = []
+			krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args), cached=False)
+			while len(info) == 0:
+				krn.poll(-1)
+			latency = registry.snapshot()['histograms']['reply_latency_seconds']
+			self.assertEqual(['msg_type=kernel_info_request'], latency.keys())
+			self.assertEqual(1, latency['msg_type=kernel_info_request']['count'])
+		finally:
+			krn.close()
+			stub.close()
+
+
+	def test_103_tracing(self):
+		tracer = Tracer()
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path, tracer=tracer)
+		try:
+			# Make sure that the IOPUB subscription is in place before executing
+			info = []
+			krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+			while len(info) == 0:
+				krn.poll(-1)
+			time.sleep(0.2)
+			tracer.clear()
+
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			msg_id = krn.execute_request('print 1', listener=ev, store_history=False)
+			while krn_event('on_request_finished') not in ev.events:
+				krn.poll(-1)
+
+			tid = [e['tid']   for e in tracer.events   if e['ph'] == 'M'  and  e['args']['name'].endswith(msg_id)][0]
+			spans = [e['name']   for e in tracer.events   if e['ph'] == 'X'  and  e['tid'] == tid]
+			self.assertEqual(['send', 'queued', 'start', 'run', 'execute_request'], spans)
+			self.assertEqual(['stream'], [e['name']   for e in tracer.events   if e.get('cat') == 'output'])
+			dispatched = set([e['name']   for e in tracer.events   if e.get('cat') == 'dispatch'])
+			self.assertTrue(set(['shell.execute_reply', 'iopub.status', 'iopub.stream']).issubset(dispatched))
+			self.assertEqual(0, tracer.n_pending)
+		finally:
+			krn.close()
+
+
+	def test_104_cancel_request(self):
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path)
+		try:
+			execution_counts = []
+			krn._add_execute_reply_observer(lambda parent_msg_id, execution_count: execution_counts.append(execution_count))
+			idle = []
+			krn.on_status = lambda parent_msg_id, busy: idle.append(parent_msg_id)   if not busy   else None
+
+			ev = self._make_event_log_listener(EventLogKernelRequestListener)
+			msg_id = krn.complete_request('import o', 8, listener=ev)
+			krn.cancel_request(msg_id)
+			self.assertEqual(0, krn.n_live_requests)
+			krn.execute_request('x = 1', listener=self._make_event_log_listener(EventLogKernelRequestListener),
+					    store_history=False)
+			while msg_id not in idle  or  len(execution_counts) == 0:
+				krn.poll(-1)
+			self.assertEqual([], ev.events)
+			self.assertEqual(1, len(execution_counts))
+		finally:
+			krn.close()
+
+
+	def test_105_coalesce_requests(self):
+		from .metrics import MetricsRegistry
+		registry = MetricsRegistry()
+		krn = KernelConnection(kernel_path=self.krn_proc.connection_file_path, metrics=registry)
+		try:
+			info = []
+			ports = []
+			history = []
+			info_ids = [krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args))   for i in xrange(3)]
+			connect_ids = [krn.connect_request(on_connect=lambda *args: ports.append(args))   for i in xrange(2)]
+			history_ids = [krn.history_request_tail(n=1, on_history=history.append)   for i in xrange(2)]
+			history_ids.append(krn.history_request_tail(n=2, on_history=history.append))
+			self.assertEqual(1, len(set(info_ids)))
+			self.assertEqual(1, len(set(connect_ids)))
+			self.assertEqual(history_ids[0], history_ids[1])
+			self.assertNotEqual(history_ids[0], history_ids[2])
+			while len(info) < 3  or  len(ports) < 2  or  len(history) < 3:
+				krn.poll(-1)
+			self.assertEqual(1, len(set(info)))
+
+			# Answered from the cache, on the next poll
+			self.assertEqual(info_ids[0], krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args)))
+			self.assertEqual(3, len(info))
+			krn.poll(0)
+			self.assertEqual(4, len(info))
+			self.assertNotEqual(info_ids[0], krn.kernel_info_request(cached=False))
+
+			counters = registry.snapshot()['counters']
+			self.assertEqual({'msg_type=kernel_info_request': 2, 'msg_type=connect_request': 1,
+					  'msg_type=history_request': 2}, counters['messages_sent_total'])
+			self.assertEqual({'msg_type=kernel_info_request': 3, 'msg_type=connect_request': 1,
+					  'msg_type=history_request': 1}, counters['requests_coalesced_total'])
+		finally:
+			krn.close()
+
+
+	def test_110_shutdown_during_execution(self):
 		ev_exec1 = self._make_event_log_listener(EventLogKernelRequestListener)
 		ev_exec2 = self._make_event_log_listener(EventLogKernelRequestListener)
 
@@ -1174,7 +2940,7 @@ comm.send({'text': 'Hi there'})
 		self.krn.execute_request(code1, listener=ev_exec1, store_history=False)
 		self.krn.execute_request(code2, listener=ev_exec2, store_history=False)
 
-		while len(ev_exec1.events) < 4:
+		while len(ev_exec1.events) < 5:
 			self.krn.poll(-1)
 
 		self.assertEventListsEqual(ev_exec1.events, [
@@ -1183,15 +2949,171 @@ comm.send({'text': 'Hi there'})
 			krn_event('on_execute_ok', execution_count=5, payload=[], user_expressions={}),
 			krn_event('on_stream', stream_name='stdout', text='1\n'),
 			krn_event('on_status', busy=False),
+			krn_event('on_request_finished'),
 			])
 
 
 
+class TestCase_kernel_io_thread (unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		ipython_path = os.environ.get('IPYTHON_PATH', 'ipython')
+
+		cls.krn_proc = IPythonKernelProcess(ipython_path=ipython_path)
+
+		cls.krn_proc.wait_ready()
+
+		cls.krn = KernelConnection(kernel_path=cls.krn_proc.connection_file_path, io_thread=True)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.krn.close()
+		cls.krn = None
+		cls.krn_proc.close()
+
+
+	def test_010_execute(self):
+		ev = EventLogKernelRequestListener(lambda prompt: 'test_input')
+
+		code = 'print raw_input()\n'
+
+		self.krn.execute_request(code, listener=ev)
+		while len(ev.events) < 7:
+			self.krn.poll(-1)
+
+		self.assertEqual(set(['on_status', 'on_execute_input', 'on_input_request', 'on_stream', 'on_execute_ok',
+				      'on_request_finished']),
+				 set([e['event_name']   for e in ev.events]))
+		self.assertIn(krn_event('on_stream', stream_name='stdout', text='test_input\n'), ev.events)
+
+
+
+class TestCase_kernel_io_executor (unittest.TestCase):
+	class _SingleThreadExecutor (object):
+		def __init__(self):
+			self.__queue = Queue.Queue()
+			self.__thread = threading.Thread(target=self.__run)
+			self.__thread.daemon = True
+			self.__thread.start()
+
+		def submit(self, fn, *args):
+			self.__queue.put((fn, args))
+
+		def shutdown(self):
+			self.__queue.put(None)
+			self.__thread.join()
+
+		def __run(self):
+			while True:
+				item = self.__queue.get()
+				if item is None:
+					return
+				item[0](*item[1])
+
+
+	def test_concurrent_requests(self):
+		from .stub_kernel import StubKernel
+		stub = StubKernel()
+		executor = self._SingleThreadExecutor()
+		krn = stub.connect(io_thread=True, io_executor=executor)
+		try:
+			info = []
+			krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+			t_end = time.time() + 10.0
+			while len(info) == 0  and  time.time() < t_end:
+				time.sleep(0.01)
+			# IOPUB is a slow joiner
+			time.sleep(0.2)
+
+			# Requests made from several threads while replies are dispatched on the executor thread; a reply
+			# that overtook the registration of its request would leave its listener unfinished
+			listeners = []
+			def make_requests():
+				for i in xrange(25):
+					ev = EventLogKernelRequestListener(lambda prompt: '')
+					listeners.append(ev)
+					krn.execute_request('pass', listener=ev, store_history=False, timeout=30.0)
+			threads = [threading.Thread(target=make_requests)   for i in xrange(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+			finished = lambda: len([ev   for ev in listeners   if krn_event('on_request_finished') in ev.events])
+			t_end = time.time() + 10.0
+			while finished() < 100  and  time.time() < t_end:
+				krn.poll(10)
+			self.assertEqual(100, finished())
+			self.assertEqual(0, krn.n_live_requests)
+			self.assertEqual(None, krn._next_deadline())
+		finally:
+			krn.close()
+			executor.shutdown()
+			stub.close()
+
+
+
+class TestCase_kernel_heartbeat (unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		ipython_path = os.environ.get('IPYTHON_PATH', 'ipython')
+
+		cls.krn_proc = IPythonKernelProcess(ipython_path=ipython_path)
+
+		# Wait for the kernel to start, so that it is not declared dead before it answers its first ping
+		cls.krn_proc.wait_ready()
+
+		cls.krn = KernelConnection(kernel_path=cls.krn_proc.connection_file_path, heartbeat_interval=0.1,
+					   heartbeat_max_misses=3)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.krn.close()
+		cls.krn = None
+		cls.krn_proc.close()
+
+
+	def test_010_alive(self):
+		from .heartbeat import STATE_ALIVE
+		deadline = time.time() + 10.0
+		while self.krn.kernel_state != STATE_ALIVE  and  time.time() < deadline:
+			self.krn.poll(100)
+		self.assertEqual(STATE_ALIVE, self.krn.kernel_state)
+		self.assertGreater(self.krn.heartbeat_stats['replies'], 0)
+		self.assertGreaterEqual(self.krn.heartbeat_stats['last_rtt'], 0.0)
+
+
+	def test_020_kernel_dead(self):
+		from .heartbeat import STATE_DEAD
+		ev = EventLogKernelRequestListener(lambda prompt: '')
+		msg_id = self.krn.execute_request('import time\ntime.sleep(30)\n', listener=ev)
+		info_msg_id = self.krn.kernel_info_request(on_kernel_info=lambda *args: None)
+		# Being busy does not stop the kernel answering heartbeats
+		t_end = time.time() + 0.5
+		while time.time() < t_end:
+			self.krn.poll(50)
+		self.assertNotEqual(STATE_DEAD, self.krn.kernel_state)
+
+		failed = []
+		self.krn.on_kernel_dead = failed.append
+		self.krn_proc.close()
+		deadline = time.time() + 10.0
+		while len(failed) == 0  and  time.time() < deadline:
+			self.krn.poll(100)
+
+		self.assertEqual(STATE_DEAD, self.krn.kernel_state)
+		self.assertEqual([[msg_id, info_msg_id]], failed)
+		self.assertEqual(krn_event('on_kernel_dead'), ev.events[-1])
+		self.assertEqual(0, self.krn.n_live_requests)
+
+
+
 def test_poll_speed():
 	krn_proc = IPythonKernelProcess()
 
-	while krn_proc.connection is None:
-		time.sleep(0.1)
+	krn_proc.wait_ready()
 
 	krn = krn_proc.connection
 
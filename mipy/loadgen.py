@@ -0,0 +1,525 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+'''
+Load generator; drives a mix of requests over many kernel connections and reports throughput, latency,
+and the CPU time and memory used by the client
+
+Usage: python -m mipy.loadgen [--kernel stub|ipython] [--kernels K] [--connections M] [--rate R]
+	[--duration S] [--mix execute=70,complete=20,inspect=5,comm=5] [--json FILE]
+
+With --rate, requests are issued open loop at the target rate, spread round robin over the connections; an
+arrival that finds every connection at --max-in-flight is dropped, and the lag between when a request was
+due and when it was sent shows how far the client is falling behind. Without --rate, every connection is
+kept at --max-in-flight requests (closed loop), which finds the most the client and kernels can sustain.
+'''
+
+import os, sys, json, time, random, tempfile, subprocess
+
+from .util import clock
+from .metrics import process_cpu_seconds, process_rss_bytes, LatencyHistogram
+from .hub import KernelHub
+from .kernel import KernelConnection, IPythonKernelProcess, InvalidConnectionFileError
+from .request_listener import KernelRequestListener
+
+
+
+KINDS = ('execute', 'complete', 'inspect', 'comm')
+
+DEFAULT_MIX = {'execute': 70, 'complete': 20, 'inspect': 5, 'comm': 5}
+
+# The comm target opened on each connection for comm traffic
+COMM_TARGET = 'mipy_loadgen'
+
+
+
+def parse_mix(text):
+	'''
+	Parse a request mix
+
+	:param text: comma separated kind=weight pairs, e.g. 'execute=70,complete=30'
+	:return: a dictionary mapping request kind to weight
+	'''
+	mix = {}
+	for item in text.split(','):
+		item = item.strip()
+		if item == '':
+			continue
+		kind, sep, weight = item.partition('=')
+		kind = kind.strip()
+		if kind not in KINDS:
+			raise ValueError, 'unknown request kind {0}; expected one of {1}'.format(kind, ', '.join(KINDS))
+		try:
+			weight = float(weight)   if sep   else 1.0
+		except ValueError:
+			raise ValueError, 'invalid weight for {0}: {1}'.format(kind, weight)
+		if weight < 0:
+			raise ValueError, 'weight for {0} must not be negative'.format(kind)
+		mix[kind] = weight
+	if sum(mix.values()) <= 0:
+		raise ValueError, 'the request mix must have a positive weight'
+	return mix
+
+
+
+class _LoadRequest (KernelRequestListener):
+	def __init__(self, generator, slot, kind, due, sent):
+		super(_LoadRequest, self).__init__()
+		self.generator = generator
+		self.slot = slot
+		self.kind = kind
+		self.due = due
+		self.sent = sent
+		self.error = False
+		self.done = False
+
+	def on_execute_error(self, ename, evalue, traceback):
+		self.error = True
+
+	def on_execute_abort(self):
+		self.error = True
+
+	def on_complete_error(self, ename, evalue, traceback):
+		self.error = True
+
+	def on_inspect_error(self, ename, evalue, traceback):
+		self.error = True
+
+	def on_kernel_dead(self):
+		self.error = True
+		self.generator._request_done(self, False)
+
+	def on_request_expired(self):
+		self.generator._request_done(self, True)
+
+	def on_request_finished(self):
+		self.generator._request_done(self, False)
+
+
+
+class _Slot (object):
+	'''
+	A connection and the requests in flight on it
+	'''
+	def __init__(self, connection):
+		self.connection = connection
+		self.comm = None
+		self.in_flight = 0
+
+
+
+class LoadGenerator (object):
+	'''
+	    Issues a mix of execute, complete, inspect and comm requests over a set of kernel connections
+
+	    The connections are serviced by a KernelHub from the calling thread. Comm traffic goes to a comm
+	    opened on each connection with the target name COMM_TARGET; a comm message counts as complete once
+	    the kernel reports idle after handling it, whether or not the kernel has a handler for the target.
+	    '''
+
+	def __init__(self, connections, mix=None, rate=None, max_in_flight=1, code='pass', timeout=30.0, seed=0):
+		'''
+		Load generator constructor
+
+		:param connections: a list of KernelConnections; they must not use background I/O threads
+		:param mix: None for DEFAULT_MIX, or a dictionary mapping request kind to weight
+		:param rate: None to keep every connection at max_in_flight requests, or the total number of
+			requests to issue per second
+		:param max_in_flight: the most requests in flight on each connection at once
+		:param code: the code sent in execute requests, and completed and inspected by complete and inspect
+			requests
+		:param timeout: the time in seconds after which a request is counted as timed out
+		:param seed: seed for the random choice of request kind
+		'''
+		mix = mix   if mix is not None   else DEFAULT_MIX
+		self.__kinds = [kind   for kind in KINDS   if mix.get(kind, 0) > 0]
+		total = float(sum([mix[kind]   for kind in self.__kinds]))
+		self.__cumulative = []
+		acc = 0.0
+		for kind in self.__kinds:
+			acc += mix[kind] / total
+			self.__cumulative.append(acc)
+		self.__mix = dict([(kind, mix[kind])   for kind in self.__kinds])
+		self.__rate = rate
+		self.__max_in_flight = max_in_flight
+		self.__code = code
+		self.__timeout = timeout
+		self.__random = random.Random(seed)
+
+		self.__hub = KernelHub()
+		self.__slots = []
+		for connection in connections:
+			self.__hub.add(connection)
+			self.__slots.append(_Slot(connection))
+		self.__next_slot = 0
+		self.__in_flight = 0
+		self.__reset_stats()
+
+
+	def __reset_stats(self):
+		self.__latency = dict([(kind, LatencyHistogram())   for kind in self.__kinds])
+		self.__lag = LatencyHistogram()
+		self.__completed = dict([(kind, 0)   for kind in self.__kinds])
+		self.__errors = dict([(kind, 0)   for kind in self.__kinds])
+		self.__timeouts = dict([(kind, 0)   for kind in self.__kinds])
+		self.__n_sent = 0
+		self.__n_dropped = 0
+
+
+	@property
+	def in_flight(self):
+		return self.__in_flight
+
+
+	def run(self, duration, warmup=0.0, drain_timeout=10.0):
+		'''
+		Generate load
+
+		:param duration: the time in seconds for which to issue requests
+		:param warmup: the time in seconds for which to issue requests before measuring
+		:param drain_timeout: the longest time in seconds to wait for requests in flight to complete once
+			the duration has passed
+		:return: a report; a JSON serializable dictionary
+		'''
+		for slot in self.__slots:
+			if slot.comm is None  and  'comm' in self.__kinds:
+				slot.comm = slot.connection.open_comm(COMM_TARGET)
+
+		if warmup > 0:
+			self.__generate(warmup)
+			self.__drain(drain_timeout)
+			self.__reset_stats()
+
+		cpu0 = process_cpu_seconds()
+		t0 = clock()
+		self.__generate(duration)
+		issue_time = clock() - t0
+		self.__drain(drain_timeout)
+		elapsed = clock() - t0
+		cpu1 = process_cpu_seconds()
+
+		return self.__report(issue_time, elapsed, cpu1 - cpu0   if cpu0 is not None  and  cpu1 is not None   else None)
+
+
+	def __generate(self, duration):
+		start = clock()
+		end = start + duration
+		interval = 1.0 / self.__rate   if self.__rate   else None
+		next_due = start
+		now = start
+		while now < end:
+			if interval is not None:
+				while next_due <= now:
+					if not self.__issue(next_due):
+						# Every connection is at max_in_flight; the client or the kernels cannot keep up
+						self.__n_dropped += 1
+					next_due += interval
+				timeout = min(next_due, end) - now
+			else:
+				while self.__issue(now):
+					pass
+				timeout = end - now
+			self.__hub.poll(max(int(timeout * 1000.0), 0))
+			now = clock()
+
+
+	def __drain(self, drain_timeout):
+		deadline = clock() + drain_timeout
+		while self.__in_flight > 0  and  clock() < deadline:
+			self.__hub.poll(100)
+
+
+	def __choose_slot(self):
+		n = len(self.__slots)
+		for i in xrange(n):
+			slot = self.__slots[(self.__next_slot + i) % n]
+			if slot.in_flight < self.__max_in_flight  and  slot.connection.is_open():
+				self.__next_slot = (self.__next_slot + i + 1) % n
+				return slot
+		return None
+
+
+	def __choose_kind(self):
+		x = self.__random.random()
+		for kind, threshold in zip(self.__kinds, self.__cumulative):
+			if x < threshold:
+				return kind
+		return self.__kinds[-1]
+
+
+	def __issue(self, due):
+		'''
+		Issue one request
+
+		:param due: the time at which the request should be sent
+		:return: False if every connection already has max_in_flight requests in flight
+		'''
+		slot = self.__choose_slot()
+		if slot is None:
+			return False
+		kind = self.__choose_kind()
+		connection = slot.connection
+		sent = clock()
+		request = _LoadRequest(self, slot, kind, due, sent)
+		on_timeout = lambda msg_id: self._request_done(request, True)
+		code = self.__code
+		if kind == 'execute':
+			connection.execute_request(code, store_history=False, listener=request, timeout=self.__timeout,
+						   on_timeout=on_timeout)
+		elif kind == 'complete':
+			connection.complete_request(code, len(code), listener=request, timeout=self.__timeout,
+						    on_timeout=on_timeout)
+		elif kind == 'inspect':
+			connection.inspect_request(code, len(code), listener=request, timeout=self.__timeout,
+						   on_timeout=on_timeout)
+		else:
+			slot.comm.send({'due': due}, listener=request)
+		slot.in_flight += 1
+		self.__in_flight += 1
+		self.__n_sent += 1
+		self.__lag.record(max(sent - due, 0.0))
+		return True
+
+
+	def _request_done(self, request, timed_out):
+		if request.done:
+			return
+		request.done = True
+		request.slot.in_flight -= 1
+		self.__in_flight -= 1
+		kind = request.kind
+		if timed_out:
+			self.__timeouts[kind] += 1
+		elif request.error:
+			self.__errors[kind] += 1
+		else:
+			self.__completed[kind] += 1
+			self.__latency[kind].record(clock() - request.sent)
+
+
+	def __report(self, issue_time, elapsed, cpu_seconds):
+		def ms(x):
+			return x * 1.0e3   if x is not None   else None
+		def latency(histogram):
+			return {'count': histogram.count, 'mean_ms': ms(histogram.total / histogram.count)   if histogram.count   else None,
+				'p50_ms': ms(histogram.percentile(50.0)), 'p90_ms': ms(histogram.percentile(90.0)),
+				'p99_ms': ms(histogram.percentile(99.0)), 'p999_ms': ms(histogram.percentile(99.9)),
+				'max_ms': ms(histogram.max)}
+
+		completed = sum(self.__completed.values())
+		kinds = {}
+		for kind in self.__kinds:
+			kinds[kind] = {'completed': self.__completed[kind], 'errors': self.__errors[kind],
+				       'timeouts': self.__timeouts[kind],
+				       'throughput': self.__completed[kind] / elapsed   if elapsed > 0   else None,
+				       'latency': latency(self.__latency[kind])}
+		return {'connections': len(self.__slots), 'mix': self.__mix, 'target_rate': self.__rate,
+			'max_in_flight': self.__max_in_flight, 'duration': issue_time, 'elapsed': elapsed,
+			'sent': self.__n_sent, 'completed': completed, 'dropped': self.__n_dropped,
+			'unfinished': self.__in_flight,
+			'throughput': completed / elapsed   if elapsed > 0   else None,
+			'send_lag': latency(self.__lag), 'kinds': kinds,
+			'client_cpu_seconds': cpu_seconds,
+			'client_cpu_utilisation': cpu_seconds / elapsed   if cpu_seconds is not None  and  elapsed > 0   else None,
+			'client_rss_bytes': process_rss_bytes()}
+
+
+
+def format_report(report):
+	'''
+	:return: a report from LoadGenerator.run() as human readable text
+	'''
+	def fmt(x, spec='{0:.2f}'):
+		return spec.format(x)   if x is not None   else '-'
+
+	lines = ['connections {0}, target rate {1}, max in flight {2}'.format(
+			report['connections'], fmt(report['target_rate'], '{0:.1f}/s')   if report['target_rate']   else 'unlimited',
+			report['max_in_flight']),
+		 'sent {0}, completed {1}, dropped {2}, unfinished {3} in {4}s'.format(
+			report['sent'], report['completed'], report['dropped'], report['unfinished'], fmt(report['elapsed'])),
+		 'throughput {0}/s; client CPU {1}s ({2}), RSS {3} MB'.format(
+			fmt(report['throughput'], '{0:.1f}'), fmt(report['client_cpu_seconds']),
+			fmt(report['client_cpu_utilisation'], '{0:.0%}'),
+			fmt(report['client_rss_bytes'] / 1.0e6   if report['client_rss_bytes'] is not None   else None, '{0:.1f}')),
+		 '',
+		 '{0:<10} {1:>9} {2:>6} {3:>8} {4:>10} {5:>9} {6:>9} {7:>9} {8:>9}'.format(
+			'kind', 'completed', 'errors', 'timeouts', 'rate/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+	rows = [(kind, report['kinds'][kind])   for kind in KINDS   if kind in report['kinds']]
+	rows.append(('send lag', None))
+	for kind, stats in rows:
+		if stats is not None:
+			latency = stats['latency']
+			counts = (stats['completed'], stats['errors'], stats['timeouts'], fmt(stats['throughput'], '{0:.1f}'))
+		else:
+			latency = report['send_lag']
+			counts = ('', '', '', '')
+		lines.append('{0:<10} {1:>9} {2:>6} {3:>8} {4:>10} {5:>9} {6:>9} {7:>9} {8:>9}'.format(
+			kind, counts[0], counts[1], counts[2], counts[3], fmt(latency['p50_ms'], '{0:.3f}'),
+			fmt(latency['p90_ms'], '{0:.3f}'), fmt(latency['p99_ms'], '{0:.3f}'), fmt(latency['max_ms'], '{0:.3f}')))
+	return '\n'.join(lines)
+
+
+
+def _wait_for_connection(connection_file_path, proc, timeout=60.0):
+	'''
+	Connect to a stub kernel subprocess once it has written its connection file
+	'''
+	deadline = clock() + timeout
+	while True:
+		if proc.poll() is not None:
+			raise RuntimeError, 'kernel process exited with status {0}'.format(proc.returncode)
+		if os.path.exists(connection_file_path):
+			try:
+				return KernelConnection(kernel_path=connection_file_path)
+			except InvalidConnectionFileError:
+				pass
+		if clock() > deadline:
+			raise RuntimeError, 'kernel did not write its connection file {0}'.format(connection_file_path)
+		time.sleep(0.05)
+
+
+def _await_ready(connections, timeout=60.0):
+	'''
+	Wait until every connection has had a reply to a kernel_info request, and give IOPUB subscriptions time
+	to reach the kernels
+	'''
+	hub = KernelHub()
+	ready = []
+	for connection in connections:
+		hub.add(connection)
+		connection.kernel_info_request(on_kernel_info=lambda *args: ready.append(True))
+	deadline = clock() + timeout
+	while len(ready) < len(connections):
+		if clock() > deadline:
+			raise RuntimeError, 'kernels did not answer kernel_info requests within {0}s'.format(timeout)
+		hub.poll(100)
+	for connection in connections:
+		hub.remove(connection)
+	time.sleep(0.2)
+
+
+def main(argv=None):
+	import argparse
+	parser = argparse.ArgumentParser(prog='python -m mipy.loadgen', description='Drive load over many kernel connections')
+	parser.add_argument('--kernel', choices=['stub', 'ipython'], default='stub',
+			    help='spawn stub kernels (python -m mipy.stub_kernel) or IPython kernels')
+	parser.add_argument('--connection-file', action='append', default=[],
+			    help='connect to an existing kernel instead of spawning one; may be repeated')
+	parser.add_argument('--ipython-path', default=os.environ.get('IPYTHON_PATH', 'ipython'))
+	parser.add_argument('--kernels', type=int, default=1, help='number of kernels to spawn')
+	parser.add_argument('--connections', type=int, default=4,
+			    help='number of connections, spread round robin over the kernels')
+	parser.add_argument('--rate', type=float, default=None,
+			    help='total requests per second; if omitted, connections are kept busy (closed loop)')
+	parser.add_argument('--max-in-flight', type=int, default=1, help='most requests in flight per connection')
+	parser.add_argument('--duration', type=float, default=10.0, help='seconds for which to generate load')
+	parser.add_argument('--warmup', type=float, default=1.0, help='seconds of load before measuring')
+	parser.add_argument('--mix', default='execute=70,complete=20,inspect=5,comm=5',
+			    help='request mix as kind=weight pairs; kinds are ' + ', '.join(KINDS))
+	parser.add_argument('--code', default='pass', help='code to execute, complete and inspect')
+	parser.add_argument('--timeout', type=float, default=30.0, help='request timeout in seconds')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--json', help='file to which the report is written as JSON')
+	args = parser.parse_args(argv)
+
+	try:
+		mix = parse_mix(args.mix)
+	except ValueError, e:
+		parser.error(str(e))
+
+	stub_procs = []
+	ipython_procs = []
+	connections = []
+	try:
+		if len(args.connection_file) > 0:
+			kernels = [(path, None)   for path in args.connection_file]
+		elif args.kernel == 'stub':
+			kernels = []
+			for i in xrange(args.kernels):
+				handle, path = tempfile.mkstemp(suffix='.json', prefix='stub_kernel')
+				os.close(handle)
+				os.remove(path)
+				proc = subprocess.Popen([sys.executable, '-m', 'mipy.stub_kernel', path])
+				stub_procs.append(proc)
+				kernels.append((path, proc))
+		else:
+			kernels = []
+			for i in xrange(args.kernels):
+				ipython_procs.append(IPythonKernelProcess(ipython_path=args.ipython_path))
+			# The kernels start in parallel
+			for ipython_proc in ipython_procs:
+				if not ipython_proc.wait_ready(60.0):
+					raise RuntimeError, 'kernel did not become ready within 60s'
+				kernels.append((ipython_proc.connection_file_path, None))
+
+		for i in xrange(args.connections):
+			path, proc = kernels[i % len(kernels)]
+			if proc is not None:
+				connections.append(_wait_for_connection(path, proc))
+			else:
+				connections.append(KernelConnection(kernel_path=path))
+		_await_ready(connections)
+
+		generator = LoadGenerator(connections, mix=mix, rate=args.rate, max_in_flight=args.max_in_flight,
+					  code=args.code, timeout=args.timeout, seed=args.seed)
+		report = generator.run(args.duration, warmup=args.warmup)
+		report['kernels'] = len(kernels)
+		report['kernel'] = 'existing'   if len(args.connection_file) > 0   else args.kernel
+
+		print format_report(report)
+		if args.json is not None:
+			with open(args.json, 'w') as f:
+				json.dump(report, f, indent=2, sort_keys=True)
+	finally:
+		for connection in connections:
+			connection.close()
+		for proc in stub_procs:
+			if proc.poll() is None:
+				proc.terminate()
+				proc.wait()
+		for ipython_proc in ipython_procs:
+			ipython_proc.close()
+
+
+if __name__ == '__main__':
+	main()
+
+
+
+
+import unittest
+
+class TestCase_loadgen (unittest.TestCase):
+	def test_parse_mix(self):
+		self.assertEqual({'execute': 3.0, 'comm': 1.0}, parse_mix('execute=3, comm'))
+		self.assertRaises(ValueError, lambda: parse_mix('evaluate=1'))
+		self.assertRaises(ValueError, lambda: parse_mix('execute=0'))
+
+
+	def test_generate(self):
+		from .stub_kernel import StubKernel
+		kernel = StubKernel()
+		connections = []
+		try:
+			connections = [kernel.connect()   for i in xrange(2)]
+			_await_ready(connections)
+			generator = LoadGenerator(connections, mix={'execute': 1, 'complete': 1, 'inspect': 1, 'comm': 1},
+						  rate=200.0, max_in_flight=2)
+			report = generator.run(0.5)
+			self.assertEqual(0, generator.in_flight)
+			self.assertEqual(report['sent'], report['completed'])
+			for kind in KINDS:
+				stats = report['kinds'][kind]
+				self.assertGreater(stats['completed'], 0)
+				self.assertEqual((0, 0), (stats['errors'], stats['timeouts']))
+				self.assertIsNotNone(stats['latency']['p99_ms'])
+			self.assertIn('send lag', format_report(report))
+			json.dumps(report)
+		finally:
+			for connection in connections:
+				connection.close()
+			kernel.close()
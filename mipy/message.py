@@ -0,0 +1,147 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+
+_UNDECODED = object()
+
+
+
+class Message (object):
+	'''
+	    A received message
+
+	    The header and parent header are decoded up front, as they are needed to route the message. The metadata
+	    and content are decoded on first access, so messages that are discarded without being examined never
+	    have their (potentially large) content parsed.
+
+	    Supports the dict style access used throughout mipy, e.g. msg['content'], msg['parent_header'], as
+	    well as attribute access, e.g. msg.content.
+	    '''
+	__slots__ = ('header', 'parent_header', 'buffers', '_unpack', '_metadata', '_content',
+		     '_metadata_frame', '_content_frame')
+
+	_KEYS = ('header', 'msg_id', 'msg_type', 'parent_header', 'metadata', 'content', 'buffers')
+
+
+	def __init__(self, unpack, header_frame, parent_header_frame, metadata_frame, content_frame, buffers):
+		'''
+		Message constructor
+
+		:param unpack: function that decodes a frame into message data
+		:param header_frame: serialized header
+		:param parent_header_frame: serialized parent header
+		:param metadata_frame: serialized metadata
+		:param content_frame: serialized content
+		:param buffers: list of binary buffers that accompanied the message
+		'''
+		self._unpack = unpack
+		self.header = unpack(header_frame)
+		self.parent_header = unpack(parent_header_frame)
+		self.buffers = buffers
+		self._metadata = _UNDECODED
+		self._content = _UNDECODED
+		self._metadata_frame = metadata_frame
+		self._content_frame = content_frame
+
+
+	@property
+	def msg_id(self):
+		return self.header['msg_id']
+
+	@property
+	def msg_type(self):
+		return self.header['msg_type']
+
+	@property
+	def metadata(self):
+		if self._metadata is _UNDECODED:
+			self._metadata = self._unpack(self._metadata_frame)
+			self._metadata_frame = None
+		return self._metadata
+
+	@property
+	def content(self):
+		if self._content is _UNDECODED:
+			self._content = self._unpack(self._content_frame)
+			self._content_frame = None
+		return self._content
+
+	@property
+	def content_decoded(self):
+		'''
+		:return: True if the content has been decoded
+		'''
+		return self._content is not _UNDECODED
+
+	@property
+	def content_size(self):
+		'''
+		:return: the size of the serialized content in bytes, or None if it has already been decoded and discarded
+		'''
+		return len(self._content_frame)   if self._content_frame is not None   else None
+
+
+	def __getitem__(self, key):
+		if key in self._KEYS:
+			return getattr(self, key)
+		raise KeyError, key
+
+	def get(self, key, default=None):
+		if key in self._KEYS:
+			return getattr(self, key)
+		return default
+
+	def __contains__(self, key):
+		return key in self._KEYS
+
+	def keys(self):
+		return list(self._KEYS)
+
+	def to_dict(self):
+		'''
+		:return: the message as a dict, decoding everything
+		'''
+		return dict([(key, getattr(self, key))   for key in self._KEYS])
+
+
+	def __repr__(self):
+		return '<Message {0} {1}>'.format(self.msg_type, self.msg_id)
+
+
+
+
+import unittest
+
+class TestCase_message (unittest.TestCase):
+	def test_lazy_decode(self):
+		from .session import Session
+
+		session = Session('key')
+		unpacked = []
+		unpack = session._unpack
+		def counting_unpack(x):
+			unpacked.append(x)
+			return unpack(x)
+		session._unpack = counting_unpack
+
+		msg, msg_id = session.build_msg('stream', {'name': 'stdout', 'text': 'hi\n'}, parent={'msg_id': 'abc'})
+		frames = session.serialize(msg)
+		received = session.deserialize(frames[1:])
+
+		self.assertEqual(2, len(unpacked))
+		self.assertEqual(msg_id, received['msg_id'])
+		self.assertEqual('stream', received.msg_type)
+		self.assertEqual('abc', received['parent_header'].get('msg_id'))
+		self.assertFalse(received.content_decoded)
+
+		self.assertEqual({'name': 'stdout', 'text': 'hi\n'}, received['content'])
+		self.assertTrue(received.content_decoded)
+		self.assertEqual(3, len(unpacked))
+		received.content
+		self.assertEqual(3, len(unpacked))
+		self.assertEqual({}, received.get('metadata'))
+		self.assertEqual(None, received.get('nonexistent'))
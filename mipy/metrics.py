@@ -0,0 +1,393 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import os, sys
+
+from .util import clock
+
+
+# The bucket boundaries, in seconds, at which histograms are exported in Prometheus text format
+PROMETHEUS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+		      0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+
+class LatencyHistogram (object):
+	'''
+	    A histogram of durations with log-linear buckets, in the style of HdrHistogram
+
+	    Values are counted in ticks of `resolution` seconds. Below 2**sub_bucket_bits ticks every value has its
+	    own bucket; above that, each power of two is divided into 2**sub_bucket_bits buckets, so the relative
+	    error of a reported value is at most 2**-sub_bucket_bits. Recording a value costs a few integer
+	    operations and a dictionary update; buckets are only allocated once used.
+	    '''
+	__slots__ = ('resolution', 'sub_bucket_bits', 'count', 'total', 'min', 'max', 'buckets')
+
+	def __init__(self, resolution=1e-7, sub_bucket_bits=5):
+		'''
+		Latency histogram constructor
+
+		:param resolution: the duration in seconds of one tick
+		:param sub_bucket_bits: the number of bits of precision kept for each value
+		'''
+		self.resolution = resolution
+		self.sub_bucket_bits = sub_bucket_bits
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+		self.buckets = {}
+
+
+	def record(self, value):
+		'''
+		Record a duration
+
+		:param value: the duration in seconds; negative durations, caused by the clock stepping backwards,
+			are recorded as zero
+		'''
+		if value < 0.0:
+			value = 0.0
+		self.count += 1
+		self.total += value
+		if self.min is None  or  value < self.min:
+			self.min = value
+		if self.max is None  or  value > self.max:
+			self.max = value
+
+		ticks = int(value / self.resolution)
+		bits = self.sub_bucket_bits
+		if ticks < (1 << bits):
+			index = ticks
+		else:
+			shift = ticks.bit_length() - bits - 1
+			index = (shift << bits) + (ticks >> shift)
+		self.buckets[index] = self.buckets.get(index, 0) + 1
+
+
+	def bucket_upper_bound(self, index):
+		'''
+		:param index: a bucket index
+		:return: the exclusive upper bound in seconds of the values counted in the bucket
+		'''
+		bits = self.sub_bucket_bits
+		if index < (1 << (bits + 1)):
+			return (index + 1) * self.resolution
+		shift = (index >> bits) - 1
+		top = index - (shift << bits)
+		return ((top + 1) << shift) * self.resolution
+
+
+	def percentile(self, q):
+		'''
+		:param q: the percentile, from 0 to 100
+		:return: an upper bound on the q'th percentile of the recorded values in seconds, or None if empty
+		'''
+		if self.count == 0:
+			return None
+		threshold = self.count * q / 100.0
+		seen = 0
+		for index in sorted(self.buckets.keys()):
+			seen += self.buckets[index]
+			if seen >= threshold:
+				return min(self.bucket_upper_bound(index), self.max)
+		return self.max
+
+
+	def cumulative_counts(self, bounds):
+		'''
+		:param bounds: a sorted sequence of durations in seconds
+		:return: a list giving, for each bound, the number of recorded values whose bucket lies entirely
+			at or below it
+		'''
+		counts = []
+		items = sorted(self.buckets.items())
+		pos = 0
+		seen = 0
+		for bound in bounds:
+			while pos < len(items)  and  self.bucket_upper_bound(items[pos][0]) <= bound:
+				seen += items[pos][1]
+				pos += 1
+			counts.append(seen)
+		return counts
+
+
+	def summary(self):
+		'''
+		:return: a dictionary of count, sum, min, max, mean, p50, p90, p99 and p999
+		'''
+		return {'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max,
+			'mean': self.total / self.count   if self.count > 0   else None,
+			'p50': self.percentile(50.0), 'p90': self.percentile(90.0), 'p99': self.percentile(99.0),
+			'p999': self.percentile(99.9)}
+
+
+
+class Counter (object):
+	'''
+	A counter metric; one value per combination of label values
+	'''
+	__slots__ = ('name', 'help', 'label_names', 'values')
+
+	def __init__(self, name, help, label_names):
+		self.name = name
+		self.help = help
+		self.label_names = label_names
+		self.values = {}
+
+
+	def inc(self, labels=(), amount=1):
+		'''
+		:param labels: tuple of label values, in the order of label_names
+		:param amount: the amount to add
+		'''
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+
+
+class Histogram (object):
+	'''
+	A histogram metric; one LatencyHistogram per combination of label values
+	'''
+	__slots__ = ('name', 'help', 'label_names', 'series')
+
+	def __init__(self, name, help, label_names):
+		self.name = name
+		self.help = help
+		self.label_names = label_names
+		self.series = {}
+
+
+	def observe(self, value, labels=()):
+		'''
+		:param value: a duration in seconds
+		:param labels: tuple of label values, in the order of label_names
+		'''
+		histogram = self.series.get(labels)
+		if histogram is None:
+			histogram = LatencyHistogram()
+			self.series[labels] = histogram
+		histogram.record(value)
+
+
+
+def process_cpu_seconds():
+	'''
+	:return: the user plus system CPU time consumed by this process in seconds, or None if unavailable
+	'''
+	try:
+		times = os.times()
+	except (AttributeError, OSError):
+		return None
+	return times[0] + times[1]
+
+
+def process_rss_bytes():
+	'''
+	:return: the resident set size of this process in bytes, or None if it cannot be determined
+	'''
+	try:
+		with open('/proc/self/statm', 'r') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError, AttributeError):
+		pass
+	try:
+		import resource
+	except ImportError:
+		return None
+	# Peak rather than current; on Linux in kilobytes, on OS X in bytes
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak   if sys.platform == 'darwin'   else peak * 1024
+
+
+
+class MetricsRegistry (object):
+	'''
+	    A set of counters and latency histograms
+
+	    Pass a registry to KernelConnection (one registry may be shared by many connections) to have the
+	    connection, its session and its message routers record message counts, bytes sent and received,
+	    time spent serializing, deserializing, signing and verifying messages, time spent in message handlers,
+	    and the latency between sending a request and receiving its reply.
+
+	    Updates are not locked, to keep them cheap. snapshot() and to_prometheus() may be called from any
+	    thread. In io_thread mode incoming messages are decoded on the I/O thread, so if several such
+	    connections share a registry, concurrent updates of the decoding metrics may occasionally lose a count.
+	    '''
+
+	def __init__(self, prefix='mipy_'):
+		'''
+		Metrics registry constructor
+
+		:param prefix: prefix prepended to metric names when exporting
+		'''
+		self.prefix = prefix
+		self.__metrics = {}
+
+
+	def counter(self, name, help='', label_names=()):
+		'''
+		Get a counter, creating it if necessary
+
+		:param name: the metric name, without the prefix
+		:param help: description
+		:param label_names: tuple of label names
+		:return: the Counter
+		'''
+		return self.__get(Counter, name, help, label_names)
+
+	def histogram(self, name, help='', label_names=()):
+		'''
+		Get a histogram, creating it if necessary
+
+		:param name: the metric name, without the prefix
+		:param help: description
+		:param label_names: tuple of label names
+		:return: the Histogram
+		'''
+		return self.__get(Histogram, name, help, label_names)
+
+
+	def reset(self):
+		'''
+		Discard all recorded values, keeping the metrics themselves
+		'''
+		for metric in self.__metrics.values():
+			if isinstance(metric, Counter):
+				metric.values = {}
+			else:
+				metric.series = {}
+
+
+	def snapshot(self):
+		'''
+		:return: a dictionary of the form {'counters': {name: {labels: value}},
+			'histograms': {name: {labels: summary}}}, where labels is a string of the form 'a=x,b=y' and
+			summary is a dictionary as returned by LatencyHistogram.summary()
+		'''
+		counters = {}
+		histograms = {}
+		for name, metric in self.__metrics.items():
+			if isinstance(metric, Counter):
+				counters[name] = dict([(_label_string(metric.label_names, labels), value)
+						       for labels, value in metric.values.items()])
+			else:
+				histograms[name] = dict([(_label_string(metric.label_names, labels), histogram.summary())
+							 for labels, histogram in metric.series.items()])
+		return {'counters': counters, 'histograms': histograms}
+
+
+	def to_prometheus(self):
+		'''
+		:return: the metrics in the Prometheus text exposition format
+		'''
+		lines = []
+		for name, metric in sorted(self.__metrics.items()):
+			full_name = self.prefix + name
+			if metric.help:
+				lines.append('# HELP {0} {1}'.format(full_name, metric.help))
+			if isinstance(metric, Counter):
+				lines.append('# TYPE {0} counter'.format(full_name))
+				for labels, value in sorted(metric.values.items()):
+					lines.append('{0}{1} {2}'.format(full_name, _prometheus_labels(metric.label_names, labels),
+									 value))
+			else:
+				lines.append('# TYPE {0} histogram'.format(full_name))
+				for labels, histogram in sorted(metric.series.items()):
+					counts = histogram.cumulative_counts(PROMETHEUS_BUCKETS)
+					for bound, count in zip(PROMETHEUS_BUCKETS, counts):
+						lines.append('{0}_bucket{1} {2}'.format(full_name, _prometheus_labels(
+							metric.label_names + ('le',), labels + (repr(bound),)), count))
+					lines.append('{0}_bucket{1} {2}'.format(full_name, _prometheus_labels(
+						metric.label_names + ('le',), labels + ('+Inf',)), histogram.count))
+					lines.append('{0}_sum{1} {2!r}'.format(full_name, _prometheus_labels(metric.label_names, labels),
+									      histogram.total))
+					lines.append('{0}_count{1} {2}'.format(full_name, _prometheus_labels(metric.label_names, labels),
+									       histogram.count))
+		return '\n'.join(lines) + '\n'
+
+
+	def __get(self, metric_type, name, help, label_names):
+		metric = self.__metrics.get(name)
+		if metric is None:
+			metric = metric_type(name, help, tuple(label_names))
+			self.__metrics[name] = metric
+		elif not isinstance(metric, metric_type)  or  metric.label_names != tuple(label_names):
+			raise ValueError, 'Metric {0} already exists with a different type or labels'.format(name)
+		return metric
+
+
+
+def _label_string(label_names, labels):
+	return ','.join(['{0}={1}'.format(n, v)   for n, v in zip(label_names, labels)])
+
+def _prometheus_labels(label_names, labels):
+	if len(label_names) == 0:
+		return ''
+	return '{' + ','.join(['{0}="{1}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+			       for n, v in zip(label_names, labels)]) + '}'
+
+
+
+
+import unittest
+
+class TestCase_metrics (unittest.TestCase):
+	def test_histogram(self):
+		h = LatencyHistogram(resolution=1.0, sub_bucket_bits=2)
+		for v in xrange(1, 101):
+			h.record(float(v))
+		self.assertEqual((100, 5050.0, 1.0, 100.0), (h.count, h.total, h.min, h.max))
+		# Bucket bounds are within 25% of the values for 2 bits of precision
+		for p, expected in [(50.0, 50.0), (90.0, 90.0), (99.0, 99.0)]:
+			actual = h.percentile(p)
+			self.assertTrue(expected <= actual <= expected * 1.25, (p, actual))
+		self.assertEqual(100.0, h.percentile(100.0))
+		self.assertEqual([0, 6, 100], h.cumulative_counts([0.5, 7.0, 1000.0]))
+
+		# Every value falls in a bucket whose bounds contain it
+		h = LatencyHistogram(resolution=1.0, sub_bucket_bits=3)
+		for v in xrange(0, 5000, 7):
+			h.buckets = {}
+			h.record(float(v))
+			index = h.buckets.keys()[0]
+			self.assertTrue(v < h.bucket_upper_bound(index), v)
+			self.assertTrue(index == 0  or  h.bucket_upper_bound(index - 1) <= v, v)
+
+		# A negative duration is recorded as zero
+		h = LatencyHistogram(resolution=1.0, sub_bucket_bits=2)
+		h.record(-3.0)
+		self.assertEqual((1, 0.0, 0.0, 0.0), (h.count, h.total, h.min, h.max))
+		self.assertEqual({0: 1}, h.buckets)
+
+
+	def test_registry(self):
+		registry = MetricsRegistry()
+		sent = registry.counter('messages_sent_total', 'Messages sent', ('msg_type',))
+		self.assertIs(sent, registry.counter('messages_sent_total', 'Messages sent', ('msg_type',)))
+		self.assertRaises(ValueError, lambda: registry.histogram('messages_sent_total'))
+		sent.inc(('execute_request',))
+		sent.inc(('execute_request',))
+		sent.inc(('kernel_info_request',), 3)
+		latency = registry.histogram('reply_latency_seconds', 'Request to reply latency', ('msg_type',))
+		latency.observe(0.002, ('execute_request',))
+
+		snapshot = registry.snapshot()
+		self.assertEqual({'msg_type=execute_request': 2, 'msg_type=kernel_info_request': 3},
+				 snapshot['counters']['messages_sent_total'])
+		self.assertEqual(1, snapshot['histograms']['reply_latency_seconds']['msg_type=execute_request']['count'])
+
+		text = registry.to_prometheus()
+		self.assertIn('# TYPE mipy_messages_sent_total counter\n', text)
+		self.assertIn('mipy_messages_sent_total{msg_type="kernel_info_request"} 3\n', text)
+		self.assertIn('mipy_reply_latency_seconds_bucket{msg_type="execute_request",le="0.001"} 0\n', text)
+		self.assertIn('mipy_reply_latency_seconds_bucket{msg_type="execute_request",le="0.0025"} 1\n', text)
+		self.assertIn('mipy_reply_latency_seconds_bucket{msg_type="execute_request",le="+Inf"} 1\n', text)
+		self.assertIn('mipy_reply_latency_seconds_count{msg_type="execute_request"} 1\n', text)
+
+		registry.reset()
+		self.assertEqual({}, registry.snapshot()['counters']['messages_sent_total'])
@@ -0,0 +1,188 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import time
+
+
+
+# The IOPUB message types that count towards an output budget; status, error, execute_input and comm messages
+# are always delivered
+BUDGETED_MSG_TYPES = frozenset(['stream', 'display_data', 'update_display_data', 'execute_result', 'pyout',
+				'clear_output'])
+
+
+REASON_BYTES = 'bytes'
+REASON_MESSAGES = 'messages'
+REASON_RATE = 'rate'
+
+
+
+class OutputBudget (object):
+	'''
+	    Limits on the output that a request, or a whole connection, may deliver
+
+	    Once max_bytes or max_messages is used up, all further output is suppressed. The rate limit is a token
+	    bucket; output arriving faster than `rate` messages per second, after an initial burst of `burst`
+	    messages, is suppressed until the bucket refills.
+	    '''
+
+	def __init__(self, max_bytes=None, max_messages=None, rate=None, burst=None, interrupt=False):
+		'''
+		Output budget constructor
+
+		:param max_bytes: None, or the total size in bytes of the serialized content and buffers of the output
+			messages that may be delivered
+		:param max_messages: None, or the number of output messages that may be delivered
+		:param rate: None, or the sustained rate in messages per second at which output may be delivered
+		:param burst: (rate limited mode) the number of messages that may be delivered at once; defaults to rate
+		:param interrupt: if True, interrupt the kernel once max_bytes or max_messages is used up
+		'''
+		if rate is not None  and  rate <= 0:
+			raise ValueError, 'rate must be positive'
+		self.max_bytes = max_bytes
+		self.max_messages = max_messages
+		self.rate = rate
+		self.burst = max(burst   if burst is not None   else rate, 1)   if rate is not None   else None
+		self.interrupt = interrupt
+
+
+
+class OutputMeter (object):
+	'''
+	Tracks the use of an OutputBudget
+	'''
+	def __init__(self, budget, clock=time.time):
+		'''
+		Output meter constructor
+
+		:param budget: the OutputBudget
+		:param clock: function returning the current time in seconds
+		'''
+		self.budget = budget
+		self.__clock = clock
+		self.n_bytes = 0
+		self.n_messages = 0
+		# Set to REASON_BYTES or REASON_MESSAGES once the budget is used up
+		self.exhausted = None
+		# Set by the owner once it has acted on the budget's interrupt option
+		self.interrupted = False
+		self.__tokens = float(budget.burst)   if budget.rate is not None   else None
+		self.__last_refill = clock()   if budget.rate is not None   else None
+
+
+	def check(self, size):
+		'''
+		Determine if a message may be delivered, without charging it
+
+		:param size: the size of the message in bytes
+		:return: None if the message may be delivered, otherwise the reason for suppressing it
+		'''
+		if self.exhausted is not None:
+			return self.exhausted
+		budget = self.budget
+		if budget.max_messages is not None  and  self.n_messages + 1 > budget.max_messages:
+			self.exhausted = REASON_MESSAGES
+			return REASON_MESSAGES
+		if budget.max_bytes is not None  and  self.n_bytes + size > budget.max_bytes:
+			self.exhausted = REASON_BYTES
+			return REASON_BYTES
+		if budget.rate is not None:
+			now = self.__clock()
+			self.__tokens = min(self.__tokens + (now - self.__last_refill) * budget.rate, float(budget.burst))
+			self.__last_refill = now
+			if self.__tokens < 1.0:
+				return REASON_RATE
+		return None
+
+
+	def charge(self, size):
+		'''
+		Charge a message that check() allowed against the budget
+
+		:param size: the size of the message in bytes
+		'''
+		self.n_messages += 1
+		self.n_bytes += size
+		if self.__tokens is not None:
+			self.__tokens -= 1.0
+
+
+
+class SuppressedOutput (object):
+	'''
+	A summary of the output suppressed for a request
+
+	Attributes:
+	n_messages: the number of messages suppressed
+	n_bytes: their total size in bytes
+	msg_types: dictionary mapping message type to the number of messages of that type suppressed
+	reason: the reason the first message was suppressed; REASON_BYTES, REASON_MESSAGES or REASON_RATE
+	connection: True if the first message was suppressed by the connection's budget rather than the request's
+	'''
+	def __init__(self, reason, connection):
+		self.n_messages = 0
+		self.n_bytes = 0
+		self.msg_types = {}
+		self.reason = reason
+		self.connection = connection
+
+
+	def add(self, msg_type, size):
+		self.n_messages += 1
+		self.n_bytes += size
+		self.msg_types[msg_type] = self.msg_types.get(msg_type, 0) + 1
+
+
+	def __repr__(self):
+		return '<SuppressedOutput {0} messages, {1} bytes, reason={2}>'.format(self.n_messages, self.n_bytes,
+											 self.reason)
+
+
+
+
+import unittest
+
+class TestCase_output_budget (unittest.TestCase):
+	def __deliver(self, meter, size):
+		reason = meter.check(size)
+		if reason is None:
+			meter.charge(size)
+		return reason
+
+
+	def test_limits(self):
+		meter = OutputMeter(OutputBudget(max_bytes=100, max_messages=3))
+		self.assertEqual(None, self.__deliver(meter, 60))
+		self.assertEqual(REASON_BYTES, self.__deliver(meter, 60))
+		# Once used up, everything is suppressed
+		self.assertEqual(REASON_BYTES, self.__deliver(meter, 1))
+		self.assertEqual((1, 60), (meter.n_messages, meter.n_bytes))
+
+		meter = OutputMeter(OutputBudget(max_messages=2))
+		self.assertEqual([None, None, REASON_MESSAGES], [self.__deliver(meter, 10)   for i in xrange(3)])
+		self.assertEqual(REASON_MESSAGES, meter.exhausted)
+
+
+	def test_rate(self):
+		now = [0.0]
+		meter = OutputMeter(OutputBudget(rate=10.0, burst=3), clock=lambda: now[0])
+		self.assertEqual([None, None, None, REASON_RATE], [self.__deliver(meter, 1)   for i in xrange(4)])
+		now[0] = 0.25
+		self.assertEqual([None, None, REASON_RATE], [self.__deliver(meter, 1)   for i in xrange(3)])
+		self.assertEqual(None, meter.exhausted)
+		# The bucket holds no more than the burst
+		now[0] = 100.0
+		self.assertEqual([None, None, None, REASON_RATE], [self.__deliver(meter, 1)   for i in xrange(4)])
+
+
+	def test_suppressed(self):
+		suppressed = SuppressedOutput(REASON_RATE, False)
+		suppressed.add('stream', 10)
+		suppressed.add('stream', 5)
+		suppressed.add('display_data', 100)
+		self.assertEqual((3, 115), (suppressed.n_messages, suppressed.n_bytes))
+		self.assertEqual({'stream': 2, 'display_data': 1}, suppressed.msg_types)
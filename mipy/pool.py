@@ -0,0 +1,315 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import threading, time, traceback, sys
+
+from .kernel import IPythonKernelProcess
+from .request_listener import KernelRequestListener
+
+
+
+RESET_NAMESPACE = 'namespace'
+RESET_RESTART = 'restart'
+
+
+
+class KernelPoolClosedError (Exception):
+	pass
+
+class KernelPoolTimeoutError (Exception):
+	pass
+
+
+
+class _ResetListener (KernelRequestListener):
+	def __init__(self):
+		super(_ResetListener, self).__init__()
+		self.done = False
+		self.ok = False
+
+	def on_execute_ok(self, execution_count, payload, user_expressions):
+		self.done = True
+		self.ok = True
+
+	def on_execute_error(self, ename, evalue, traceback):
+		self.done = True
+
+	def on_execute_abort(self):
+		self.done = True
+
+
+
+class KernelPool (object):
+	'''
+	    A pool of warm IPython kernels
+
+	    Kernels are spawned and connected in a background thread, so that checking out a kernel does not
+	    incur the cost of starting an IPython kernel process and waiting for it to answer.
+
+	    Usage:
+	    krn = pool.checkout()
+	    try:
+		krn.execute_request(...)
+	    finally:
+		pool.checkin(krn)
+
+	    Note that a connection that has been checked out should only be used by the thread that checked it out.
+	    '''
+
+	def __init__(self, size=2, max_size=None, reset=RESET_NAMESPACE, ipython_path='ipython', startup_timeout=30.0):
+		'''
+		Kernel pool constructor
+
+		:param size: the number of idle kernels to keep warm
+		:param max_size: the maximum number of kernels (idle, checked out or starting) that the pool will
+			own at any one time; None for no limit
+		:param reset: the default reset strategy applied when a kernel is checked in; either RESET_NAMESPACE
+			(run %reset in the kernel) or RESET_RESTART (discard the kernel and start a new one)
+		:param ipython_path: path of the ipython executable used to spawn kernels
+		:param startup_timeout: time in seconds to wait for a newly spawned kernel to answer a kernel_info request
+		'''
+		if size < 0:
+			raise ValueError, 'size must be >= 0'
+		if max_size is not None  and  max_size < size:
+			raise ValueError, 'max_size must be >= size'
+		if reset not in (RESET_NAMESPACE, RESET_RESTART):
+			raise ValueError, 'Unknown reset strategy {0}'.format(reset)
+
+		self.size = size
+		self.max_size = max_size
+		self.reset = reset
+		self.startup_timeout = startup_timeout
+		self.__ipython_path = ipython_path
+
+		self.__lock = threading.Lock()
+		self.__cond = threading.Condition(self.__lock)
+
+		# Idle kernel processes, ready to be checked out
+		self.__idle = []
+		# Maps connection to kernel process for kernels that are checked out
+		self.__checked_out = {}
+		# Number of kernels that are currently being spawned
+		self.__n_starting = 0
+		# Number of checkouts waiting for a kernel
+		self.__n_waiting = 0
+		self.__open = True
+
+		self.__replenish_thread = threading.Thread(target=self.__replenish_loop, name='mipy-kernel-pool')
+		self.__replenish_thread.daemon = True
+		self.__replenish_thread.start()
+
+
+	@property
+	def n_idle(self):
+		with self.__lock:
+			return len(self.__idle)
+
+	@property
+	def n_checked_out(self):
+		with self.__lock:
+			return len(self.__checked_out)
+
+	@property
+	def n_starting(self):
+		with self.__lock:
+			return self.__n_starting
+
+
+	def checkout(self, timeout=None):
+		'''
+		Check out a kernel connection
+
+		:param timeout: time in seconds to wait for a kernel to become available; None to wait indefinitely
+		:return: a KernelConnection
+		'''
+		deadline = time.time() + timeout   if timeout is not None   else None
+		with self.__lock:
+			self.__n_waiting += 1
+			try:
+				while True:
+					if not self.__open:
+						raise KernelPoolClosedError
+					if len(self.__idle) > 0:
+						krn_proc = self.__idle.pop(0)
+						connection = krn_proc.connection
+						self.__checked_out[connection] = krn_proc
+						# Wake the replenish thread so that it can top up the idle kernels
+						self.__cond.notify_all()
+						return connection
+					self.__cond.notify_all()
+					if deadline is not None:
+						remaining = deadline - time.time()
+						if remaining <= 0.0:
+							raise KernelPoolTimeoutError, 'No kernel became available within {0}s'.format(timeout)
+						self.__cond.wait(remaining)
+					else:
+						self.__cond.wait()
+			finally:
+				self.__n_waiting -= 1
+
+
+	def checkin(self, connection, reset=None, reset_timeout=10.0):
+		'''
+		Return a kernel connection to the pool
+
+		:param connection: a KernelConnection acquired using checkout()
+		:param reset: the reset strategy to apply (RESET_NAMESPACE or RESET_RESTART); None to use the pool default
+		:param reset_timeout: time in seconds to wait for a namespace reset to complete; if the reset does not
+			complete in time the kernel is discarded and replaced
+		:return: None
+		'''
+		if reset is None:
+			reset = self.reset
+		if reset not in (RESET_NAMESPACE, RESET_RESTART):
+			raise ValueError, 'Unknown reset strategy {0}'.format(reset)
+
+		with self.__lock:
+			krn_proc = self.__checked_out.pop(connection)
+
+		reusable = False
+		if reset == RESET_NAMESPACE  and  self.__open  and  connection.is_open():
+			reusable = self.__reset_namespace(connection, reset_timeout)
+
+		with self.__lock:
+			if reusable  and  self.__open:
+				self.__idle.append(krn_proc)
+				krn_proc = None
+			self.__cond.notify_all()
+
+		if krn_proc is not None:
+			krn_proc.close()
+
+
+	def close(self):
+		'''
+		Shut down the pool, closing all idle kernels
+
+		Kernels that are checked out are closed when they are checked in.
+		:return: None
+		'''
+		with self.__lock:
+			if not self.__open:
+				return
+			self.__open = False
+			idle = self.__idle[:]
+			del self.__idle[:]
+			self.__cond.notify_all()
+
+		for krn_proc in idle:
+			krn_proc.close()
+		self.__replenish_thread.join()
+
+
+	def __reset_namespace(self, connection, reset_timeout):
+		listener = _ResetListener()
+		connection.execute_request('%reset -f', silent=True, store_history=False, listener=listener)
+		deadline = time.time() + reset_timeout
+		while not listener.done:
+			remaining = deadline - time.time()
+			if remaining <= 0.0:
+				break
+			connection.poll(int(remaining * 1000.0) + 1)
+		listener.detach()
+		return listener.ok
+
+
+	def __n_wanted(self):
+		# Number of additional kernels that the replenish thread should start
+		n_total = len(self.__idle) + len(self.__checked_out) + self.__n_starting
+		wanted = max(self.size, self.__n_waiting) - (len(self.__idle) + self.__n_starting)
+		if self.max_size is not None:
+			wanted = min(wanted, self.max_size - n_total)
+		return max(wanted, 0)
+
+
+	def __replenish_loop(self):
+		while True:
+			with self.__lock:
+				while self.__open  and  self.__n_wanted() == 0:
+					self.__cond.wait()
+				if not self.__open:
+					return
+				self.__n_starting += 1
+
+			krn_proc = None
+			try:
+				krn_proc = self.__start_kernel()
+			except:
+				type, value, tb = sys.exc_info()
+				print 'WARNING: {0}:{1} exception while starting pooled kernel'.format(type, value)
+				traceback.print_tb(tb)
+
+			with self.__lock:
+				self.__n_starting -= 1
+				if krn_proc is not None  and  self.__open:
+					self.__idle.append(krn_proc)
+					krn_proc = None
+				self.__cond.notify_all()
+
+			if krn_proc is not None:
+				krn_proc.close()
+
+
+	def __start_kernel(self):
+		krn_proc = IPythonKernelProcess(ipython_path=self.__ipython_path)
+		deadline = time.time() + self.startup_timeout
+		try:
+			# Wait in short steps, so that closing the pool is noticed
+			while not krn_proc.wait_ready(0.1):
+				if time.time() > deadline  or  not self.__open:
+					raise KernelPoolTimeoutError, 'Kernel did not start within {0}s'.format(self.startup_timeout)
+		except:
+			krn_proc.close()
+			raise
+		return krn_proc
+
+
+
+
+import unittest, os
+from .request_listener import EventLogKernelRequestListener
+
+class TestCase_pool (unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		ipython_path = os.environ.get('IPYTHON_PATH', 'ipython')
+		cls.pool = KernelPool(size=1, max_size=2, ipython_path=ipython_path)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.pool.close()
+
+
+	def _execute(self, krn, code):
+		ev = EventLogKernelRequestListener(lambda prompt: '')
+		krn.execute_request(code, listener=ev)
+		while not any([e['event_name'] in ('on_execute_ok', 'on_execute_error')   for e in ev.events]):
+			krn.poll(-1)
+		ev.detach()
+		return ev.events
+
+
+	def test_010_checkout_reset_checkin(self):
+		krn = self.pool.checkout(timeout=30.0)
+		events = self._execute(krn, 'pool_test_var = 1\n')
+		self.assertIn('on_execute_ok', [e['event_name']   for e in events])
+		self.pool.checkin(krn)
+
+		krn = self.pool.checkout(timeout=30.0)
+		events = self._execute(krn, 'pool_test_var\n')
+		self.assertIn('on_execute_error', [e['event_name']   for e in events])
+		self.pool.checkin(krn, reset=RESET_RESTART)
+
+		self.assertEqual(0, self.pool.n_checked_out)
+
+
+	def test_020_max_size(self):
+		a = self.pool.checkout(timeout=30.0)
+		b = self.pool.checkout(timeout=30.0)
+		self.assertRaises(KernelPoolTimeoutError, lambda: self.pool.checkout(timeout=0.5))
+		self.pool.checkin(a)
+		self.pool.checkin(b)
@@ -51,6 +51,16 @@ class KernelRequestListener (object):
 		"""
 		pass
 
+	def on_buffers(self, msg_type, buffers):
+		"""
+		Binary buffers that accompanied a message on the IOPUB socket; invoked immediately before the event
+		for the message itself (e.g. on_display_data or on_execute_result), and only if buffers were attached
+
+		:param msg_type: the type of the message that carried the buffers
+		:param buffers: list of buffers; large buffers are memoryviews onto the received frames
+		"""
+		pass
+
 	def on_input_request(self, prompt, password, reply_callback):
 		'''
 		'input_request' message on STDIN socket
@@ -69,6 +79,36 @@ class KernelRequestListener (object):
 		"""
 		pass
 
+	def on_request_finished(self):
+		"""
+		The request has finished; its reply and the kernel's idle status have been received, so no further
+		events will arrive. The listener has been detached from the request.
+		"""
+		pass
+
+	def on_kernel_dead(self):
+		"""
+		The heartbeat monitor declared the kernel dead while the request was in flight; no further events will
+		arrive. The listener has been detached from the request.
+		"""
+		pass
+
+	def on_request_expired(self):
+		"""
+		The request received no events within the connection's request_ttl, so its reply or idle status is
+		presumed lost; no further events will be delivered. The listener has been detached from the request.
+		"""
+		pass
+
+	def on_output_suppressed(self, suppressed):
+		"""
+		Output for the request was suppressed because it exceeded an output budget; invoked once, immediately
+		before on_request_finished
+
+		:param suppressed: a SuppressedOutput summarising the messages that were dropped
+		"""
+		pass
+
 	def on_comm_open(self, comm, data):
 		"""
 		'comm_open' message on IOPUB socket
@@ -287,6 +327,9 @@ class EventLogKernelRequestListener (KernelRequestListener):
 	def on_display_data(self, data, metadata):
 		self.events.append(krn_event('on_display_data', data=data, metadata=metadata))
 
+	def on_buffers(self, msg_type, buffers):
+		self.events.append(krn_event('on_buffers', msg_type=msg_type, buffers=[bytes(b)   for b in buffers]))
+
 	def on_status(self, busy):
 		self.events.append(krn_event('on_status', busy=busy))
 
@@ -298,6 +341,17 @@ class EventLogKernelRequestListener (KernelRequestListener):
 	def on_request_finished(self):
 		self.events.append(krn_event('on_request_finished'))
 
+	def on_kernel_dead(self):
+		self.events.append(krn_event('on_kernel_dead'))
+
+	def on_request_expired(self):
+		self.events.append(krn_event('on_request_expired'))
+
+	def on_output_suppressed(self, suppressed):
+		self.events.append(krn_event('on_output_suppressed', n_messages=suppressed.n_messages,
+					     n_bytes=suppressed.n_bytes, msg_types=suppressed.msg_types,
+					     reason=suppressed.reason))
+
 	def on_comm_open(self, comm, data):
 		super(EventLogKernelRequestListener, self).on_comm_open(comm, data)
 		self.events.append(krn_event('on_comm_open'))
@@ -0,0 +1,247 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import time
+
+
+
+class _TrackedRequest (object):
+	__slots__ = ('msg_id', 'listener', 'expects_reply', 'replied', 'idle', 'last_activity')
+
+	def __init__(self, msg_id, listener, expects_reply, now):
+		self.msg_id = msg_id
+		self.listener = listener
+		self.expects_reply = expects_reply
+		self.replied = False
+		self.idle = False
+		self.last_activity = now
+
+
+	@property
+	def finished(self):
+		return self.idle  and  (self.replied  or  not self.expects_reply)
+
+
+
+class RequestTracker (object):
+	'''
+	    Tracks the lifecycle of the requests whose events are delivered to a KernelRequestListener
+
+	    A request is finished once its reply has arrived on the SHELL socket and the kernel's idle status for
+	    it has arrived on the IOPUB socket; no further events are expected after that. Requests that elicit
+	    no reply (comm messages) finish on the idle status alone, and aborted requests, for which the kernel
+	    publishes no status, finish on the reply alone. Finished requests are removed, detaching their
+	    listener.
+
+	    If a time to live is given, requests that see no activity for that long are expired and removed by
+	    sweep(), so that requests whose reply or status is lost do not accumulate.
+	    '''
+
+	def __init__(self, ttl=None, clock=time.time):
+		'''
+		Request tracker constructor
+
+		:param ttl: None, or the time in seconds after the last event received for a request at which it expires
+		:param clock: function returning the current time in seconds
+		'''
+		self.__requests = {}
+		self.__ttl = ttl
+		self.__clock = clock
+		self.__next_sweep = None   if ttl is None   else clock() + ttl
+
+		self.n_tracked = 0
+		self.n_finished = 0
+		self.n_expired = 0
+		self.n_detached = 0
+
+
+	@property
+	def ttl(self):
+		return self.__ttl
+
+	@property
+	def n_live(self):
+		return len(self.__requests)
+
+
+	def stats(self):
+		'''
+		:return: a dictionary of counters: live, tracked, finished, expired and detached
+		'''
+		return {'live': len(self.__requests), 'tracked': self.n_tracked, 'finished': self.n_finished,
+			'expired': self.n_expired, 'detached': self.n_detached}
+
+
+	def add(self, msg_id, listener, expects_reply=True):
+		'''
+		Start tracking a request
+
+		:param msg_id: the message ID of the request
+		:param listener: the KernelRequestListener that receives the request's events
+		:param expects_reply: False for requests that elicit no reply on the SHELL socket
+		'''
+		self.__requests[msg_id] = _TrackedRequest(msg_id, listener, expects_reply,
+							  self.__clock()   if self.__ttl is not None   else None)
+		self.n_tracked += 1
+
+
+	def remove(self, msg_id):
+		'''
+		Stop tracking a request without finishing it
+
+		:param msg_id: the message ID of the request
+		:return: the request's listener, or None if the request is not being tracked
+		'''
+		request = self.__requests.pop(msg_id, None)
+		if request is not None:
+			self.n_detached += 1
+			return request.listener
+		return None
+
+
+	def remove_all(self):
+		'''
+		Stop tracking all requests without finishing them
+
+		:return: a list of the listeners of the requests
+		'''
+		requests = self.__requests.values()
+		self.__requests = {}
+		self.n_detached += len(requests)
+		return [r.listener   for r in requests]
+
+
+	def get_listener(self, msg_id):
+		'''
+		:param msg_id: the message ID of a request
+		:return: the listener for the request, or None if it is not being tracked
+		'''
+		request = self.__requests.get(msg_id)
+		if request is not None:
+			if self.__ttl is not None:
+				request.last_activity = self.__clock()
+			return request.listener
+		return None
+
+
+	def reply_received(self, msg_id, aborted=False):
+		'''
+		Notify the tracker that the reply to a request has arrived
+
+		:param msg_id: the message ID of the request
+		:param aborted: True if the kernel aborted the request
+		:return: the request's listener if the request is now finished, otherwise None
+		'''
+		request = self.__requests.get(msg_id)
+		if request is not None:
+			request.replied = True
+			if aborted:
+				request.idle = True
+			return self.__check_finished(request)
+		return None
+
+
+	def idle_received(self, msg_id):
+		'''
+		Notify the tracker that the kernel's idle status for a request has arrived
+
+		:param msg_id: the message ID of the request
+		:return: the request's listener if the request is now finished, otherwise None
+		'''
+		request = self.__requests.get(msg_id)
+		if request is not None:
+			request.idle = True
+			return self.__check_finished(request)
+		return None
+
+
+	def sweep(self, force=False):
+		'''
+		Expire requests that have seen no activity within the time to live
+
+		Cheap to call often; unless forced, requests are only examined once per time to live.
+
+		:param force: if True, examine the requests regardless of when they were last examined
+		:return: a list of the listeners of the expired requests
+		'''
+		if self.__ttl is None:
+			return []
+		now = self.__clock()
+		if not force  and  now < self.__next_sweep:
+			return []
+		self.__next_sweep = now + self.__ttl
+
+		expire_before = now - self.__ttl
+		expired = [r   for r in self.__requests.values()   if r.last_activity <= expire_before]
+		for request in expired:
+			del self.__requests[request.msg_id]
+		self.n_expired += len(expired)
+		return [r.listener   for r in expired]
+
+
+	def __check_finished(self, request):
+		if request.finished:
+			del self.__requests[request.msg_id]
+			self.n_finished += 1
+			return request.listener
+		return None
+
+
+
+
+import unittest
+
+class TestCase_request_tracker (unittest.TestCase):
+	def test_finish(self):
+		tracker = RequestTracker()
+		tracker.add('a', 'listener_a')
+		tracker.add('b', 'listener_b')
+		tracker.add('c', 'listener_c', expects_reply=False)
+		tracker.add('d', 'listener_d')
+		self.assertEqual(4, tracker.n_live)
+
+		self.assertEqual(None, tracker.idle_received('a'))
+		self.assertEqual('listener_a', tracker.reply_received('a'))
+		self.assertEqual(None, tracker.reply_received('b'))
+		self.assertEqual('listener_b', tracker.idle_received('b'))
+		self.assertEqual('listener_c', tracker.idle_received('c'))
+		self.assertEqual('listener_d', tracker.reply_received('d', aborted=True))
+		self.assertEqual(None, tracker.idle_received('a'))
+		self.assertEqual(None, tracker.get_listener('a'))
+		self.assertEqual({'live': 0, 'tracked': 4, 'finished': 4, 'expired': 0, 'detached': 0}, tracker.stats())
+
+
+	def test_expire(self):
+		now = [0.0]
+		tracker = RequestTracker(ttl=10.0, clock=lambda: now[0])
+		tracker.add('a', 'listener_a')
+		tracker.add('b', 'listener_b')
+		self.assertEqual('listener_a', tracker.remove('a'))
+
+		now[0] = 5.0
+		tracker.add('c', 'listener_c')
+		self.assertEqual([], tracker.sweep())
+
+		now[0] = 12.0
+		self.assertEqual('listener_c', tracker.get_listener('c'))
+		self.assertEqual(['listener_b'], tracker.sweep())
+		self.assertEqual(1, tracker.n_live)
+
+		now[0] = 21.0
+		self.assertEqual([], tracker.sweep())
+		now[0] = 22.0
+		self.assertEqual(['listener_c'], tracker.sweep())
+		self.assertEqual({'live': 0, 'tracked': 3, 'finished': 0, 'expired': 2, 'detached': 1}, tracker.stats())
+
+
+	def test_remove_all(self):
+		tracker = RequestTracker()
+		tracker.add('a', 'listener_a')
+		tracker.add('b', 'listener_b', expects_reply=False)
+		self.assertEqual(['listener_a', 'listener_b'], sorted(tracker.remove_all()))
+		self.assertEqual(None, tracker.idle_received('b'))
+		self.assertEqual({'live': 0, 'tracked': 2, 'finished': 0, 'expired': 0, 'detached': 2}, tracker.stats())
@@ -5,35 +5,148 @@
 ##-* This source code is (C)copyright Geoffrey French 1999-2014.
 ##-*************************
 
-import hashlib, hmac, uuid, datetime, json
+import uuid, datetime, itertools
 
-from .util import str_to_bytes, bytes_to_str, zmq_recv_multipart, zmq_send_multipart
+from .util import str_to_bytes, bytes_to_str, zmq_recv_multipart, zmq_send_multipart, clock
+from .codec import default_codec, available_codecs
+from .message import Message
+from .signer import HMACSigner
 
 
 _DELIM = str_to_bytes("<IDS|MSG>")
 _KERNEL_PROTOCOL_VERSION = b'5.0'
+# Received frames at least this large are not copied out of ZeroMQ's message buffers
+_DEFAULT_COPY_THRESHOLD = 65536
+
+
+
+class _PackedHeader (dict):
+	'''
+	A message header that carries its serialized form, so that it need not be packed again when sent
+	'''
+	__slots__ = ('packed',)
+
+
+
+def _frame_size(x):
+	'''
+	The size in bytes of a frame; buffers such as numpy arrays or memoryviews onto them may have more than one
+	dimension, in which case len() gives only the length of the first
+	'''
+	n_bytes = getattr(x, 'nbytes', None)
+	if n_bytes is not None:
+		return n_bytes
+	if isinstance(x, memoryview):
+		n_bytes = x.itemsize
+		for dim in x.shape:
+			n_bytes *= dim
+		return n_bytes
+	return len(x)
 
 
 
 
 class Session(object):
-	def __init__(self, key, username=''):
+	def __init__(self, key, username='', codec=None, verify_signatures=True, copy_threshold=_DEFAULT_COPY_THRESHOLD):
 		'''
 		IPython session constructor
 
 		:param key: message authentication key from connection file
 		:param username: Username of user (or empty string)
+		:param codec: JSON codec used to pack and unpack message data (see the codec module); None to use the
+			fastest available
+		:param verify_signatures: if False, the signatures of incoming messages are not checked. Only disable
+			this for kernels that you launched yourself and that are reached over a trusted local transport
+		:param copy_threshold: received frames of at least this many bytes are passed on as memoryviews onto
+			ZeroMQ's buffers rather than copied; None to always copy
 		:return:
 		'''
 		self.__key = key.encode('utf8')
 
-		self.auth = hmac.HMAC(self.__key, digestmod=hashlib.sha256)
+		self.codec = codec   if codec is not None   else default_codec()
 
-		self.session = str(uuid.uuid4())
-		self.username = username
+		self.auth = HMACSigner(self.__key)
+		self.verify_signatures = verify_signatures
+		self.copy_threshold = copy_threshold
+
+		self.__session = str(uuid.uuid4())
+		self.__username = username
+
+		# Message IDs are a random per-session prefix followed by a counter; cheaper than a UUID per message
+		self.__msg_id_prefix = str(uuid.uuid4()) + '_'
+		self.__msg_counter = itertools.count()
+		self.__update_header_template()
 
 		self.__none = self._pack({})
 
+		self.metrics = None
+
+
+	@property
+	def metrics(self):
+		'''
+		None, or the MetricsRegistry in which message counts, sizes and serialization times are recorded
+		'''
+		return self.__metrics
+
+	@metrics.setter
+	def metrics(self, registry):
+		self.__metrics = registry
+		if registry is not None:
+			self.__messages_sent = registry.counter('messages_sent_total', 'Messages sent', ('msg_type',))
+			self.__bytes_sent = registry.counter('bytes_sent_total', 'Bytes sent, including buffers')
+			self.__bytes_received = registry.counter('bytes_received_total', 'Bytes received, including buffers')
+			self.__serialize_time = registry.histogram('serialize_seconds',
+								   'Time spent building, serializing and signing messages')
+			self.__sign_time = registry.histogram('sign_seconds', 'Time spent signing messages')
+			self.__deserialize_time = registry.histogram('deserialize_seconds',
+								     'Time spent verifying and deserializing message headers')
+			self.__verify_time = registry.histogram('verify_seconds', 'Time spent verifying message signatures')
+
+
+	@property
+	def key(self):
+		return self.__key
+
+	@key.setter
+	def key(self, key):
+		'''
+		Replace the message authentication key
+
+		:param key: the key as read from the connection file; it is encoded as UTF-8 here
+		'''
+		key = key.encode('utf8')
+		if key != self.__key:
+			self.__key = key
+			self.auth = HMACSigner(key)
+
+
+	@property
+	def session(self):
+		return self.__session
+
+	@session.setter
+	def session(self, session):
+		self.__session = session
+		self.__update_header_template()
+
+	@property
+	def username(self):
+		return self.__username
+
+	@username.setter
+	def username(self, username):
+		self.__username = username
+		self.__update_header_template()
+
+
+	def __update_header_template(self):
+		# The serialized form of the parts of the header that never change, without the opening brace
+		self.__header_suffix = self.codec.dumps({'username': self.__username, 'session': self.__session,
+							 'version': _KERNEL_PROTOCOL_VERSION})[1:]
+		# Maps msg_type to the start of the serialized header, up to the opening quote of the msg_id
+		self.__header_prefixes = {}
+
 
 	def send(self, stream, msg_type, content=None, parent=None, metadata=None, ident=None, buffers=None):
 		'''
@@ -45,27 +158,53 @@ class Session(object):
 		:param parent: message parent header
 		:param metadata: message metadata
 		:param ident: IDENT
-		:param buffers: binary data buffers to append to message
+		:param buffers: binary data buffers (byte strings, or objects supporting the buffer interface such as
+			memoryviews) to append to message. They are sent without being copied, so they must not be modified
+			until the message has been sent.
 		:return: a tuple of (message structure, message ID)
 		'''
+		to_send, msg, msg_id = self.build_multipart(msg_type, content, parent, metadata, ident, buffers)
+		zmq_send_multipart(stream, to_send, copy=not buffers)
+		return msg, msg_id
+
+	def build_multipart(self, msg_type, content=None, parent=None, metadata=None, ident=None, buffers=None):
+		'''
+		Build and serialize a message, ready to be sent as a multipart message; see send()
+
+		:return: a tuple of (list of message parts, message structure, message ID)
+		'''
+		if self.__metrics is not None:
+			t0 = clock()
 		msg, msg_id = self.build_msg(msg_type, content, parent, metadata)
 		to_send = self.serialize(msg, ident)
 		if buffers is not None:
 			to_send.extend(buffers)
-		zmq_send_multipart(stream, to_send)
-		return msg, msg_id
+		if self.__metrics is not None:
+			self.__serialize_time.observe(clock() - t0)
+			self.__messages_sent.inc((msg_type,))
+			self.__bytes_sent.inc((), sum([_frame_size(x)   for x in to_send]))
+		return to_send, msg, msg_id
 
 	def recv(self, stream):
 		'''
 		Receive a message from a stream
+
+		Frames of copy_threshold bytes or more, typically binary buffers, arrive as memoryviews rather than
+		byte strings.
 		:param stream: the JeroMQ stream from which to read the message
 		:return: a tuple: (idents, msg) where msg is the deserialized message
 		'''
-		msg_list = zmq_recv_multipart(stream)
+		msg_list = zmq_recv_multipart(stream, self.copy_threshold)
 
 		# Extract identities
 		pos = msg_list.index(_DELIM)
 		idents, msg_list = msg_list[:pos], msg_list[pos + 1:]
+		if self.__metrics is not None:
+			self.__bytes_received.inc((), sum([len(x)   for x in msg_list]))
+			t0 = clock()
+			msg = self.deserialize(msg_list)
+			self.__deserialize_time.observe(clock() - t0)
+			return idents, msg
 		return idents, self.deserialize(msg_list)
 
 
@@ -83,9 +222,16 @@ class Session(object):
 		else:
 			content = self._pack(content)
 
-		payload = [self._pack(msg['header']),
-			   self._pack(msg['parent_header']),
-			   self._pack(msg['metadata']),
+		header = msg['header']
+		packed_header = getattr(header, 'packed', None)
+		if packed_header is None:
+			packed_header = self._pack(header)
+		parent_header = msg['parent_header']
+		metadata = msg['metadata']
+
+		payload = [packed_header,
+			   self._pack(parent_header)   if parent_header   else self.__none,
+			   self._pack(metadata)   if metadata   else self.__none,
 			   content]
 
 		serialized = []
@@ -96,7 +242,12 @@ class Session(object):
 			serialized.append(ident)
 		serialized.append(_DELIM)
 
-		signature = self.sign(payload)
+		if self.__metrics is not None:
+			t0 = clock()
+			signature = self.sign(payload)
+			self.__sign_time.observe(clock() - t0)
+		else:
+			signature = self.sign(payload)
 		serialized.append(signature)
 		serialized.extend(payload)
 
@@ -105,45 +256,49 @@ class Session(object):
 
 	def deserialize(self, msg_list):
 		'''
-		Deserialize a message, converting it from a list of byte arrays to a message structure (a dict)
+		Deserialize a message, converting it from a list of byte arrays to a message structure (a Message)
+
+		The header and parent header are decoded immediately; the metadata and content are decoded when
+		they are first accessed.
 		:param msg_list: serialized message in the form of a list of byte arrays
 		:return: message structure
 		'''
 		min_len = 5
-		if self.auth is not None:
-			signature = msg_list[0]
-			check = self.sign(msg_list[1:5])
-			if signature != check:
-				raise ValueError, 'Invalid signature'
 		if len(msg_list) < min_len:
 			raise ValueError, 'Message too short'
-		header = self._unpack(msg_list[1])
-		return {
-			'header': header,
-			'msg_id': header['msg_id'],
-			'msg_type': header['msg_type'],
-			'parent_header': self._unpack(msg_list[2]),
-			'metadata': self._unpack(msg_list[3]),
-			'content': self._unpack(msg_list[4]),
-			'buffers': msg_list[5:]
-		}
+		if self.auth is not None  and  self.verify_signatures:
+			if self.__metrics is not None:
+				t0 = clock()
+				verified = self.auth.verify(msg_list[0], msg_list[1:5])
+				self.__verify_time.observe(clock() - t0)
+			else:
+				verified = self.auth.verify(msg_list[0], msg_list[1:5])
+			if not verified:
+				raise ValueError, 'Invalid signature'
+		return Message(self._unpack, msg_list[1], msg_list[2], msg_list[3], msg_list[4], msg_list[5:])
 
 
 	def build_msg_header(self, msg_type):
 		'''
 		Build a header for a message of the given type
+
+		The header carries its serialized form, built by splicing the message ID, type and date into
+		a template that is prepared once per session.
 		:param msg_type: the message type
 		:return: the message header
 		'''
-		msg_id = str(uuid.uuid4())
-		return {
-			'msg_id': msg_id,
-			'msg_type': msg_type,
-			'username': self.username,
-			'session': self.session,
-			'date': datetime.datetime.now().isoformat(),
-			'version': _KERNEL_PROTOCOL_VERSION
-		}
+		msg_id = self.__msg_id_prefix + str(next(self.__msg_counter))
+		date = datetime.datetime.now().isoformat()
+		header = _PackedHeader(msg_id=msg_id, msg_type=msg_type, username=self.__username, session=self.__session,
+				       date=date, version=_KERNEL_PROTOCOL_VERSION)
+
+		try:
+			prefix = self.__header_prefixes[msg_type]
+		except KeyError:
+			prefix = '{"msg_type":' + self.codec.dumps(msg_type) + ',"msg_id":"'
+			self.__header_prefixes[msg_type] = prefix
+		header.packed = str_to_bytes(prefix + msg_id + '","date":"' + date + '",' + self.__header_suffix)
+		return header
 
 	def build_msg(self, msg_type, content=None, parent=None, metadata=None):
 		'''
@@ -176,10 +331,7 @@ class Session(object):
 		if self.auth is None:
 			return str_to_bytes('')
 		else:
-			h = self.auth.copy()
-			for m in msg_payload_list:
-				h.update(m)
-			return str_to_bytes(h.hexdigest())
+			return self.auth.sign(msg_payload_list)
 
 
 	def _pack(self, x):
@@ -189,7 +341,7 @@ class Session(object):
 		:param x: message data to pack
 		:return: byte array
 		'''
-		return str_to_bytes(json.dumps(x))
+		return str_to_bytes(self.codec.dumps(x))
 
 	def _unpack(self, x):
 		'''
@@ -198,7 +350,79 @@ class Session(object):
 		:param x: byte array to unpack
 		:return: message component
 		'''
-		return json.loads(bytes_to_str(x))
-
-
-
+		if isinstance(x, memoryview):
+			x = x.tobytes()
+		return self.codec.loads(bytes_to_str(x))
+
+
+
+
+
+
+import unittest
+
+class TestCase_session (unittest.TestCase):
+	def test_key(self):
+		session = Session(u'k\xe9y')
+		self.assertEqual(b'k\xc3\xa9y', session.key)
+		auth = session.auth
+
+		# Setting the same key keeps the signer
+		session.key = u'k\xe9y'
+		self.assertEqual(b'k\xc3\xa9y', session.key)
+		self.assertIs(auth, session.auth)
+
+		session.key = u'n\xe9w'
+		self.assertEqual(b'n\xc3\xa9w', session.key)
+		self.assertIsNot(auth, session.auth)
+
+
+	def test_packed_header(self):
+		msg_types = ['execute_request', 'comm_msg', 'quote"back\\slash', 'new\nline\ttab', u'caf\xe9', '']
+		for codec_type in available_codecs():
+			session = Session(u'key', username=u'us"er', codec=codec_type())
+			for msg_type in msg_types:
+				# The second header of each type is built from the cached prefix
+				for i in xrange(2):
+					header = session.build_msg_header(msg_type)
+					self.assertEqual(dict(header), session._unpack(header.packed), (codec_type, msg_type))
+
+				# The header survives being sent and received
+				msg, msg_id = session.build_msg(msg_type, {'a': 1})
+				received = session.deserialize(session.serialize(msg)[1:])
+				self.assertEqual(dict(msg['header']), received['header'])
+				self.assertEqual(msg_id, received['msg_id'])
+				self.assertEqual(msg_type, received['msg_type'])
+				self.assertEqual({'a': 1}, received['content'])
+
+
+	def test_msg_ids_unique(self):
+		a = Session(u'key')
+		b = Session(u'key')
+		ids_a = [a.build_msg_header('execute_request')['msg_id']   for i in xrange(1000)]
+		ids_b = [b.build_msg_header('execute_request')['msg_id']   for i in xrange(1000)]
+		self.assertEqual(1000, len(set(ids_a)))
+		self.assertEqual(1000, len(set(ids_b)))
+		self.assertEqual(set(), set(ids_a) & set(ids_b))
+		self.assertNotEqual(a.session, b.session)
+
+
+	def test_bytes_sent(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest('numpy is not available')
+		from .metrics import MetricsRegistry
+		session = Session(u'key')
+		session.metrics = MetricsRegistry()
+		bytes_sent = session.metrics.counter('bytes_sent_total')
+
+		to_send, msg, msg_id = session.build_multipart('comm_msg', {'a': 1})
+		header_bytes = sum([len(x)   for x in to_send])
+		self.assertEqual(header_bytes, bytes_sent.values[()])
+
+		# Multi-dimensional buffers are counted by their size in bytes, not their length
+		arr = numpy.zeros((256, 128))
+		to_send, msg, msg_id = session.build_multipart('comm_msg', {'a': 1}, buffers=[arr, memoryview(arr), b'xyz'])
+		header_bytes += sum([len(x)   for x in to_send[:-3]])
+		self.assertEqual(header_bytes + arr.nbytes * 2 + 3, bytes_sent.values[()])
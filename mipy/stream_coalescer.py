@@ -0,0 +1,134 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+
+
+class _PendingStream (object):
+	__slots__ = ('stream_name', 'chunks', 'size', 'timer')
+
+	def __init__(self, stream_name):
+		self.stream_name = stream_name
+		self.chunks = []
+		self.size = 0
+		self.timer = None
+
+
+
+class StreamCoalescer (object):
+	'''
+	    Merges consecutive 'stream' messages for the same request and stream name
+
+	    Text is held back until max_bytes have accumulated, until interval seconds have passed since the first
+	    held back chunk arrived, or until flush() is called for the request; the owner must call flush() before
+	    delivering any other event for the request (e.g. its idle status) so that ordering is preserved. The
+	    held back chunks are joined once, when they are delivered.
+	    '''
+
+	def __init__(self, deliver, timers, max_bytes=65536, interval=0.05):
+		'''
+		Stream coalescer constructor
+
+		:param deliver: function of the form f(parent_msg_id, stream_name, text) that delivers merged text
+		:param timers: a TimerQueue used to schedule interval flushes
+		:param max_bytes: the amount of text after which pending text is delivered immediately
+		:param interval: the longest time in seconds for which text is held back; None to hold text back until
+			max_bytes is reached or flush() is called
+		'''
+		self.__deliver = deliver
+		self.__timers = timers
+		self.__max_bytes = max_bytes
+		self.__interval = interval
+		self.__pending = {}
+
+		self.n_received = 0
+		self.n_delivered = 0
+
+
+	def has_pending(self, parent_msg_id):
+		return parent_msg_id in self.__pending
+
+
+	def add(self, parent_msg_id, stream_name, text):
+		'''
+		Add text received in a 'stream' message
+
+		:param parent_msg_id: the message ID of the request that produced the text
+		:param stream_name: the stream name, e.g. stdout
+		:param text: the text
+		'''
+		self.n_received += 1
+		pending = self.__pending.get(parent_msg_id)
+		if pending is not None  and  pending.stream_name != stream_name:
+			self.flush(parent_msg_id)
+			pending = None
+		if pending is None:
+			pending = _PendingStream(stream_name)
+			self.__pending[parent_msg_id] = pending
+			if self.__interval is not None:
+				pending.timer = self.__timers.add(self.__interval, lambda: self.flush(parent_msg_id))
+		pending.chunks.append(text)
+		pending.size += len(text)
+		if pending.size >= self.__max_bytes:
+			self.flush(parent_msg_id)
+
+
+	def flush(self, parent_msg_id):
+		'''
+		Deliver any text held back for a request
+		'''
+		pending = self.__pending.pop(parent_msg_id, None)
+		if pending is not None:
+			if pending.timer is not None:
+				pending.timer.cancel()
+			self.n_delivered += 1
+			self.__deliver(parent_msg_id, pending.stream_name, ''.join(pending.chunks))
+
+
+	def flush_all(self):
+		'''
+		Deliver all text held back
+		'''
+		for parent_msg_id in list(self.__pending.keys()):
+			self.flush(parent_msg_id)
+
+
+
+
+import unittest
+
+class TestCase_stream_coalescer (unittest.TestCase):
+	def test_coalesce(self):
+		from .timers import TimerQueue
+		now = [0.0]
+		timers = TimerQueue(clock=lambda: now[0])
+		delivered = []
+		coalescer = StreamCoalescer(lambda *args: delivered.append(args), timers, max_bytes=10, interval=1.0)
+
+		coalescer.add('a', 'stdout', 'abc')
+		coalescer.add('a', 'stdout', 'def')
+		coalescer.add('b', 'stdout', 'xyz')
+		self.assertEqual([], delivered)
+
+		# Switching stream delivers the text from the other stream first
+		coalescer.add('a', 'stderr', 'err')
+		self.assertEqual([('a', 'stdout', 'abcdef')], delivered)
+
+		# Byte limit
+		coalescer.add('b', 'stdout', '0123456789')
+		self.assertEqual(('b', 'stdout', 'xyz0123456789'), delivered[-1])
+
+		# Interval
+		now[0] = 1.0
+		timers.run_expired()
+		self.assertEqual(('a', 'stderr', 'err'), delivered[-1])
+		self.assertFalse(coalescer.has_pending('a'))
+
+		coalescer.add('b', 'stdout', 'q')
+		coalescer.flush('b')
+		self.assertEqual(('b', 'stdout', 'q'), delivered[-1])
+		self.assertEqual(0, len(timers))
+		self.assertEqual((6, 4), (coalescer.n_received, coalescer.n_delivered))
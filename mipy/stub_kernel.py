@@ -0,0 +1,317 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import os, sys, json, uuid, time, signal, tempfile, threading, traceback
+
+from .util import *
+from .session import Session
+
+
+
+_KERNEL_INFO = {
+	'protocol_version': '5.0',
+	'implementation': 'mipy-stub',
+	'implementation_version': '1.0',
+	'language_info': {'name': 'python', 'version': '{0}.{1}.{2}'.format(*sys.version_info[:3])},
+	'banner': 'mipy stub kernel',
+}
+
+
+
+def stream_output(text, name='stdout'):
+	'''
+	:return: a 'stream' output for an execute handler to return
+	'''
+	return ('stream', {'name': name, 'text': text})
+
+
+def display_output(data, metadata=None, buffers=None):
+	'''
+	:return: a 'display_data' output for an execute handler to return
+	'''
+	return ('display_data', {'data': data, 'metadata': metadata   if metadata is not None   else {}}, buffers)
+
+
+
+class StubKernel (object):
+	'''
+	    An in-process kernel that speaks the IPython messaging protocol, for tests and benchmarks
+
+	    Binds SHELL, CONTROL and STDIN (ROUTER), IOPUB (PUB) and heartbeat (REP) sockets to random loopback
+	    ports, writes a connection file describing them and answers requests on a background thread, using
+	    Session to sign and serialize messages just as a real kernel would:
+
+	    kernel_info, connect, history, complete, inspect and shutdown requests receive canned replies
+	    execute requests publish busy, execute_input, the outputs returned by the execute handler, then send
+	    	execute_reply and publish idle. If the execute handler raises an exception, an error is
+	    	published and the reply has status 'error'.
+	    comm_msg messages for comms opened by the front end are echoed back on IOPUB, with their buffers
+
+	    As with a real kernel, IOPUB is a PUB socket, so output published before a connection's subscription
+	    has been established is lost; make a request and wait for its reply before relying on output.
+	    '''
+
+	def __init__(self, execute_handler=None, connection_file_path=None, key=None):
+		'''
+		Stub kernel constructor; starts the kernel thread
+
+		:param execute_handler: None, or a function of the form f(code) that returns a list of outputs to
+			publish in response to an execute request, each a tuple of (msg_type, content) or
+			(msg_type, content, buffers); see stream_output() and display_output()
+		:param connection_file_path: path at which to write the connection file; None for a temporary file
+		:param key: the message signing key; None to generate one
+		'''
+		if connection_file_path is None:
+			handle, connection_file_path = tempfile.mkstemp(suffix='.json', prefix='stub_kernel')
+			os.close(handle)
+		if key is None:
+			key = str(uuid.uuid4())
+
+		self.__connection_file_path = connection_file_path
+		self.__execute_handler = execute_handler
+		self.__session = Session(key)
+		self.__execution_count = 0
+		self.__comm_ids = set()
+		self.n_requests = 0
+
+		self.__ctx = ZMQ_new_context(1)
+		address = 'tcp://127.0.0.1'
+		self.__shell = self.__ctx.socket(ZMQ.ROUTER)
+		self.__control = self.__ctx.socket(ZMQ.ROUTER)
+		self.__stdin = self.__ctx.socket(ZMQ.ROUTER)
+		self.__iopub = self.__ctx.socket(ZMQ.PUB)
+		self.__hb = self.__ctx.socket(ZMQ.REP)
+		# Never drop output, so that floods measure how fast a connection drains IOPUB rather than how much
+		# it loses; a slow subscriber holds the output back through TCP flow control instead
+		zmq_set_send_hwm(self.__iopub, 0)
+		ports = {}
+		for name, socket in [('shell_port', self.__shell), ('control_port', self.__control),
+				     ('stdin_port', self.__stdin), ('iopub_port', self.__iopub), ('hb_port', self.__hb)]:
+			zmq_set_linger(socket, 0)
+			ports[name] = socket.bind_to_random_port(address)
+		self.__ports = ports
+
+		connection = dict(ports)
+		connection.update({'ip': '127.0.0.1', 'transport': 'tcp', 'key': key, 'signature_scheme': 'hmac-sha256'})
+		# Write the connection file in one step, so that a client polling for it never reads part of it
+		with open(connection_file_path + '.tmp', 'w') as f:
+			json.dump(connection, f)
+		os.rename(connection_file_path + '.tmp', connection_file_path)
+
+		self.__running = True
+		self.__thread = threading.Thread(target=self.__run)
+		self.__thread.daemon = True
+		self.__thread.start()
+
+
+	@property
+	def connection_file_path(self):
+		return self.__connection_file_path
+
+
+	def connect(self, **kwargs):
+		'''
+		Open a connection to the stub kernel
+
+		:param kwargs: keyword arguments for the KernelConnection constructor
+		:return: a KernelConnection
+		'''
+		from .kernel import KernelConnection
+		return KernelConnection(kernel_path=self.__connection_file_path, **kwargs)
+
+
+	def close(self):
+		'''
+		Stop the kernel thread, close the sockets and remove the connection file
+		'''
+		if self.__running:
+			self.__running = False
+			self.__thread.join()
+			self.__ctx.term()
+			if os.path.exists(self.__connection_file_path):
+				os.remove(self.__connection_file_path)
+
+
+	def __run(self):
+		poller = ZMQReadPoller()
+		for socket in [self.__shell, self.__control, self.__hb]:
+			poller.register(socket)
+		try:
+			while self.__running:
+				poller.poll(50, self.__handle_socket_read)
+		finally:
+			for socket in [self.__shell, self.__control, self.__stdin, self.__iopub, self.__hb]:
+				socket.close()
+
+
+	def __handle_socket_read(self, socket):
+		if socket is self.__hb:
+			zmq_send_multipart(socket, zmq_recv_multipart(socket))
+			return
+		idents, msg = self.__session.recv(socket)
+		self.n_requests += 1
+		handler = getattr(self, '_StubKernel__handle_' + msg['msg_type'], None)
+		if handler is not None:
+			try:
+				handler(socket, idents, msg)
+			except:
+				print 'WARNING: stub kernel failed to handle {0}'.format(msg['msg_type'])
+				traceback.print_exc()
+
+
+	def __reply(self, socket, idents, msg, msg_type, content):
+		self.__session.send(socket, msg_type, content, parent=msg['header'], ident=idents)
+
+	def __publish(self, msg, msg_type, content, buffers=None):
+		self.__session.send(self.__iopub, msg_type, content, parent=msg['header'],
+				    ident=str_to_bytes('kernel.' + msg_type), buffers=buffers)
+
+	def __reply_busy(self, socket, idents, msg, msg_type, content):
+		self.__publish(msg, 'status', {'execution_state': 'busy'})
+		self.__reply(socket, idents, msg, msg_type, content)
+		self.__publish(msg, 'status', {'execution_state': 'idle'})
+
+
+	def __handle_kernel_info_request(self, socket, idents, msg):
+		self.__reply_busy(socket, idents, msg, 'kernel_info_reply', _KERNEL_INFO)
+
+	def __handle_connect_request(self, socket, idents, msg):
+		ports = self.__ports
+		self.__reply_busy(socket, idents, msg, 'connect_reply',
+				  {'shell_port': ports['shell_port'], 'iopub_port': ports['iopub_port'],
+				   'stdin_port': ports['stdin_port'], 'hb_port': ports['hb_port']})
+
+	def __handle_history_request(self, socket, idents, msg):
+		self.__reply_busy(socket, idents, msg, 'history_reply', {'history': []})
+
+	def __handle_complete_request(self, socket, idents, msg):
+		content = msg['content']
+		self.__reply_busy(socket, idents, msg, 'complete_reply',
+				  {'status': 'ok', 'matches': [], 'cursor_start': content['cursor_pos'],
+				   'cursor_end': content['cursor_pos'], 'metadata': {}})
+
+	def __handle_inspect_request(self, socket, idents, msg):
+		self.__reply_busy(socket, idents, msg, 'inspect_reply',
+				  {'status': 'ok', 'found': False, 'data': {}, 'metadata': {}})
+
+	def __handle_shutdown_request(self, socket, idents, msg):
+		self.__reply_busy(socket, idents, msg, 'shutdown_reply', {'restart': msg['content']['restart']})
+
+
+	def __handle_execute_request(self, socket, idents, msg):
+		content = msg['content']
+		code = content['code']
+		silent = content.get('silent', False)
+		if content.get('store_history', True)  and  not silent:
+			self.__execution_count += 1
+		execution_count = self.__execution_count
+
+		self.__publish(msg, 'status', {'execution_state': 'busy'})
+		if not silent:
+			self.__publish(msg, 'execute_input', {'code': code, 'execution_count': execution_count})
+		try:
+			outputs = self.__execute_handler(code)   if self.__execute_handler is not None   else []
+		except Exception, e:
+			error = {'ename': type(e).__name__, 'evalue': str(e), 'traceback': traceback.format_exc().splitlines()}
+			self.__publish(msg, 'error', error)
+			reply = dict(error, status='error', execution_count=execution_count)
+		else:
+			for output in outputs:
+				self.__publish(msg, output[0], output[1], output[2]   if len(output) > 2   else None)
+			reply = {'status': 'ok', 'execution_count': execution_count, 'payload': [], 'user_expressions': {}}
+		self.__reply(socket, idents, msg, 'execute_reply', reply)
+		self.__publish(msg, 'status', {'execution_state': 'idle'})
+
+
+	def __handle_comm_open(self, socket, idents, msg):
+		self.__comm_ids.add(msg['content']['comm_id'])
+
+	def __handle_comm_msg(self, socket, idents, msg):
+		content = msg['content']
+		if content['comm_id'] in self.__comm_ids:
+			self.__publish(msg, 'status', {'execution_state': 'busy'})
+			self.__publish(msg, 'comm_msg', {'comm_id': content['comm_id'], 'data': content['data']},
+				       buffers=[bytes(b)   for b in msg['buffers']]   or  None)
+			self.__publish(msg, 'status', {'execution_state': 'idle'})
+
+	def __handle_comm_close(self, socket, idents, msg):
+		self.__comm_ids.discard(msg['content']['comm_id'])
+
+
+
+def main(argv=None):
+	'''
+	Run a stub kernel until it is terminated; usage: python -m mipy.stub_kernel CONNECTION_FILE
+	'''
+	import argparse
+	parser = argparse.ArgumentParser(prog='python -m mipy.stub_kernel', description='Run a mipy stub kernel')
+	parser.add_argument('connection_file', help='path at which to write the connection file')
+	args = parser.parse_args(argv)
+
+	kernel = StubKernel(connection_file_path=args.connection_file)
+	stop = []
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+	try:
+		while len(stop) == 0:
+			time.sleep(0.1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		kernel.close()
+
+
+if __name__ == '__main__':
+	main()
+
+
+
+
+import unittest
+
+class TestCase_stub_kernel (unittest.TestCase):
+	def test_requests(self):
+		kernel = StubKernel(execute_handler=lambda code: [stream_output(code)])
+		try:
+			krn = kernel.connect()
+			try:
+				info = []
+				krn.kernel_info_request(on_kernel_info=lambda *args: info.append(args))
+				while len(info) == 0:
+					krn.poll(-1)
+				self.assertEqual(('5.0', 'mipy-stub'), info[0][:2])
+				# IOPUB is a slow joiner
+				time.sleep(0.2)
+
+				from .request_listener import KernelRequestListener
+				events = []
+				class Listener (KernelRequestListener):
+					def on_execute_ok(self, execution_count, payload, user_expressions):
+						events.append(('ok', execution_count))
+					def on_stream(self, stream_name, text):
+						events.append(('stream', text))
+					def on_request_finished(self):
+						events.append(('finished',))
+				krn.execute_request('hello', listener=Listener())
+				while ('finished',) not in events:
+					krn.poll(-1)
+				# Replies and output arrive on different sockets, so their relative order is not fixed
+				self.assertEqual([('ok', 1), ('stream', 'hello')], sorted(events[:2]))
+				self.assertEqual(('finished',), events[2])
+
+				received = []
+				comm = krn.open_comm('echo')
+				comm.on_binary_message = lambda comm, data, buffers, listener: received.append((data, buffers))
+				comm.send({'x': 1}, buffers=[b'abc'])
+				while len(received) == 0:
+					krn.poll(-1)
+				self.assertEqual({'x': 1}, received[0][0])
+				self.assertEqual([b'abc'], [bytes(b)   for b in received[0][1]])
+			finally:
+				krn.close()
+		finally:
+			kernel.close()
+		self.assertFalse(os.path.exists(kernel.connection_file_path))
@@ -0,0 +1,199 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import heapq, itertools, math, time
+
+
+
+def limit_poll_timeout(timeout, deadline, now):
+	'''
+	Limit a poll timeout so that the poll returns in time for a deadline
+
+	:param timeout: poll timeout in milliseconds; -1 = wait indefinitely, 0 = return immediately
+	:param deadline: the deadline in seconds, or None
+	:param now: the current time in seconds
+	:return: the timeout in milliseconds to use instead
+	'''
+	if deadline is None  or  timeout == 0:
+		return timeout
+	remaining = max(int(math.ceil((deadline - now) * 1000.0)), 0)
+	return remaining   if timeout < 0   else min(timeout, remaining)
+
+
+
+class Timer (object):
+	'''
+	A timer scheduled on a TimerQueue; returned by TimerQueue.add()
+	'''
+	__slots__ = ('deadline', 'callback', '_queue')
+
+	def __init__(self, queue, deadline, callback):
+		self._queue = queue
+		self.deadline = deadline
+		self.callback = callback
+
+
+	@property
+	def active(self):
+		return self.callback is not None
+
+
+	def cancel(self):
+		'''
+		Cancel the timer; has no effect if it has already fired or been cancelled
+		'''
+		if self.callback is not None:
+			self.callback = None
+			self._queue._on_cancelled()
+
+
+
+class TimerQueue (object):
+	'''
+	    A queue of timers ordered by deadline, held in a binary heap
+
+	    Adding a timer and firing the earliest cost O(log n); finding the next deadline is O(1). Cancelled
+	    timers are left in the heap and discarded when they reach the top, or when they come to outnumber
+	    the live timers, at which point the heap is rebuilt without them.
+	    '''
+
+	def __init__(self, clock=time.time, on_earliest=None):
+		'''
+		Timer queue constructor
+
+		:param clock: function returning the current time in seconds
+		:param on_earliest: None, or function of the form f(deadline) invoked when a timer is added whose
+			deadline is earlier than that of any other timer in the queue
+		'''
+		self.__heap = []
+		self.__counter = itertools.count()
+		self.__n_cancelled = 0
+		self.clock = clock
+		self.on_earliest = on_earliest
+
+
+	def __len__(self):
+		return len(self.__heap) - self.__n_cancelled
+
+
+	def add(self, delay, callback):
+		'''
+		Schedule a callback
+
+		:param delay: the time from now in seconds at which the callback should be invoked
+		:param callback: function of the form f()
+		:return: a Timer that can be used to cancel the callback
+		'''
+		timer = Timer(self, self.clock() + delay, callback)
+		# The counter breaks ties between equal deadlines, so timers are never compared with one another
+		heapq.heappush(self.__heap, (timer.deadline, next(self.__counter), timer))
+		if self.on_earliest is not None  and  self.__heap[0][2] is timer:
+			self.on_earliest(timer.deadline)
+		return timer
+
+
+	def next_deadline(self):
+		'''
+		:return: the deadline of the earliest active timer, or None if there are none
+		'''
+		heap = self.__heap
+		while len(heap) > 0  and  heap[0][2].callback is None:
+			heapq.heappop(heap)
+			self.__n_cancelled -= 1
+		return heap[0][0]   if len(heap) > 0   else None
+
+
+	def wait_time(self, timeout):
+		'''
+		Limit a poll timeout so that the poll returns in time for the next deadline
+
+		:param timeout: poll timeout in milliseconds; -1 = wait indefinitely, 0 = return immediately
+		:return: the timeout in milliseconds to use instead
+		'''
+		deadline = self.next_deadline()
+		if deadline is None:
+			return timeout
+		return limit_poll_timeout(timeout, deadline, self.clock())
+
+
+	def run_expired(self):
+		'''
+		Invoke the callbacks of all timers whose deadlines have passed, earliest first
+
+		:return: the number of callbacks invoked
+		'''
+		now = self.clock()
+		heap = self.__heap
+		n = 0
+		while len(heap) > 0  and  heap[0][0] <= now:
+			timer = heapq.heappop(heap)[2]
+			callback = timer.callback
+			if callback is None:
+				self.__n_cancelled -= 1
+			else:
+				timer.callback = None
+				callback()
+				n += 1
+		return n
+
+
+	def _on_cancelled(self):
+		self.__n_cancelled += 1
+		if self.__n_cancelled > 64  and  self.__n_cancelled * 2 > len(self.__heap):
+			self.__heap = [entry   for entry in self.__heap   if entry[2].callback is not None]
+			heapq.heapify(self.__heap)
+			self.__n_cancelled = 0
+
+
+
+
+import unittest
+
+class TestCase_timers (unittest.TestCase):
+	def test_order(self):
+		now = [0.0]
+		queue = TimerQueue(clock=lambda: now[0])
+		fired = []
+		for delay in [3.0, 1.0, 2.0, 1.0]:
+			queue.add(delay, lambda delay=delay: fired.append(delay))
+		cancelled = queue.add(1.5, lambda: fired.append('cancelled'))
+		cancelled.cancel()
+
+		self.assertEqual(4, len(queue))
+		self.assertEqual(1.0, queue.next_deadline())
+		self.assertEqual(1000, queue.wait_time(-1))
+		self.assertEqual(10, queue.wait_time(10))
+		self.assertEqual(0, queue.wait_time(0))
+
+		now[0] = 2.0
+		self.assertEqual(3, queue.run_expired())
+		self.assertEqual([1.0, 1.0, 2.0], fired)
+		self.assertEqual(1000, queue.wait_time(-1))
+		now[0] = 5.0
+		self.assertEqual(1, queue.run_expired())
+		self.assertEqual(None, queue.next_deadline())
+		self.assertEqual(-1, queue.wait_time(-1))
+
+
+	def test_cancel_compacts(self):
+		queue = TimerQueue(clock=lambda: 0.0)
+		timers = [queue.add(float(i), lambda: None)   for i in xrange(1000)]
+		for timer in timers[:900]:
+			timer.cancel()
+		self.assertEqual(100, len(queue))
+		self.assertEqual(900.0, queue.next_deadline())
+		self.assertFalse(timers[0].active)
+		self.assertTrue(timers[-1].active)
+
+
+	def test_on_earliest(self):
+		earliest = []
+		queue = TimerQueue(clock=lambda: 0.0, on_earliest=earliest.append)
+		queue.add(2.0, lambda: None)
+		queue.add(3.0, lambda: None)
+		queue.add(1.0, lambda: None)
+		self.assertEqual([2.0, 1.0], earliest)
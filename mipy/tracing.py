@@ -0,0 +1,361 @@
+##-*************************
+##-* This software can be used, redistributed and/or modified under
+##-* the terms of the BSD 2-clause license as found in the file
+##-* 'License.txt' in this distribution.
+##-* This source code is (C)copyright Geoffrey French 1999-2014.
+##-*************************
+
+import json, os, collections
+
+from .util import clock
+
+
+
+# The trace viewer row on which client side message dispatch is shown; each request gets a row of its own
+DISPATCH_TID = 0
+
+# Messages that mark the progress of a request rather than carrying its output
+_STAGE_MSG_TYPES = frozenset(['status', 'execute_input', 'pyin'])
+
+
+
+class _RequestTimeline (object):
+	__slots__ = ('msg_id', 'msg_type', 'expects_reply', 'tid', 'sent', 'queued', 'busy', 'started', 'replied',
+		     'idle', 'n_outputs')
+
+	def __init__(self, msg_id, msg_type, expects_reply, tid, sent, queued):
+		self.msg_id = msg_id
+		self.msg_type = msg_type
+		self.expects_reply = expects_reply
+		self.tid = tid
+		self.sent = sent
+		self.queued = queued
+		self.busy = None
+		self.started = None
+		self.replied = None
+		self.idle = None
+		self.n_outputs = 0
+
+
+
+class Tracer (object):
+	'''
+	    Records the timeline of each request made on a KernelConnection as Chrome trace events
+
+	    Pass a tracer to KernelConnection to enable tracing. Each request is shown on a row of its own, with
+	    spans for the stages of its lifecycle:
+	    send: serializing, signing and sending the request
+	    queued: from sending the request until the kernel reports busy; network time plus the time the
+	    	kernel took to get to it
+	    start: from busy until execute_input
+	    run: from execute_input (or busy) until the kernel reports idle
+	    and instant events for each output message and for the reply. A span covering the whole request is
+	    emitted once both its reply and idle status have arrived; on the idle status alone for messages that
+	    elicit no reply (comm messages), and on the reply alone if no busy status preceded it. The connection
+	    closes the timelines of requests that it finishes, times out, cancels or expires by other means. The
+	    time taken to dispatch each incoming message, including the listener callbacks it invokes, is shown
+	    on the dispatch row.
+
+	    Write the trace with write() and load it into chrome://tracing or Perfetto. All times are taken on the
+	    thread that sends requests and dispatches messages; a tracer is not thread safe.
+	    '''
+
+	def __init__(self, max_events=1000000, max_requests=10000, clock=clock):
+		'''
+		Tracer constructor
+
+		:param max_events: the most events recorded; further events are counted in n_dropped and discarded
+		:param max_requests: the most unfinished requests tracked at once; beyond this, the timeline of the
+			oldest is closed as abandoned to make room
+		:param clock: function returning the current time in seconds
+		'''
+		self.clock = clock
+		self.__max_events = max_events
+		self.__max_requests = max_requests
+		self.__origin = clock()
+		self.__pid = os.getpid()
+		self.__events = []
+		self.__timelines = collections.OrderedDict()
+		self.__next_tid = DISPATCH_TID + 1
+		self.n_dropped = 0
+		self.__thread_name(DISPATCH_TID, 'dispatch')
+
+
+	@property
+	def events(self):
+		'''
+		The trace events recorded so far, as a list of dictionaries in Chrome trace event format
+		'''
+		return self.__events
+
+	@property
+	def n_pending(self):
+		'''
+		The number of requests whose timelines are still open
+		'''
+		return len(self.__timelines)
+
+
+	def complete(self, name, cat, start, end, tid=DISPATCH_TID, args=None):
+		'''
+		Record a span
+
+		:param name: the name of the span
+		:param cat: its category
+		:param start: the time at which it started, from the tracer's clock
+		:param end: the time at which it ended
+		:param tid: the row on which to show it
+		:param args: None, or a dictionary of values to show with it
+		'''
+		event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': self.__us(start), 'dur': (end - start) * 1.0e6,
+			 'pid': self.__pid, 'tid': tid}
+		if args is not None:
+			event['args'] = args
+		self.__add(event)
+
+
+	def instant(self, name, cat, t, tid=DISPATCH_TID, args=None):
+		'''
+		Record an instant event
+
+		:param name: the name of the event
+		:param cat: its category
+		:param t: the time at which it occurred, from the tracer's clock
+		:param tid: the row on which to show it
+		:param args: None, or a dictionary of values to show with it
+		'''
+		event = {'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'ts': self.__us(t), 'pid': self.__pid, 'tid': tid}
+		if args is not None:
+			event['args'] = args
+		self.__add(event)
+
+
+	def request_sent(self, msg_id, msg_type, start, end, expects_reply=None):
+		'''
+		Open the timeline of a request
+
+		:param msg_id: the request's message ID
+		:param msg_type: its message type
+		:param start: the time at which sending began
+		:param end: the time at which it was handed to the socket
+		:param expects_reply: whether the kernel replies to the message; None to decide by its type, as
+			only *_request messages are replied to
+		'''
+		if expects_reply is None:
+			expects_reply = msg_type.endswith('_request')
+		while len(self.__timelines) >= self.__max_requests:
+			self.request_abandoned(next(iter(self.__timelines)), 'evicted')
+		tid = self.__next_tid
+		self.__next_tid += 1
+		self.__thread_name(tid, '{0} {1}'.format(msg_type, msg_id))
+		self.__timelines[msg_id] = _RequestTimeline(msg_id, msg_type, expects_reply, tid, start, end)
+		self.complete('send', 'request', start, end, tid)
+
+
+	def message_received(self, parent_msg_id, msg_type):
+		'''
+		Record the arrival of a message in the timeline of the request that caused it
+
+		:param parent_msg_id: the message ID of the request
+		:param msg_type: the type of the message received
+		'''
+		timeline = self.__timelines.get(parent_msg_id)
+		if timeline is None:
+			return
+		now = self.clock()
+		tid = timeline.tid
+		if msg_type == 'status':
+			if timeline.busy is None:
+				timeline.busy = now
+				self.complete('queued', 'request', timeline.queued, now, tid)
+			else:
+				timeline.idle = now
+				start = timeline.started   if timeline.started is not None   else timeline.busy
+				self.complete('run', 'request', start, now, tid)
+				if timeline.replied is not None  or  not timeline.expects_reply:
+					self.__finish(timeline, now)
+		elif msg_type == 'execute_input'  or  msg_type == 'pyin':
+			if timeline.busy is not None  and  timeline.started is None:
+				timeline.started = now
+				self.complete('start', 'request', timeline.busy, now, tid)
+		elif msg_type.endswith('_reply'):
+			timeline.replied = now
+			self.instant(msg_type, 'request', now, tid, {'latency_ms': (now - timeline.sent) * 1.0e3})
+			# The kernel publishes busy before handling a request, so if it has not arrived by the time of the
+			# reply, the status messages were lost (e.g. to the IOPUB slow joiner) or never sent (aborted)
+			if timeline.idle is not None  or  timeline.busy is None:
+				self.__finish(timeline, now)
+		else:
+			timeline.n_outputs += 1
+			self.instant(msg_type, 'output', now, tid)
+
+
+	def request_finished(self, msg_id):
+		'''
+		Close the timeline of a request that the connection has finished with, if it is still open, e.g.
+		because its idle status was lost
+
+		:param msg_id: the request's message ID
+		'''
+		timeline = self.__timelines.get(msg_id)
+		if timeline is not None:
+			self.__finish(timeline, self.clock())
+
+
+	def request_abandoned(self, msg_id, reason):
+		'''
+		Close the timeline of a request that will not complete, e.g. because it timed out
+
+		:param msg_id: the request's message ID
+		:param reason: a short description shown on the trace
+		'''
+		timeline = self.__timelines.pop(msg_id, None)
+		if timeline is not None:
+			now = self.clock()
+			self.instant(reason, 'request', now, timeline.tid)
+			self.complete(timeline.msg_type, 'request', timeline.sent, now, timeline.tid,
+				      {'msg_id': msg_id, 'outputs': timeline.n_outputs, 'abandoned': reason})
+
+
+	def abandon_all(self, reason):
+		'''
+		Close the timelines of all requests in flight
+
+		:param reason: a short description shown on the trace
+		'''
+		for msg_id in list(self.__timelines.keys()):
+			self.request_abandoned(msg_id, reason)
+
+
+	def clear(self):
+		'''
+		Discard the events recorded so far; timelines of requests in flight are kept
+		'''
+		del self.__events[:]
+		self.n_dropped = 0
+		self.__thread_name(DISPATCH_TID, 'dispatch')
+		for timeline in self.__timelines.values():
+			self.__thread_name(timeline.tid, '{0} {1}'.format(timeline.msg_type, timeline.msg_id))
+
+
+	def to_chrome_trace(self):
+		'''
+		:return: the trace as a JSON serializable dictionary in Chrome trace event format
+		'''
+		return {'traceEvents': list(self.__events), 'displayTimeUnit': 'ms',
+			'otherData': {'dropped_events': self.n_dropped}}
+
+
+	def write(self, f):
+		'''
+		Write the trace as Chrome trace event JSON
+
+		:param f: a file name or a file-like object
+		'''
+		if isinstance(f, basestring):
+			with open(f, 'w') as out:
+				json.dump(self.to_chrome_trace(), out)
+		else:
+			json.dump(self.to_chrome_trace(), f)
+
+
+	def __finish(self, timeline, now):
+		del self.__timelines[timeline.msg_id]
+		self.complete(timeline.msg_type, 'request', timeline.sent, now, timeline.tid,
+			      {'msg_id': timeline.msg_id, 'outputs': timeline.n_outputs})
+
+
+	def __thread_name(self, tid, name):
+		self.__add({'name': 'thread_name', 'ph': 'M', 'pid': self.__pid, 'tid': tid, 'args': {'name': name}})
+
+
+	def __us(self, t):
+		return (t - self.__origin) * 1.0e6
+
+
+	def __add(self, event):
+		if len(self.__events) < self.__max_events:
+			self.__events.append(event)
+		else:
+			self.n_dropped += 1
+
+
+
+
+import unittest
+
+class TestCase_tracing (unittest.TestCase):
+	def __spans(self, tracer, tid):
+		return [(ev['name'], ev['ts'], ev['dur'])   for ev in tracer.events   if ev['ph'] == 'X'  and  ev['tid'] == tid]
+
+
+	def test_request_timeline(self):
+		now = [0.0]
+		tracer = Tracer(clock=lambda: now[0])
+		tracer.request_sent('req-1', 'execute_request', 0.0, 0.001)
+		for t, msg_type in [(0.003, 'status'), (0.004, 'execute_input'), (0.010, 'stream'), (0.011, 'stream'),
+				    (0.020, 'execute_reply'), (0.021, 'status')]:
+			now[0] = t
+			tracer.message_received('req-1', msg_type)
+		# Messages for requests that are not traced are ignored
+		tracer.message_received('other', 'status')
+
+		spans = [(name, round(ts), round(dur))   for name, ts, dur in self.__spans(tracer, 1)]
+		self.assertEqual([('send', 0, 1000), ('queued', 1000, 2000), ('start', 3000, 1000), ('run', 4000, 17000),
+				  ('execute_request', 0, 21000)], spans)
+		instants = [ev['name']   for ev in tracer.events   if ev['ph'] == 'i']
+		self.assertEqual(['stream', 'stream', 'execute_reply'], instants)
+		self.assertEqual(0, tracer.n_pending)
+		names = [ev['args']['name']   for ev in tracer.events   if ev['ph'] == 'M']
+		self.assertEqual(['dispatch', 'execute_request req-1'], names)
+
+
+	def test_abandon_and_limits(self):
+		now = [0.0]
+		tracer = Tracer(max_events=10, max_requests=1, clock=lambda: now[0])
+		tracer.request_sent('req-1', 'complete_request', 0.0, 0.0)
+		# Over the request limit; the oldest timeline makes room
+		tracer.request_sent('req-2', 'complete_request', 0.0, 0.0)
+		self.assertEqual(1, tracer.n_pending)
+		self.assertEqual({'msg_id': 'req-1', 'outputs': 0, 'abandoned': 'evicted'}, tracer.events[-3]['args'])
+		now[0] = 1.0
+		tracer.abandon_all('timeout')
+		self.assertEqual(0, tracer.n_pending)
+		self.assertEqual({'msg_id': 'req-2', 'outputs': 0, 'abandoned': 'timeout'}, tracer.events[-1]['args'])
+
+		for i in xrange(10):
+			tracer.complete('x', 'dispatch', 0.0, 0.0)
+		self.assertEqual(10, len(tracer.events))
+		self.assertEqual(9, tracer.n_dropped)
+
+		trace = json.loads(json.dumps(tracer.to_chrome_trace()))
+		self.assertEqual(10, len(trace['traceEvents']))
+		tracer.clear()
+		self.assertEqual(1, len(tracer.events))
+
+
+	def test_close_without_reply(self):
+		now = [0.0]
+		tracer = Tracer(clock=lambda: now[0])
+		# Comm messages are not replied to; their timelines close on idle
+		tracer.request_sent('comm-1', 'comm_msg', 0.0, 0.0)
+		for msg_type in ['status', 'comm_msg', 'status']:
+			tracer.message_received('comm-1', msg_type)
+		self.assertEqual(0, tracer.n_pending)
+
+		# A reply without a preceding busy status closes the timeline
+		tracer.request_sent('req-0', 'kernel_info_request', 0.0, 0.0)
+		tracer.message_received('req-0', 'kernel_info_reply')
+		self.assertEqual(0, tracer.n_pending)
+
+		# A request whose idle status is lost is closed when the connection finishes it
+		tracer.request_sent('req-1', 'execute_request', 0.0, 0.0)
+		tracer.message_received('req-1', 'status')
+		tracer.message_received('req-1', 'execute_reply')
+		self.assertEqual(1, tracer.n_pending)
+		now[0] = 1.0
+		tracer.request_finished('req-1')
+		self.assertEqual(0, tracer.n_pending)
+		self.assertEqual(('execute_request', 1.0e6), (tracer.events[-1]['name'], tracer.events[-1]['dur']))
+		tracer.request_finished('req-1')
+		self.assertEqual(0, tracer.n_pending)
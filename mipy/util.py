@@ -5,7 +5,13 @@
 ##-* This source code is (C)copyright Geoffrey French 1999-2014.
 ##-*************************
 
-import os
+import os, timeit
+
+
+
+# The highest resolution wall clock timer available on Python 2 (time.clock on Windows, time.time elsewhere).
+# It is not monotonic: a clock adjustment can make a measured duration negative.
+clock = timeit.default_timer
 
 
 if os.name == 'java':
@@ -18,6 +24,10 @@ if os.name == 'java':
 
 	ZMQ_new_context = ZMQ.context
 
+	# JeroMQ sockets do not expose file descriptors that can be waited on with select, so zmq_socket_fd()
+	# is not defined
+	ZMQ_SOCKET_FDS_AVAILABLE = False
+
 	class ZMQReadPoller (object):
 		def __init__(self, n_sockets=4):
 			self.__poller = ZMQ.Poller(n_sockets)
@@ -28,6 +38,10 @@ if os.name == 'java':
 			index = self.__poller.register(socket, ZMQ.Poller.POLLIN)
 			self.__indices_and_sockets.append((index, socket))
 
+		def unregister(self, socket):
+			self.__poller.unregister(socket)
+			self.__indices_and_sockets = [(i, s)   for i, s in self.__indices_and_sockets   if s is not socket]
+
 		def poll(self, timeout, event_callback):
 			n_events_processed = 0
 			n_events = self.__poller.poll(timeout)
@@ -45,17 +59,30 @@ if os.name == 'java':
 	def zmq_subscribe_socket(socket, topic):
 		socket.subscribe(str_to_bytes(topic))
 
-	def zmq_recv_multipart(stream):
+	def zmq_set_identity(socket, identity):
+		socket.setIdentity(str_to_bytes(identity))
+
+	def zmq_recv_multipart(stream, copy_threshold=None):
+		# JeroMQ always hands over frames as Java byte arrays; copy_threshold is accepted for compatibility
 		msg_list = [stream.recv()]
 		while stream.hasReceiveMore():
 			msg_list.append(stream.recv())
 		return msg_list
 
-	def zmq_send_multipart(stream, msg_parts):
+	def zmq_send_multipart(stream, msg_parts, copy=True):
 		for part in msg_parts[:-1]:
 			stream.sendMore(part)
 		stream.send(msg_parts[-1])
 
+	def zmq_socket_readable(socket):
+		return (socket.getEvents() & ZMQ.Poller.POLLIN) != 0
+
+	def zmq_set_linger(socket, linger):
+		socket.setLinger(linger)
+
+	def zmq_set_send_hwm(socket, hwm):
+		socket.setSndHWM(hwm)
+
 else:
 	import zmq as ZMQ
 
@@ -67,6 +94,8 @@ else:
 
 	ZMQ_new_context = ZMQ.Context
 
+	ZMQ_SOCKET_FDS_AVAILABLE = True
+
 	class ZMQReadPoller (object):
 		def __init__(self):
 			self.__poller = ZMQ.Poller()
@@ -75,6 +104,9 @@ else:
 		def register(self, socket):
 			self.__poller.register(socket, ZMQ.POLLIN)
 
+		def unregister(self, socket):
+			self.__poller.unregister(socket)
+
 		def poll(self, timeout, event_callback):
 			events = self.__poller.poll(timeout)
 			for socket, event_flags in events:
@@ -88,11 +120,34 @@ else:
 	def zmq_subscribe_socket(socket, topic):
 		socket.set(ZMQ.SUBSCRIBE, topic)
 
-	def zmq_recv_multipart(stream):
-		return stream.recv_multipart()
+	def zmq_set_identity(socket, identity):
+		socket.setsockopt(ZMQ.IDENTITY, identity)
+
+	def zmq_recv_multipart(stream, copy_threshold=None):
+		if copy_threshold is None:
+			return stream.recv_multipart()
+		else:
+			# Receive without copying; frames smaller than the threshold are cheap to copy into byte strings,
+			# larger ones are handed over as memoryviews onto the ZeroMQ message
+			frames = stream.recv_multipart(copy=False)
+			return [f.bytes   if len(f) < copy_threshold   else f.buffer   for f in frames]
+
+	def zmq_send_multipart(stream, msg_parts, copy=True):
+		stream.send_multipart(msg_parts, copy=copy)
+
+	def zmq_socket_fd(socket):
+		# Note that the file descriptor is edge triggered; use zmq_socket_readable to check for
+		# messages that were already queued when it signalled
+		return socket.getsockopt(ZMQ.FD)
 
-	def zmq_send_multipart(stream, msg_parts):
-		stream.send_multipart(msg_parts)
+	def zmq_socket_readable(socket):
+		return (socket.getsockopt(ZMQ.EVENTS) & ZMQ.POLLIN) != 0
+
+	def zmq_set_linger(socket, linger):
+		socket.setsockopt(ZMQ.LINGER, linger)
+
+	def zmq_set_send_hwm(socket, hwm):
+		socket.setsockopt(ZMQ.SNDHWM, hwm)
 
 
 class MessageRouter(object):
@@ -112,6 +167,34 @@ class MessageRouter(object):
 		self.__handler_method_cache = {}
 		self.__instance = instance
 		self.__socket_name = socket_name
+		self.__messages_received = None
+		self.__handle_time = None
+		self.__tracer = None
+
+
+	def set_metrics(self, registry):
+		'''
+		Record the number of messages received and the time spent handling them
+
+		:param registry: None, or a MetricsRegistry
+		'''
+		if registry is not None:
+			self.__messages_received = registry.counter('messages_received_total', 'Messages received',
+								    ('socket', 'msg_type'))
+			self.__handle_time = registry.histogram('handle_seconds', 'Time spent in message handlers',
+								('socket', 'msg_type'))
+		else:
+			self.__messages_received = None
+			self.__handle_time = None
+
+
+	def set_tracer(self, tracer):
+		'''
+		Record the time spent handling each message as a span on a trace
+
+		:param tracer: None, or a Tracer
+		'''
+		self.__tracer = tracer
 
 
 	def handle(self, idents, msg):
@@ -141,6 +224,27 @@ class MessageRouter(object):
 				bound_method = None
 			self.__handler_method_cache[msg_type] = bound_method
 
+		tracer = self.__tracer
+		if tracer is not None  and  bound_method is not None:
+			t0 = tracer.clock()
+			try:
+				return self.__handle_measured(bound_method, idents, msg, msg_type)
+			finally:
+				tracer.complete('{0}.{1}'.format(self.__socket_name, msg_type), 'dispatch', t0, tracer.clock())
+		return self.__handle_measured(bound_method, idents, msg, msg_type)
+
+
+	def __handle_measured(self, bound_method, idents, msg, msg_type):
+		if self.__messages_received is not None:
+			labels = (self.__socket_name, msg_type)
+			self.__messages_received.inc(labels)
+			if bound_method is not None:
+				t0 = clock()
+				try:
+					return bound_method(idents, msg)
+				finally:
+					self.__handle_time.observe(clock() - t0, labels)
+
 		if bound_method is not None:
 			return bound_method(idents, msg)
 		else:
@@ -18,9 +18,47 @@ if os.name == 'java':
 
 
 
+import mipy.codec
+import mipy.message
+import mipy.signer
+import mipy.session
+import mipy.request_tracker
+import mipy.timers
+import mipy.stream_coalescer
+import mipy.output_budget
+import mipy.heartbeat
+import mipy.metrics
+import mipy.tracing
+import mipy.stub_kernel
 import mipy.kernel
-
-testModules = [ mipy.kernel,
+import mipy.pool
+import mipy.async_connection
+import mipy.hub
+import mipy.completion_cache
+import mipy.history
+import mipy.loadgen
+import mipy.array_comm
+
+testModules = [ mipy.codec,
+		mipy.message,
+		mipy.signer,
+		mipy.session,
+		mipy.request_tracker,
+		mipy.timers,
+		mipy.stream_coalescer,
+		mipy.output_budget,
+		mipy.heartbeat,
+		mipy.metrics,
+		mipy.tracing,
+		mipy.stub_kernel,
+		mipy.kernel,
+		mipy.pool,
+		mipy.async_connection,
+		mipy.hub,
+		mipy.completion_cache,
+		mipy.history,
+		mipy.loadgen,
+		mipy.array_comm,
 		]
 
 